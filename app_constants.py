@@ -1,9 +1,33 @@
+# Категории ремонта: (id, ключ, название).
+# id хранится в заявках, ключ - в кнопках и коде, название только показывается,
+# поэтому его можно менять. id не меняются и не используются повторно.
+CATEGORIES = (
+    (1, "plumbing", "Сантехника 🚿"),
+    (2, "electrical", "Электрика ⚡"),
+    (3, "appliances", "Бытовая техника 🌀"),
+    (4, "furniture", "Сборка мебели 🛋️"),
+    (5, "doors_windows", "Двери/Окна 🚪"),
+    (6, "other", "Прочее 🔧"),
+)
+
 # Список категорий для ремонта
-REPAIR_CATEGORIES = {
-    "plumbing": "Сантехника 🚿",
-    "electrical": "Электрика ⚡",
-    "appliances": "Бытовая техника 🌀",
-    "furniture": "Сборка мебели 🛋️",
-    "doors_windows": "Двери/Окна 🚪",
-    "other": "Прочее 🔧"
-}
\ No newline at end of file
+REPAIR_CATEGORIES = {key: label for _, key, label in CATEGORIES}
+CATEGORY_IDS = {key: category_id for category_id, key, _ in CATEGORIES}
+
+# Сроки заявок по категориям, в минутах (см. sla.py): сколько новая заявка ждет мастера,
+# прежде чем о ней напомнят всем мастерам и клиенту, и сколько заявка может быть в работе
+# до напоминания мастеру. Напоминания повторяются через тот же срок, не больше SLA_MAX_ALERTS раз.
+# Категории без записи (в том числе старые из базы) получают SLA_DEFAULT_MINUTES
+SLA_MINUTES = {
+    "plumbing": (30, 240),
+    "electrical": (30, 240),
+    "appliances": (60, 480),
+    "furniture": (120, 1440),
+    "doors_windows": (120, 1440),
+    "other": (60, 720),
+}
+SLA_DEFAULT_MINUTES = (60, 720)
+SLA_MAX_ALERTS = 3
+
+# За сколько последних дней /finance показывает завершенные заказы по категориям
+FINANCE_DAYS = 7
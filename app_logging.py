@@ -0,0 +1,70 @@
+import json
+import logging
+import os
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# Уровень и формат журнала задаются переменными окружения
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+
+# Поля, которые обработчики передают через extra={...}
+CONTEXT_FIELDS = ('order_id', 'user_id', 'handler')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON с полями order_id, user_id и handler, если они заданы"""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler, который не форматирует запись в потоке обработчика.
+
+    Стандартный prepare() собирает сообщение сразу; здесь запись уходит в очередь
+    как есть, а подстановка аргументов и JSON делаются в потоке QueueListener.
+    Это безопасно, пока очередь не покидает процесс и в аргументах неизменяемые значения."""
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None):
+    """Направить все журналы через очередь в фоновый поток. Возвращает запущенный QueueListener,
+    его нужно остановить при завершении, чтобы дописать хвост очереди"""
+    # Наши форматы не выводят файл, строку и процесс: не собираем их для каждой записи
+    # (рекомендация из раздела Optimization документации logging)
+    logging._srcfile = None
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(records))
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    listener = QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,97 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Завершенные заявки старше ARCHIVE_AFTER_DAYS дней переносятся в orders_archive (0 - не переносить)
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '500'))
+ARCHIVE_INTERVAL = float(os.getenv('ARCHIVE_INTERVAL', '3600'))
+# Пауза между пачками, чтобы бот успевал записывать заявки между ними
+ARCHIVE_PAUSE = 0.05
+# Страниц за один шаг incremental_vacuum (по 4 КБ - около 1 МБ)
+VACUUM_STEP_PAGES = 256
+
+
+class OrderArchiver:
+    """Фоновый перенос старых завершенных заявок в архив.
+
+    Раз в interval секунд переносит заявки пачками по batch_size в отдельных транзакциях,
+    затем небольшими шагами incremental_vacuum возвращает освободившееся место в файле.
+    Запускается в одном процессе: в bot.py или в супервизоре."""
+
+    def __init__(self, after_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE, interval=ARCHIVE_INTERVAL,
+                 pause=ARCHIVE_PAUSE):
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {'archived': 0, 'batches': 0, 'vacuumed_pages': 0, 'runs': 0}
+
+    def start(self):
+        if self.after_days <= 0:
+            logger.info("Архивирование заявок выключено (ARCHIVE_AFTER_DAYS=0)")
+            return
+        self._thread = threading.Thread(target=self._run, name="archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def run_once(self):
+        """Перенести все подходящие заявки и освободить место. Возвращает число перенесенных"""
+        completed_before = (datetime.now(timezone.utc) - timedelta(days=self.after_days)).strftime('%Y-%m-%d %H:%M:%S')
+        archived = 0
+        while not self._stopping.is_set():
+            moved = database.archive_orders(completed_before, self.batch_size)
+            if not moved:
+                break
+            archived += moved
+            self._count('archived', moved)
+            self._count('batches')
+            self._stopping.wait(self.pause)
+        if archived:
+            logger.info("Перенесено в архив заявок: %s", archived)
+        self.vacuum()
+        self._count('runs')
+        return archived
+
+    def vacuum(self):
+        """Вернуть свободные страницы файла шагами по VACUUM_STEP_PAGES"""
+        free, page_size, incremental = database.free_pages()
+        if not free:
+            return
+        if not incremental:
+            logger.info("В базе %s свободных страниц (%.1f МБ); чтобы возвращать их автоматически, "
+                        "выполните один раз manage.py vacuum", free, free * page_size / 1e6)
+            return
+        while free and not self._stopping.is_set():
+            database.incremental_vacuum(VACUUM_STEP_PAGES)
+            self._count('vacuumed_pages', min(free, VACUUM_STEP_PAGES))
+            free = database.free_pages()[0]
+            self._stopping.wait(self.pause)
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Ошибка архивирования заявок")
+            self._stopping.wait(self.interval)
@@ -0,0 +1,186 @@
+import logging
+import os
+import threading
+import time
+from datetime import date
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Авто-распределение включается явно: AUTO_DISPATCH=1. Заявки предлагаются только мастерам,
+# которые выбрали категории командой /skills; остальные берут заявки сами через /admin
+AUTO_DISPATCH = os.getenv('AUTO_DISPATCH', '0') == '1'
+# Сколько секунд мастер думает над предложением, прежде чем заявка уйдет следующему
+OFFER_TIMEOUT = float(os.getenv('DISPATCH_OFFER_TIMEOUT', '60'))
+DISPATCH_INTERVAL = float(os.getenv('DISPATCH_INTERVAL', '1'))
+# Заявок в одном сопоставлении; сколько новых заявок просматривать за проход и по сколько за запрос
+DISPATCH_BATCH = 100
+DISPATCH_SCAN_LIMIT = 10000
+DISPATCH_PAGE_SIZE = 500
+
+
+def match_orders(orders, masters_by_category, free, loads):
+    """Сопоставить заявки свободным мастерам: паросочетание Куна.
+
+    orders - [(order_id, category_id, offered)] в порядке очереди, offered - мастера,
+    которым заявка уже предлагалась. Каждый мастер получает не больше одной заявки.
+    Поздняя заявка забирает мастера у ранней, только если для ранней находится другой,
+    поэтому назначений максимально много, а старые заявки не уступают место новым.
+    Из подходящих мастеров первым пробуется наименее загруженный (loads).
+    Возвращает {order_id: master_id}."""
+    candidates = []
+    for order_id, category_id, offered in orders:
+        masters = [master_id for master_id in masters_by_category.get(category_id, ())
+                   if master_id in free and master_id not in offered]
+        masters.sort(key=lambda master_id: (loads.get(master_id, 0), master_id))
+        candidates.append(masters)
+
+    owners = {}
+
+    def augment(index, seen):
+        for master_id in candidates[index]:
+            if master_id in seen:
+                continue
+            seen.add(master_id)
+            if master_id not in owners or augment(owners[master_id], seen):
+                owners[master_id] = index
+                return True
+        return False
+
+    for index, masters in enumerate(candidates):
+        if masters:
+            augment(index, set())
+    return {orders[index][0]: master_id for master_id, index in owners.items()}
+
+
+class AutoDispatcher:
+    """Предложение новых заявок мастерам без /admin.
+
+    Раз в interval секунд или сразу после wake() поток закрывает просроченные предложения,
+    собирает новые заявки без предложения и свободных мастеров с нужной категорией
+    и сопоставляет их (match_orders). Мастер получает сообщение с кнопками
+    "Принять"/"Отказаться"; после отказа или timeout секунд заявка предлагается
+    следующему. Заявка, которую предложили всем подходящим мастерам, остается в /admin.
+
+    Состояние предложений хранится в dispatch_offers, поэтому ответы мастеров можно
+    обрабатывать в любом процессе, а сам AutoDispatcher работает в одном: в bot.py или
+    в супервизоре. Индекс мастеров по категориям и загрузка (сколько заявок предложено
+    за день) живут в памяти."""
+
+    def __init__(self, notifier, render, timeout=OFFER_TIMEOUT, interval=DISPATCH_INTERVAL,
+                 batch_size=DISPATCH_BATCH, scan_limit=DISPATCH_SCAN_LIMIT):
+        self.notifier = notifier
+        self.render = render
+        self.timeout = timeout
+        self.interval = interval
+        self.batch_size = batch_size
+        self.scan_limit = scan_limit
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._skills = None
+        self._masters_by_category = {}
+        self._exhausted = set()
+        self._loads = {}
+        self._loads_day = None
+        self._lock = threading.Lock()
+        self._counters = {'offered': 0, 'expired': 0, 'exhausted': 0, 'runs': 0}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="auto-dispatch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+    def wake(self):
+        """Разобрать очередь сразу: после новой заявки, отказа или смены категорий мастера"""
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def run_once(self):
+        """Один проход распределения. Возвращает число отправленных предложений"""
+        now = time.time()
+        self._count('expired', database.expire_offers(now))
+        self._count('runs')
+        self._load_skills()
+        if not self._masters_by_category:
+            return 0
+        free = {master_id for masters in self._masters_by_category.values() for master_id in masters}
+        free -= database.get_busy_masters()
+        if not free:
+            return 0
+
+        if self._loads_day != date.today():
+            self._loads_day = date.today()
+            self._loads = {}
+        matches = match_orders(self._collect_orders(free), self._masters_by_category, free, self._loads)
+        if not matches:
+            return 0
+        database.create_offers(matches.items(), now + self.timeout)
+        orders = {order.id: order for order in database.get_orders_by_ids(matches)}
+        for order_id, master_id in matches.items():
+            self._loads[master_id] = self._loads.get(master_id, 0) + 1
+            text, reply_markup = self.render(orders[order_id], self.timeout)
+            self.notifier.notify(master_id, text, parse_mode='Markdown', reply_markup=reply_markup)
+        self._count('offered', len(matches))
+        return len(matches)
+
+    def _load_skills(self):
+        skills = sorted(database.get_master_skills())
+        if skills == self._skills:
+            return
+        # Мастера сменили категории: заявки, которые некому было предложить, проверяются заново
+        self._skills = skills
+        self._exhausted.clear()
+        self._masters_by_category = {}
+        for master_id, _, category_id in skills:
+            self._masters_by_category.setdefault(category_id, []).append(master_id)
+
+    def _collect_orders(self, free):
+        """Заявки в порядке очереди, которые можно предложить кому-то из free:
+        [(order_id, category_id, offered)]"""
+        orders = []
+        after = ('', 0)
+        scanned = set()
+        while len(orders) < self.batch_size and len(scanned) < self.scan_limit:
+            page = database.get_undispatched_orders(after, DISPATCH_PAGE_SIZE)
+            scanned.update(row[0] for row in page)
+            if len(page) < DISPATCH_PAGE_SIZE:
+                # Очередь просмотрена до конца: взятые заявки больше не нужно помнить
+                self._exhausted &= scanned
+            if not page:
+                break
+            after = (page[-1][2], page[-1][0])
+            page = [row for row in page if row[0] not in self._exhausted]
+            offered = database.get_offered_masters(row[0] for row in page)
+            for order_id, category_id, _ in page:
+                masters = self._masters_by_category.get(category_id, ())
+                already = offered.get(order_id, set())
+                if all(master_id in already for master_id in masters):
+                    # Предлагать больше некому, заявка остается в /admin
+                    self._exhausted.add(order_id)
+                    self._count('exhausted')
+                elif any(master_id in free and master_id not in already for master_id in masters):
+                    orders.append((order_id, category_id, already))
+        return orders[:self.batch_size]
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Ошибка авто-распределения заявок")
+            self._wakeup.wait(self.interval)
@@ -1,45 +1,68 @@
 import logging
+import os
+import signal
+import threading
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, CallbackContext
 from telegram.ext import Filters
-from datetime import datetime
+from telegram.utils.request import Request
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
 from config import BOT_TOKEN
-from database import init_db, save_order, get_new_orders, get_order_by_id, update_order_status, get_orders_stats, \
-    get_new_orders_by_category, get_orders_count_by_category, get_master_active_orders, assign_order_to_master, \
-    complete_order, get_completed_orders_with_master, get_master_earnings
-
-# Простые категории прямо в коде
-REPAIR_CATEGORIES = {
-    "plumbing": "Сантехника 🚿",
-    "electrical": "Электрика ⚡",
-    "appliances": "Бытовая техника 🌀",
-    "furniture": "Сборка мебели 🛋️",
-    "doors_windows": "Двери/Окна 🚪",
-    "other": "Прочее 🔧"
-}
-
-# Глобальный словарь для отслеживания состояния пользователей
-user_states = {}
+import app_logging
+import callbacks
+import metrics
+import sla
+from app_constants import REPAIR_CATEGORIES, CATEGORY_IDS, FINANCE_DAYS
+from archiver import OrderArchiver
+from auto_dispatch import AUTO_DISPATCH, AutoDispatcher
+from callbacks import CallbackRouter
+from coalescer import RenderCoalescer
+from db_executor import DB_BATCH_SIZE, DB_BATCH_WINDOW, DB_SYNCHRONOUS, DatabaseExecutor
+from notifier import Notifier, OutboxWorker
+from sla import SLA_ENABLED, SlaScheduler
+from webhook import ShardedUpdateQueue, start_webhook_server
+from state_store import ConversationStore, STATE_AWAITING_CATEGORY, STATE_AWAITING_DESCRIPTION, \
+    STATE_AWAITING_CONTACTS
+from models import OrderState
+from database import init_db, save_order, get_order_card, update_order_status, get_orders_stats, \
+    get_new_order_near, get_new_order_position, get_orders_summary, get_master_active_orders, claim_order, \
+    CLAIM_BUSY, CLAIM_LOST, complete_order, get_recent_completed_orders, get_finance_summary, get_finance_by_day, \
+    close_connections, category_label, search_orders, search_query, SEARCH_COUNT_LIMIT, cache_stats, \
+    answer_offer, OFFER_DECLINED, OFFER_EXPIRED, set_master_skills, get_master_categories, get_master_skills
+
+# Состояния диалогов пользователей (с вытеснением старых и сохранением в базу)
+conversations = ConversationStore()
 
 # Список ID администраторов/мастеров
 ADMIN_IDS = [5172832447]  # Замените на ваш Telegram ID
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Запросы к базе выполняются вне потоков диспетчера: чтение в пуле, запись в одном потоке.
+# Размер пачки записи и режим fsync задаются переменными окружения (см. db_executor.py)
+db = DatabaseExecutor(batch_size=DB_BATCH_SIZE, batch_window=DB_BATCH_WINDOW, synchronous=DB_SYNCHRONOUS)
+
+# Заявок на одной странице результатов /search
+SEARCH_PAGE_SIZE = 5
+
+# Фоновая рассылка уведомлений, доставка из outbox, авто-распределение и сроки заявок, создаются в main()
+notifier = None
+outbox_worker = None
+auto_dispatcher = None
+sla_scheduler = None
+
+# Журнал настраивается в main(): запись идет через очередь в фоновый поток (см. app_logging)
 logger = logging.getLogger(__name__)
 
 
+@metrics.timed("start")
 def start_command(update: Update, context: CallbackContext):
     """Команда /start для обычных пользователей"""
     user_id = update.effective_user.id
-    user_states[user_id] = 'awaiting_category'
+    conversations.set(user_id, STATE_AWAITING_CATEGORY)
 
     keyboard = []
     for category_key, category_name in REPAIR_CATEGORIES.items():
-        keyboard.append([InlineKeyboardButton(category_name, callback_data=f"category_{category_key}")])
+        keyboard.append([InlineKeyboardButton(category_name, callback_data=callbacks.encode(callbacks.PICK_CATEGORY, category=category_key))])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -51,6 +74,7 @@ def start_command(update: Update, context: CallbackContext):
     )
 
 
+@metrics.timed("admin")
 def admin_command(update: Update, context: CallbackContext):
     """Команда /admin только для мастеров"""
     user_id = update.effective_user.id
@@ -65,9 +89,12 @@ def admin_command(update: Update, context: CallbackContext):
 def show_admin_panel(update: Update, context: CallbackContext):
     """Показать панель управления для мастеров"""
     user_id = update.effective_user.id
-    stats = get_orders_stats()
+    # Оба запроса выполняются параллельно в пуле читателей
+    stats_future = db.read(get_orders_stats)
+    active_orders_future = db.read(get_master_active_orders, user_id)
+    stats = stats_future.result()
 
-    active_orders = get_master_active_orders(user_id)
+    active_orders = active_orders_future.result()
     has_active_order = len(active_orders) > 0
 
     admin_text = (
@@ -83,27 +110,28 @@ def show_admin_panel(update: Update, context: CallbackContext):
         order = active_orders[0]
         admin_text += (
             "📋 *Ваша текущая заявка:*\n"
-            f"• *Заявка #*: {order[0]}\n"
-            f"• *Категория:* {order[3]}\n"
-            f"• *Клиент:* {order[2]}\n"
-            f"• *Описание:* {order[4]}\n"
-            f"• *Контакты:* {order[5]}\n"
-            f"• *Принята:* {order[9]}\n\n"
+            f"• *Заявка #*: {order.id}\n"
+            f"• *Категория:* {category_label(order.category_id)}\n"
+            f"• *Клиент:* {order.username}\n"
+            f"• *Описание:* {order.description}\n"
+            f"• *Контакты:* {order.contacts}\n"
+            f"• *Принята:* {order.created_at}\n\n"
         )
 
     admin_text += "Выберите действие:"
 
     keyboard = [
-        [InlineKeyboardButton("📂 Просмотреть заявки", callback_data="admin_show_categories")],
+        [InlineKeyboardButton("📂 Просмотреть заявки", callback_data=callbacks.encode(callbacks.ADMIN_CATEGORIES))],
     ]
 
     if has_active_order:
         order_id = active_orders[0][0]
-        keyboard.append([InlineKeyboardButton("📋 Моя заявка в работе", callback_data=f"show_my_order_{order_id}")])
+        keyboard.append([InlineKeyboardButton("📋 Моя заявка в работе",
+                                              callback_data=callbacks.encode(callbacks.MY_ORDER, order_id))])
 
     keyboard.extend([
-        [InlineKeyboardButton("🔄 Обновить статистику", callback_data="admin_refresh")],
-        [InlineKeyboardButton("❌ Закрыть панель", callback_data="admin_close")]
+        [InlineKeyboardButton("🔄 Обновить статистику", callback_data=callbacks.encode(callbacks.ADMIN_REFRESH))],
+        [InlineKeyboardButton("❌ Закрыть панель", callback_data=callbacks.encode(callbacks.ADMIN_CLOSE))]
     ])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -119,20 +147,20 @@ def show_category_selection(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
 
-    category_counts = {}
-    for category_key in REPAIR_CATEGORIES.keys():
-        count = get_orders_count_by_category(category_key)
-        category_counts[category_key] = count
+    summary = db.read(get_orders_summary).result()
+    category_counts = summary['by_category']
 
     keyboard = []
     for category_key, category_name in REPAIR_CATEGORIES.items():
         count = category_counts[category_key]
         button_text = f"{category_name} ({count})"
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"admin_category_{category_key}")])
+        keyboard.append([InlineKeyboardButton(
+            button_text, callback_data=callbacks.encode(callbacks.SHOW_ORDERS, category=category_key))])
 
-    total_new = get_orders_stats()['new']
-    keyboard.append([InlineKeyboardButton(f"📋 Все заявки ({total_new})", callback_data="admin_all_orders")])
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="admin_back")])
+    total_new = summary['new']
+    keyboard.append([InlineKeyboardButton(f"📋 Все заявки ({total_new})",
+                                          callback_data=callbacks.encode(callbacks.SHOW_ORDERS))])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=callbacks.encode(callbacks.ADMIN_BACK))])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -142,46 +170,48 @@ def show_category_selection(update: Update, context: CallbackContext):
     )
 
 
-def show_single_order(update: Update, context: CallbackContext, category_key=None):
-    """Показать одну заявку с навигацией"""
+def show_single_order(update: Update, context: CallbackContext, category_key=None, order_id=None, step=0):
+    """Показать одну заявку с навигацией.
+
+    Из базы читается только показываемая заявка: соседняя ищется по (created_at, id)
+    относительно order_id, в user_data хранится только ID текущей заявки."""
     query = update.callback_query
     query.answer()
 
+    order_future = db.read(get_new_order_near, category_key, order_id, step)
+    summary = db.read(get_orders_summary).result()
+    order = order_future.result()
     if category_key == "all":
-        orders = get_new_orders()
+        total = summary['new']
         category_name = "Все заявки"
     else:
-        orders = get_new_orders_by_category(category_key)
+        total = summary['by_category'].get(category_key, 0)
         category_name = REPAIR_CATEGORIES.get(category_key, "Неизвестная категория")
 
-    if not orders:
+    if not order:
         query.edit_message_text(
             f"📭 Нет новых заявок в категории '{category_name}'\n\n"
             "Новых заявок пока нет. Проверьте позже.",
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 К выбору категорий", callback_data="admin_show_categories")]
+                [InlineKeyboardButton("🔙 К выбору категорий",
+                                      callback_data=callbacks.encode(callbacks.ADMIN_CATEGORIES))]
             ])
         )
         return
 
-    current_index = context.user_data.get('current_order_index', 0)
+    position = db.read(get_new_order_position, order, category_key).result()
+    total = max(total, position)
 
-    if current_index >= len(orders):
-        current_index = 0
-    if current_index < 0:
-        current_index = len(orders) - 1
-
-    order = orders[current_index]
-    order_id = order[0]
-    username = order[2]
-    order_category = order[3]
-    description = order[4]
-    contacts = order[5]
-    created_at = order[9]
+    order_id = order.id
+    username = order.username
+    order_category = category_label(order.category_id)
+    description = order.description
+    contacts = order.contacts
+    created_at = order.created_at
 
     order_text = (
         f"🎯 *Заявка #{order_id}* ({category_name})\n"
-        f"*{current_index + 1} из {len(orders)}*\n\n"
+        f"*{position} из {total}*\n\n"
         f"• *Категория:* {order_category}\n"
         f"• *Пользователь:* {username}\n"
         f"• *Описание:* {description}\n"
@@ -191,18 +221,20 @@ def show_single_order(update: Update, context: CallbackContext, category_key=Non
     )
 
     keyboard = []
-    keyboard.append([InlineKeyboardButton("✅ Взять в работу", callback_data=f"take_{order_id}")])
+    keyboard.append([InlineKeyboardButton("✅ Взять в работу",
+                                          callback_data=callbacks.encode(callbacks.TAKE_ORDER, order_id))])
 
-    if len(orders) > 1:
+    if total > 1:
         nav_buttons = []
-        nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"prev_{order_id}_{category_key}"))
-        nav_buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"next_{order_id}_{category_key}"))
+        nav_buttons.append(InlineKeyboardButton(
+            "⬅️ Назад", callback_data=callbacks.encode(callbacks.PREV_ORDER, order_id, category_key)))
+        nav_buttons.append(InlineKeyboardButton(
+            "Вперед ➡️", callback_data=callbacks.encode(callbacks.NEXT_ORDER, order_id, category_key)))
         keyboard.append(nav_buttons)
 
-    keyboard.append([InlineKeyboardButton("🔙 К категориям", callback_data="admin_show_categories")])
+    keyboard.append([InlineKeyboardButton("🔙 К категориям", callback_data=callbacks.encode(callbacks.ADMIN_CATEGORIES))])
 
-    context.user_data['current_order_index'] = current_index
-    context.user_data['current_orders'] = orders
+    context.user_data['current_order_id'] = order_id
     context.user_data['current_category'] = category_key
 
     query.edit_message_text(
@@ -212,103 +244,103 @@ def show_single_order(update: Update, context: CallbackContext, category_key=Non
     )
 
 
-def handle_admin_actions(update: Update, context: CallbackContext):
-    """Обработка действий в панели администратора"""
+def handle_admin_refresh(update: Update, context: CallbackContext, callback):
+    """Обновить статистику в панели мастера"""
+    update.callback_query.answer("Статистика обновлена! ✅")
+    show_admin_panel(update, context)
+
+
+def handle_admin_back(update: Update, context: CallbackContext, callback):
+    """Вернуться в панель мастера"""
+    update.callback_query.answer()
+    show_admin_panel(update, context)
+
+
+def handle_admin_close(update: Update, context: CallbackContext, callback):
+    """Закрыть панель мастера"""
     query = update.callback_query
     query.answer()
+    query.edit_message_text("Панель управления закрыта")
+
 
-    data = query.data
+def handle_take_order(update: Update, context: CallbackContext, callback):
+    """Взять заявку в работу"""
+    query = update.callback_query
     master_id = update.effective_user.id
     master_name = update.effective_user.first_name
-
-    print(f"Обрабатываем callback: {data}")  # Debug
-
-    if data == "admin_show_categories":
-        return show_category_selection(update, context)
-
-    elif data == "admin_refresh":
-        query.answer("Статистика обновлена! ✅")
+    order_id = callback.order_id
+
+    result = db.write(claim_order, order_id, master_id, master_name).result()
+    if result == CLAIM_BUSY:
+        query.answer(
+            "⛔ У вас уже есть активная заявка!\n"
+            "Завершите текущую заявку прежде чем брать новую.",
+            show_alert=True
+        )
+        return
+    if result == CLAIM_LOST:
+        query.answer("⛔ Эту заявку уже взял другой мастер.", show_alert=True)
         return
 
-    elif data == "admin_back":
-        return show_admin_panel(update, context)
+    _track_assigned(order_id)
+    query.answer()
+    current_category = context.user_data.get('current_category', 'all')
 
-    elif data == "admin_close":
-        query.edit_message_text("Панель управления закрыта")
-        return
+    query.edit_message_text(
+        f"✅ Заявка #{order_id} взята в работу!\n\n"
+        f"Мастер: {master_name}\n"
+        "Свяжитесь с клиентом в ближайшее время.\n\n"
+        "Когда завершите заявку, используйте команду /complete",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔙 К заявкам",
+                                  callback_data=callbacks.encode(callbacks.SHOW_ORDERS, category=current_category))]
+        ])
+    )
 
-    elif data == "admin_all_orders":
-        context.user_data['current_order_index'] = 0
-        return show_single_order(update, context, "all")
-
-    elif data.startswith("admin_category_"):
-        category_key = data.split("_")[2]
-        context.user_data['current_order_index'] = 0
-        return show_single_order(update, context, category_key)
-
-    elif data.startswith("take_"):
-        active_orders = get_master_active_orders(master_id)
-        if active_orders:
-            query.answer(
-                "⛔ У вас уже есть активная заявка!\n"
-                "Завершите текущую заявку прежде чем брать новую.",
-                show_alert=True
-            )
-            return
-
-        order_id = data.split("_")[1]
-        assign_order_to_master(order_id, master_id, master_name)
-        current_category = context.user_data.get('current_category', 'all')
 
-        query.edit_message_text(
-            f"✅ Заявка #{order_id} взята в работу!\n\n"
-            f"Мастер: {master_name}\n"
-            "Свяжитесь с клиентом в ближайшее время.\n\n"
-            "Когда завершите заявку, используйте команду /complete",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 К заявкам", callback_data=f"admin_back_to_{current_category}")]
-            ])
-        )
+def handle_offer_answer(update: Update, context: CallbackContext, callback):
+    """Ответ мастера на заявку, предложенную авто-распределением"""
+    query = update.callback_query
+    master_id = update.effective_user.id
+    master_name = update.effective_user.first_name
+    order_id = callback.order_id
+    accept = callback.action == callbacks.OFFER_ACCEPT
+
+    result = db.write(answer_offer, order_id, master_id, master_name, accept).result()
+    if result in (OFFER_DECLINED, CLAIM_BUSY) and auto_dispatcher:
+        # Заявка свободна для следующего мастера
+        auto_dispatcher.wake()
+    if result == OFFER_EXPIRED:
+        query.answer("⌛ Предложение уже неактуально.", show_alert=True)
+        query.edit_message_text(f"⌛ Предложение заявки #{order_id} истекло. Свободные заявки - в /admin")
         return
-
-    elif data.startswith("admin_back_to_"):
-        category_key = data.split("_")[3]
-        context.user_data['current_order_index'] = 0
-        return show_single_order(update, context, category_key)
-
-    elif data.startswith("show_my_order_"):
-        order_id = data.split("_")[3]
-        return show_my_active_order(update, context, order_id)
-
-    elif data.startswith("next_"):
-        parts = data.split("_")
-        if len(parts) >= 3:
-            category_key = parts[2]
-            current_index = context.user_data.get('current_order_index', 0)
-            context.user_data['current_order_index'] = current_index + 1
-            return show_single_order(update, context, category_key)
-
-    elif data.startswith("prev_"):
-        parts = data.split("_")
-        if len(parts) >= 3:
-            category_key = parts[2]
-            current_index = context.user_data.get('current_order_index', 0)
-            context.user_data['current_order_index'] = current_index - 1
-            return show_single_order(update, context, category_key)
-
-    elif data.startswith("complete_"):
-        order_id = data.split("_")[1]
-        complete_order(order_id)
-        query.edit_message_text(
-            f"✅ Заявка #{order_id} завершена!\n\n"
-            "Теперь вы можете брать новые заявки через /admin"
-        )
+    if result == OFFER_DECLINED:
+        query.answer()
+        query.edit_message_text(f"Вы отказались от заявки #{order_id}.")
+        return
+    if result == CLAIM_BUSY:
+        query.answer("⛔ У вас уже есть активная заявка!", show_alert=True)
+        query.edit_message_text(f"Заявка #{order_id} предложена другому мастеру: у вас уже есть заявка в работе.")
+        return
+    if result == CLAIM_LOST:
+        query.answer("⛔ Эту заявку уже взял другой мастер.", show_alert=True)
+        query.edit_message_text(f"Заявку #{order_id} уже взял другой мастер.")
         return
 
-    # Если действие не распознано
-    query.answer("Неизвестное действие")
+    _track_assigned(order_id)
+    query.answer()
+    query.edit_message_text(
+        f"✅ Заявка #{order_id} взята в работу!\n\n"
+        f"Мастер: {master_name}\n"
+        "Свяжитесь с клиентом в ближайшее время.\n\n"
+        "Когда завершите заявку, используйте команду /complete",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("📋 Моя заявка в работе", callback_data=callbacks.encode(callbacks.MY_ORDER, order_id))]
+        ])
+    )
 
 
+@metrics.timed("complete")
 def complete_command(update: Update, context: CallbackContext):
     """Команда для завершения заявки"""
     user_id = update.effective_user.id
@@ -317,7 +349,7 @@ def complete_command(update: Update, context: CallbackContext):
         update.message.reply_text("⛔ Доступ запрещен.")
         return
 
-    active_orders = get_master_active_orders(user_id)
+    active_orders = db.read(get_master_active_orders, user_id).result()
 
     if not active_orders:
         update.message.reply_text(
@@ -328,10 +360,11 @@ def complete_command(update: Update, context: CallbackContext):
 
     keyboard = []
     for order in active_orders:
-        order_id = order[0]
-        category = order[3]
+        order_id = order.id
+        category = category_label(order.category_id)
         keyboard.append(
-            [InlineKeyboardButton(f"Заявка #{order_id} - {category}", callback_data=f"complete_{order_id}")])
+            [InlineKeyboardButton(f"Заявка #{order_id} - {category}",
+                                  callback_data=callbacks.encode(callbacks.COMPLETE_ORDER, order_id))])
 
     update.message.reply_text(
         "Выберите заявку для завершения:",
@@ -339,57 +372,52 @@ def complete_command(update: Update, context: CallbackContext):
     )
 
 
-def handle_complete_actions(update: Update, context: CallbackContext):
+def handle_complete_actions(update: Update, context: CallbackContext, callback):
     """Обработка завершения заявок"""
     query = update.callback_query
     query.answer()
 
-    data = query.data
-
-    if data.startswith("complete_"):
-        order_id = data.split("_")[1]
-        complete_order(order_id)
-        query.edit_message_text(
-            f"✅ Заявка #{order_id} завершена!\n\n"
-            "Теперь вы можете брать новые заявки через /admin"
-        )
+    order_id = callback.order_id
+    db.write(complete_order, order_id).result()
+    if sla_scheduler:
+        sla_scheduler.order_closed(order_id)
+    query.edit_message_text(
+        f"✅ Заявка #{order_id} завершена!\n\n"
+        "Теперь вы можете брать новые заявки через /admin"
+    )
 
 
-def handle_category_selection(update: Update, context: CallbackContext):
+def handle_category_selection(update: Update, context: CallbackContext, callback):
     """Обработка выбора категории пользователем"""
     query = update.callback_query
     query.answer()
 
     user_id = update.effective_user.id
+    category_key = callback.category
 
-    if query.data.startswith("category_"):
-        category_key = query.data[9:]
+    if category_key in REPAIR_CATEGORIES:
+        category_name = REPAIR_CATEGORIES[category_key]
+        conversations.set(user_id, STATE_AWAITING_DESCRIPTION, category=category_key)
 
-        if category_key in REPAIR_CATEGORIES:
-            category_name = REPAIR_CATEGORIES[category_key]
-            context.user_data['category'] = category_key
-            context.user_data['category_name'] = category_name
-            user_states[user_id] = 'awaiting_description'
-
-            query.edit_message_text(
-                text=f"Вы выбрали: {category_name}\n\n"
-                     "Теперь подробно опишите, что случилось:"
-            )
+        query.edit_message_text(
+            text=f"Вы выбрали: {category_name}\n\n"
+                 "Теперь подробно опишите, что случилось:"
+        )
 
-        else:
-            query.edit_message_text("Категория не найдена. Нажмите /start")
-            user_states[user_id] = 'main'
+    else:
+        query.edit_message_text("Категория не найдена. Нажмите /start")
+        conversations.reset(user_id)
 
 
+@metrics.timed("text")
 def handle_text_messages(update: Update, context: CallbackContext):
     """Обработчик текстовых сообщений"""
     user_id = update.effective_user.id
-    current_state = user_states.get(user_id, 'main')
+    conversation = conversations.get(user_id)
     user_text = update.message.text
 
-    if current_state == 'awaiting_description':
-        context.user_data['description'] = user_text
-        user_states[user_id] = 'awaiting_contacts'
+    if conversation and conversation.state == STATE_AWAITING_DESCRIPTION:
+        conversations.set(user_id, STATE_AWAITING_CONTACTS, description=user_text)
 
         update.message.reply_text(
             "Спасибо за описание! 📝\n\n"
@@ -401,21 +429,24 @@ def handle_text_messages(update: Update, context: CallbackContext):
             "ул. Ленина, д. 10, кв. 25"
         )
 
-    elif current_state == 'awaiting_contacts':
-        context.user_data['contacts'] = user_text
-        category = context.user_data.get('category_name', 'Не указана')
-        description = context.user_data.get('description', 'Не указано')
+    elif conversation and conversation.state == STATE_AWAITING_CONTACTS:
+        category_id = CATEGORY_IDS.get(conversation.category)
+        category = category_label(category_id)
+        description = conversation.description or 'Не указано'
         username = update.effective_user.username or update.effective_user.first_name
 
-        # СОХРАНЯЕМ ЗАЯВКУ В БАЗУ ДАННЫХ
-        order_id = save_order(user_id, username, category, description, user_text)
-        print(f"✅ Заявка #{order_id} сохранена")
+        # СОХРАНЯЕМ ЗАЯВКУ В БАЗУ ДАННЫХ вместе с уведомлениями мастерам
+        # (не отправляем уведомление самому себе, если бот тоже в списке)
+        master_ids = [master_id for master_id in ADMIN_IDS if master_id != context.bot.id]
+        order_id = db.write(save_order, user_id, username, category_id, description, user_text,
+                            notify_chat_ids=master_ids).result()
 
         # ⭐⭐⭐ ОТПРАВЛЯЕМ УВЕДОМЛЕНИЯ МАСТЕРАМ ⭐⭐⭐
-        try:
-            notify_masters_new_order(context, order_id, category, description)
-        except Exception as e:
-            print(f"⚠️ Ошибка при отправке уведомлений: {e}")
+        outbox_worker.wake()
+        if auto_dispatcher:
+            auto_dispatcher.wake()
+        if sla_scheduler:
+            sla_scheduler.order_created(order_id, category_id)
 
         # Формируем сообщение для пользователя
         order_text = (
@@ -428,56 +459,86 @@ def handle_text_messages(update: Update, context: CallbackContext):
         )
 
         update.message.reply_text(order_text, parse_mode='Markdown')
-        user_states[user_id] = 'main'
+        conversations.reset(user_id)
 
         # Логируем создание заявки
-        print(f"\n🎉 НОВАЯ ЗАЯВКА #{order_id}")
-        print(f"👤 Пользователь: {username} (ID: {user_id})")
-        print(f"📦 Категория: {category}")
-        print(f"📝 Описание: {description}")
-        print(f"📞 Контакты: {user_text}")
-        print("📨 Уведомления отправлены мастерам")
-        print("=" * 50)
+        logger.info("Новая заявка #%s от %s: %s", order_id, username, category,
+                    extra={'order_id': order_id, 'user_id': user_id, 'handler': 'text'})
 
     else:
         update.message.reply_text("Нажмите /start чтобы создать новую заявку")
 
 
-def notify_masters_new_order(context, order_id, category, description):
-    """Уведомление мастеров о новой заявке"""
-    try:
-        # Обрезаем длинное описание
-        short_description = description[:100] + "..." if len(description) > 100 else description
+def new_order_notification_text(order):
+    """Текст уведомления мастерам о новой заявке"""
+    order_id, category, description = order.id, category_label(order.category_id), order.description
+    # Обрезаем длинное описание
+    short_description = description[:100] + "..." if len(description) > 100 else description
 
-        message = (
-            "🎯 *НОВАЯ ЗАЯВКА!*\n\n"
-            f"*Заявка #*: {order_id}\n"
-            f"*Категория:* {category}\n"
-            f"*Описание:* {short_description}\n\n"
-            "➡️ Используйте /admin чтобы взять заявку в работу"
-        )
+    return (
+        "🎯 *НОВАЯ ЗАЯВКА!*\n\n"
+        f"*Заявка #*: {order_id}\n"
+        f"*Категория:* {category}\n"
+        f"*Описание:* {short_description}\n\n"
+        "➡️ Используйте /admin чтобы взять заявку в работу"
+    )
 
-        print(f"📨 Отправляем уведомления о заявке #{order_id}")
-
-        # Отправляем всем мастерам кроме самого себя (если он тоже мастер)
-        for master_id in ADMIN_IDS:
-            try:
-                # Не отправляем уведомление самому себе
-                if master_id != context.bot.id:
-                    context.bot.send_message(
-                        chat_id=master_id,
-                        text=message,
-                        parse_mode='Markdown'
-                    )
-                    print(f"✅ Уведомление отправлено мастеру {master_id}")
-                else:
-                    print(f"⏩ Пропускаем отправку самому себе ({master_id})")
-
-            except Exception as e:
-                print(f"❌ Ошибка отправки мастеру {master_id}: {e}")
 
-    except Exception as e:
-        print(f"❌ Критическая ошибка в уведомлениях: {e}")
+def offer_message(order, timeout):
+    """Текст и кнопки предложения заявки мастеру (см. auto_dispatch.py)"""
+    description = order.description
+    short_description = description[:200] + "..." if len(description) > 200 else description
+    text = (
+        "🤖 *Вам предложена заявка!*\n\n"
+        f"*Заявка #*: {order.id}\n"
+        f"*Категория:* {category_label(order.category_id)}\n"
+        f"*Описание:* {short_description}\n\n"
+        f"Ответьте в течение {int(timeout)} с, потом заявка уйдет другому мастеру."
+    )
+    reply_markup = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Принять", callback_data=callbacks.encode(callbacks.OFFER_ACCEPT, order.id)),
+        InlineKeyboardButton("❌ Отказаться", callback_data=callbacks.encode(callbacks.OFFER_DECLINE, order.id)),
+    ]])
+    return text, reply_markup
+
+
+def _track_assigned(order_id):
+    """Поставить срок заявки, которую мастер только что взял в работу (см. sla.py)"""
+    if sla_scheduler:
+        order = db.read(get_order_card, order_id).result()
+        if order:
+            sla_scheduler.order_assigned(order_id, order.category_id)
+
+
+def sla_masters():
+    """Кому отправлять новые заявки, которые долго ждут: всем мастерам"""
+    return set(ADMIN_IDS) | {master_id for master_id, _, _ in get_master_skills()}
+
+
+def sla_message(event, order, waited):
+    """Текст и кнопки напоминаний о сроках заявки (см. sla.py); waited - сколько минут заявка ждет"""
+    hours, minutes = divmod(waited, 60)
+    waited_text = f"{hours} ч {minutes} мин" if hours else f"{minutes} мин"
+    if event == sla.CUSTOMER:
+        return (f"⏳ Ваша заявка #{order.id} пока ждет мастера. Мы напомнили о ней всем мастерам, "
+                "с вами свяжутся, как только ее возьмут в работу."), None
+    if event == sla.REMIND:
+        text = (f"⏰ Заявка #{order.id} в работе уже {waited_text}.\n\n"
+                "Если работа выполнена, завершите заявку - клиент ждет.")
+        return text, InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Завершить", callback_data=callbacks.encode(callbacks.COMPLETE_ORDER, order.id))]])
+
+    card = get_order_card(order.id)
+    description = card.description if card else ''
+    short_description = description[:100] + "..." if len(description) > 100 else description
+    text = (
+        f"⏰ *Заявка ждет мастера уже {waited_text}!*\n\n"
+        f"*Заявка #*: {order.id}\n"
+        f"*Категория:* {category_label(order.category_id)}\n"
+        f"*Описание:* {short_description}"
+    )
+    return text, InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ Взять заявку", callback_data=callbacks.encode(callbacks.TAKE_ORDER, order.id))]])
 
 
 def show_my_active_order(update: Update, context: CallbackContext, order_id):
@@ -485,41 +546,29 @@ def show_my_active_order(update: Update, context: CallbackContext, order_id):
     query = update.callback_query
     query.answer()
 
-    order = get_order_by_id(order_id)
+    order = db.read(get_order_card, order_id).result()
     if not order:
         query.edit_message_text("❌ Заявка не найдена.")
         return
 
-    # Безопасное извлечение данных
-    order_data = {
-        'id': order[0],
-        'user_id': order[1],
-        'username': order[2],
-        'category': order[3],
-        'description': order[4],
-        'contacts': order[5],
-        'status': order[6],
-        'master_id': order[7],
-        'master_name': order[8],
-        'created_at': order[9]
-    }
-
+    category = category_label(order.category_id)
     # Убираем Markdown разметку для простоты
     order_text = (
         "📋 Ваша активная заявка\n\n"
-        f"• Заявка #: {order_data['id']}\n"
-        f"• Категория: {order_data['category']}\n"
-        f"• Клиент: @{order_data['username'] if order_data['username'] else 'без username'}\n"
-        f"• Описание: {order_data['description']}\n"
-        f"• Контакты: {order_data['contacts']}\n"
-        f"• Принята: {order_data['created_at']}\n"
-        f"• Статус: {order_data['status']}\n\n"
+        f"• Заявка #: {order.id}\n"
+        f"• Категория: {category}\n"
+        f"• Клиент: @{order.username if order.username else 'без username'}\n"
+        f"• Описание: {order.description}\n"
+        f"• Контакты: {order.contacts}\n"
+        f"• Принята: {order.created_at}\n"
+        f"• Статус: {OrderState(order.status).label}\n\n"
         "Выберите действие:"
     )
 
     keyboard = [
-        [InlineKeyboardButton("✅ Завершить заявку", callback_data=f"complete_{order_data['id']}")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="admin_back")]
+        [InlineKeyboardButton("✅ Завершить заявку",
+                              callback_data=callbacks.encode(callbacks.COMPLETE_ORDER, order.id))],
+        [InlineKeyboardButton("🔙 Назад", callback_data=callbacks.encode(callbacks.ADMIN_BACK))]
     ]
 
     try:
@@ -529,15 +578,18 @@ def show_my_active_order(update: Update, context: CallbackContext, order_id):
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     except Exception as e:
-        print(f"Ошибка при редактировании сообщения: {e}")
+        logger.warning("Ошибка при редактировании сообщения: %s", e,
+                       extra={'order_id': order.id, 'user_id': update.effective_user.id,
+                              'handler': 'my_order'})
         # Пробуем без разметки вообще
-        simple_text = f"Заявка #{order_data['id']} - {order_data['category']}\nКлиент: {order_data['contacts']}"
+        simple_text = f"Заявка #{order.id} - {category}\nКлиент: {order.contacts}"
         query.edit_message_text(
             simple_text,
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
 
+@metrics.timed("finance")
 def finance_command(update: Update, context: CallbackContext):
     """Команда для финансовой отчетности"""
     user_id = update.effective_user.id
@@ -546,8 +598,14 @@ def finance_command(update: Update, context: CallbackContext):
         update.message.reply_text("⛔ Доступ запрещен.")
         return
 
-    completed_orders = get_completed_orders_with_master()
-    total_orders = len(completed_orders)
+    # Итоги берутся из сводной таблицы, а не из всей истории заказов
+    finance_future = db.read(get_finance_summary)
+    recent_future = db.read(get_recent_completed_orders, 5)
+    # Дни в сводках - даты UTC, как date('now') в SQLite
+    since_day = (datetime.now(timezone.utc).date() - timedelta(days=FINANCE_DAYS - 1)).isoformat()
+    by_day_future = db.read(get_finance_by_day, since_day)
+    finance = finance_future.result()
+    total_orders = finance['total']
     your_earnings = total_orders * 500  # 500 руб. с заказа
 
     finance_text = (
@@ -559,19 +617,23 @@ def finance_command(update: Update, context: CallbackContext):
     if total_orders > 0:
         finance_text += "📊 *Последние заказы:*\n\n"
 
-        for order in completed_orders[:5]:
-            order_id, master_id, master_name, category, created_at = order
-            finance_text += f"• Заявка #{order_id} - {category}\n"
-            finance_text += f"  Мастер: {master_name}\n"
-            finance_text += f"  Завершена: {created_at}\n\n"
-
-        masters_stats = {}
-        for order in completed_orders:
-            master_id = order[1]
-            masters_stats[master_id] = masters_stats.get(master_id, 0) + 1
+        for order in recent_future.result():
+            finance_text += f"• Заявка #{order.id} - {category_label(order.category_id)}\n"
+            finance_text += f"  Мастер: {order.master_name}\n"
+            finance_text += f"  Завершена: {order.completed_at}\n\n"
+
+        by_day = {}
+        for day, category_id, completed in by_day_future.result():
+            if completed:
+                by_day.setdefault(day, []).append(f"{category_label(category_id)} {completed}")
+        if by_day:
+            finance_text += f"📅 *За {FINANCE_DAYS} дн. по категориям:*\n"
+            for day, categories in by_day.items():
+                finance_text += f"• {day}: {', '.join(categories)}\n"
+            finance_text += "\n"
 
         finance_text += "👨‍🔧 *По мастерам:*\n"
-        for master_id, orders_count in masters_stats.items():
+        for master_id, master_name, orders_count in finance['by_master']:
             finance_text += f"• Мастер {master_id}: {orders_count} зак.\n"
     else:
         finance_text += "📭 Пока нет выполненных заказов"
@@ -579,13 +641,15 @@ def finance_command(update: Update, context: CallbackContext):
     update.message.reply_text(finance_text, parse_mode='Markdown')
 
 
+@metrics.timed("status")
 def status_command(update: Update, context: CallbackContext):
     """Проверка статуса бота"""
     user_id = update.effective_user.id
     if user_id not in ADMIN_IDS:
         return
 
-    stats = get_orders_stats()
+    stats = db.read(get_orders_stats).result()
+    db_stats = db.stats()
     status_text = (
         "🤖 *Статус бота*\n\n"
         f"• Запущен: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
@@ -594,43 +658,325 @@ def status_command(update: Update, context: CallbackContext):
         f"• В работе: {stats['in_progress']}\n"
         f"• Завершено: {stats['completed']}\n"
         f"• Мастеров: {len(ADMIN_IDS) - 1}\n"
-        "• Статус: ✅ Работает"
+        f"• Очередь БД: чтение {db_stats['read']['queue_depth']}, запись {db_stats['write']['queue_depth']}\n"
+        f"• Ожидание БД: чтение {db_stats['read']['avg_wait'] * 1000:.1f} мс, "
+        f"запись {db_stats['write']['avg_wait'] * 1000:.1f} мс\n"
     )
+    if sla_scheduler:
+        sla_stats = sla_scheduler.stats()
+        status_text += (f"• Просрочено: ждут мастера {sla_stats['overdue_new']}, "
+                        f"долго в работе {sla_stats['overdue_in_progress']}\n")
+    status_text += "• Статус: ✅ Работает"
     update.message.reply_text(status_text, parse_mode='Markdown')
 
 
+@metrics.timed("metrics")
+def metrics_command(update: Update, context: CallbackContext):
+    """Метрики производительности для мастеров"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        update.message.reply_text("⛔ Доступ запрещен.")
+        return
+
+    db_stats = db.stats()
+    notifier_stats = notifier.stats() if notifier else {}
+    outbox_stats = outbox_worker.stats() if outbox_worker else {}
+    order_cache_stats = cache_stats()
+    text = (
+        "📈 Метрики\n\n"
+        f"{metrics.render_text()}\n\n"
+        f"🗃 Очередь БД: чтение {db_stats['read']['queue_depth']}, запись {db_stats['write']['queue_depth']}, "
+        f"средняя пачка записи {db_stats['write']['avg_batch']:.1f}\n"
+        f"📨 Уведомления: отправлено {notifier_stats.get('sent', 0)}, ошибок {notifier_stats.get('failed', 0)}, "
+        f"в очереди {notifier_stats.get('queue_depth', 0)}, outbox {outbox_stats.get('sent_per_sec', 0):.1f}/с\n"
+        f"🧠 Кэш заявок: {_cache_line(order_cache_stats['orders'])}, активных заявок мастеров: "
+        f"{_cache_line(order_cache_stats['active'])}"
+    )
+    render_stats = renders.stats()
+    text += (f"\n🖱 Кнопки: нажатий {render_stats['callbacks']}, слито {render_stats['coalesced']}, "
+             f"правок {render_stats['edits']}, без изменений {render_stats['edits_skipped']}, "
+             f"лишних ответов {render_stats['answers_skipped']}; сэкономлено вызовов API "
+             f"{render_stats['api_calls_saved']}")
+    if sla_scheduler:
+        sla_stats = sla_scheduler.stats()
+        text += (f"\n⏰ Сроки: отслеживается {sla_stats['tracked']}, напоминаний мастерам о новых "
+                 f"{sla_stats['escalated']}, клиентам {sla_stats['customers']}, о заявках в работе "
+                 f"{sla_stats['reminded']}")
+    if auto_dispatcher:
+        dispatch_stats = auto_dispatcher.stats()
+        text += (f"\n🤖 Авто-распределение: предложено {dispatch_stats['offered']}, "
+                 f"просрочено {dispatch_stats['expired']}, некому предложить {dispatch_stats['exhausted']}")
+    # Без Markdown: в тексте запросов встречаются * и _
+    update.message.reply_text(text[:4000])
+
+
+@metrics.timed("skills")
+def skills_command(update: Update, context: CallbackContext):
+    """Категории, заявки которых бот предлагает мастеру сам: /skills plumbing electrical, /skills all, /skills off"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        update.message.reply_text("⛔ Доступ запрещен.")
+        return
+
+    args = [arg.lower() for arg in context.args or []]
+    if args:
+        if args == ['off']:
+            category_ids = []
+        elif args == ['all']:
+            category_ids = list(CATEGORY_IDS.values())
+        else:
+            unknown = [arg for arg in args if arg not in CATEGORY_IDS]
+            if unknown:
+                update.message.reply_text(f"Неизвестные категории: {', '.join(unknown)}\n\n{_skills_help()}")
+                return
+            category_ids = [CATEGORY_IDS[arg] for arg in args]
+        db.write(set_master_skills, user_id, update.effective_user.first_name, category_ids).result()
+        if auto_dispatcher:
+            auto_dispatcher.wake()
+
+    current = db.read(get_master_categories, user_id).result()
+    if current:
+        status = "Бот предлагает вам заявки категорий:\n" + "\n".join(f"• {category_label(c)}" for c in current)
+    else:
+        status = "Бот не предлагает вам заявки, вы берете их сами через /admin."
+    if not AUTO_DISPATCH:
+        status += "\n\n⚠️ Авто-распределение выключено (AUTO_DISPATCH)."
+    update.message.reply_text(f"🤖 {status}\n\n{_skills_help()}")
+
+
+def _skills_help():
+    categories = "\n".join(f"• {key} - {label}" for key, label in REPAIR_CATEGORIES.items())
+    return ("Выбрать категории: /skills plumbing electrical\n"
+            "Все категории: /skills all, не предлагать заявки: /skills off\n\n"
+            f"Категории:\n{categories}")
+
+
+def _cache_line(stats):
+    lookups = stats['hits'] + stats['misses']
+    ratio = stats['hits'] / lookups * 100 if lookups else 0
+    return f"{stats['hits']}/{lookups} попаданий ({ratio:.0f}%)"
+
+
+@metrics.timed("search")
+def search_command(update: Update, context: CallbackContext):
+    """Поиск заявок по описанию, контактам и имени клиента: /search бойлер ленина"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        update.message.reply_text("⛔ Доступ запрещен.")
+        return
+
+    text = " ".join(context.args or [])
+    if not search_query(text):
+        update.message.reply_text(
+            "🔎 Укажите слова для поиска, например:\n"
+            "/search бойлер\n"
+            "/search ленина 10\n"
+            "/search 900 123\n\n"
+            "Ищется по описанию, контактам и имени клиента, слова можно писать не полностью."
+        )
+        return
+
+    # В callback_data запрос не помещается, кнопки страниц несут только номер страницы
+    context.user_data['search_query'] = text
+    page_text, keyboard = render_search_page(text, 0)
+    update.message.reply_text(page_text, reply_markup=keyboard)
+
+
+def show_search_page(update: Update, context: CallbackContext, callback):
+    """Страница результатов поиска (кнопки ⬅️/➡️ под результатами /search)"""
+    query = update.callback_query
+    query.answer()
+    text = context.user_data.get('search_query')
+    if update.effective_user.id not in ADMIN_IDS or not text:
+        query.edit_message_text("🔎 Результаты поиска устарели, повторите /search")
+        return
+    page_text, keyboard = render_search_page(text, callback.cursor)
+    query.edit_message_text(page_text, reply_markup=keyboard)
+
+
+def render_search_page(text, page):
+    """Текст и кнопки страницы page (с 0) результатов поиска"""
+    orders, total = db.read(search_orders, text, SEARCH_PAGE_SIZE, page * SEARCH_PAGE_SIZE).result()
+    if not total:
+        return f"🔎 По запросу «{text}» ничего не найдено", None
+
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    found = f"{total}+" if total >= SEARCH_COUNT_LIMIT else total
+    lines = [f"🔎 «{text}»: найдено {found}, страница {page + 1} из {pages}\n"]
+    for order in orders:
+        description = order.description[:100] + "..." if len(order.description) > 100 else order.description
+        lines.append(
+            f"#{order.id} • {category_label(order.category_id)} • {OrderState(order.status).label}\n"
+            f"{description}\n"
+            f"Клиент: {order.username or 'без username'}, {order.contacts}\n"
+            f"Создана: {order.created_at}\n"
+        )
+
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(
+            "⬅️ Назад", callback_data=callbacks.encode(callbacks.SEARCH_PAGE, cursor=page - 1)))
+    if page + 1 < pages:
+        navigation.append(InlineKeyboardButton(
+            "Вперед ➡️", callback_data=callbacks.encode(callbacks.SEARCH_PAGE, cursor=page + 1)))
+    # Без Markdown: в описаниях и контактах клиентов встречаются * и _
+    return "\n".join(lines), InlineKeyboardMarkup([navigation]) if navigation else None
+
+
+# Таблица обработчиков кнопок: код действия -> handler(update, context, callback)
+CALLBACK_HANDLERS = {
+    callbacks.PICK_CATEGORY: handle_category_selection,
+    callbacks.ADMIN_CATEGORIES: lambda update, context, callback: show_category_selection(update, context),
+    callbacks.ADMIN_REFRESH: handle_admin_refresh,
+    callbacks.ADMIN_BACK: handle_admin_back,
+    callbacks.ADMIN_CLOSE: handle_admin_close,
+    callbacks.SHOW_ORDERS: lambda update, context, callback: show_single_order(update, context, callback.category),
+    callbacks.NEXT_ORDER: lambda update, context, callback: show_single_order(
+        update, context, callback.category, callback.order_id, 1),
+    callbacks.PREV_ORDER: lambda update, context, callback: show_single_order(
+        update, context, callback.category, callback.order_id, -1),
+    callbacks.TAKE_ORDER: handle_take_order,
+    callbacks.MY_ORDER: lambda update, context, callback: show_my_active_order(update, context, callback.order_id),
+    callbacks.COMPLETE_ORDER: handle_complete_actions,
+    callbacks.SEARCH_PAGE: show_search_page,
+    callbacks.OFFER_ACCEPT: handle_offer_answer,
+    callbacks.OFFER_DECLINE: handle_offer_answer,
+}
+# Нажатия, которые только перерисовывают сообщение: их можно сливать и отбрасывать повторы
+RERENDER_ACTIONS = (callbacks.ADMIN_CATEGORIES, callbacks.ADMIN_REFRESH, callbacks.ADMIN_BACK, callbacks.SHOW_ORDERS,
+                    callbacks.NEXT_ORDER, callbacks.PREV_ORDER, callbacks.SEARCH_PAGE)
+renders = RenderCoalescer()
+callback_router = CallbackRouter({
+    action: metrics.timed(f"callback:{callbacks.ACTION_NAMES[action]}")(handler)
+    for action, handler in CALLBACK_HANDLERS.items()
+}, coalescer=renders, coalesce=RERENDER_ACTIONS)
+
+
 def main():
-    print("Запускаем бота...")
+    log_listener = app_logging.setup_logging()
+    logger.info("Запускаем бота...")
     init_db()
-    print("База данных готова")
+    db.start()
+    logger.info("Восстановлено диалогов: %s", conversations.load())
+    conversations.start()
 
-    updater = Updater(BOT_TOKEN, use_context=True)
+    # Запросы к Telegram идут через пул соединений: диспетчер, рассылка и обработчики в фоне
+    bot = create_bot(16)
+    updater = Updater(bot=bot, use_context=True)
     application = updater.dispatcher
 
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port))
+        logger.info("Метрики Prometheus: http://127.0.0.1:%s/metrics", metrics_port)
+
+    global notifier, outbox_worker, auto_dispatcher, sla_scheduler
+    notifier = Notifier(updater.bot)
+    notifier.start()
+    outbox_worker = OutboxWorker(notifier, new_order_notification_text)
+    outbox_worker.start()
+    archiver = OrderArchiver()
+    archiver.start()
+    if AUTO_DISPATCH:
+        auto_dispatcher = AutoDispatcher(notifier, offer_message)
+        auto_dispatcher.start()
+    if SLA_ENABLED:
+        sla_scheduler = SlaScheduler(notifier, sla_message, sla_masters)
+        sla_scheduler.start(updater.job_queue)
+
+    webhook_mode = os.getenv('BOT_MODE', 'polling') == 'webhook'
+    register_handlers(application, run_async=not webhook_mode)
+    logger.info("Бот запущен! Команды: /start, /admin, /complete, /finance, /status, /metrics, /search, /skills")
+
+    if webhook_mode:
+        run_webhook(updater)
+    else:
+        updater.start_polling(
+            allowed_updates=['message', 'callback_query'],
+            drop_pending_updates=True
+        )
+        updater.idle()
+    if auto_dispatcher:
+        auto_dispatcher.stop()
+    archiver.stop()
+    outbox_worker.stop()
+    notifier.stop()
+    conversations.stop()
+    db.shutdown()
+    close_connections()
+    log_listener.stop()
+
+
+def create_bot(pool_size):
+    """Bot с пулом из pool_size соединений. TELEGRAM_API_URL задает свой сервер Bot API
+    (например, локальный telegram-bot-api или тестовый)"""
+    return metrics.InstrumentedBot(BOT_TOKEN, base_url=os.getenv('TELEGRAM_API_URL'),
+                                   request=Request(con_pool_size=pool_size))
+
+
+def register_handlers(application, run_async=True):
+    """Подключить обработчики бота к диспетчеру.
+
+    run_async=False - обновления уже обрабатываются в потоках ShardedUpdateQueue (webhook
+    и рабочие процессы супервизора): обработчик выполняется в потоке своего чата,
+    и обновления одного чата не обгоняют друг друга в пуле диспетчера"""
     application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("admin", admin_command))
-    application.add_handler(CommandHandler("complete", complete_command))
-    application.add_handler(CommandHandler("finance", finance_command))
-    application.add_handler(CommandHandler("status", status_command))
-
-    application.add_handler(CallbackQueryHandler(handle_category_selection, pattern="^category_"))
-    application.add_handler(CallbackQueryHandler(handle_complete_actions, pattern="^complete_"))
-    application.add_handler(CallbackQueryHandler(handle_admin_actions))
+    # При long polling обработчики мастеров выполняются в пуле диспетчера и не задерживают
+    # остальные обновления. Диалог с клиентом остается последовательным, чтобы сообщения
+    # одного чата не перепутались.
+    application.add_handler(CommandHandler("admin", admin_command, run_async=run_async))
+    application.add_handler(CommandHandler("complete", complete_command, run_async=run_async))
+    application.add_handler(CommandHandler("finance", finance_command, run_async=run_async))
+    application.add_handler(CommandHandler("status", status_command, run_async=run_async))
+    application.add_handler(CommandHandler("metrics", metrics_command, run_async=run_async))
+    application.add_handler(CommandHandler("search", search_command, run_async=run_async))
+    application.add_handler(CommandHandler("skills", skills_command, run_async=run_async))
+
+    application.add_handler(CallbackQueryHandler(callback_router, run_async=run_async))
 
     application.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text_messages))
 
-    print("Бот запущен!")
-    print("• /start - для пользователей")
-    print("• /admin - для мастеров (просмотр заявок)")
-    print("• /complete - для мастеров (завершение заявок)")
-    print("• /finance - финансовая отчетность")
-    print("• /status - статус бота")
 
-    updater.start_polling(
-        allowed_updates=['message', 'callback_query'],
-        drop_pending_updates=True
-    )
-    updater.idle()
+def run_webhook(updater):
+    """Получать обновления через webhook: Telegram присылает их на встроенный HTTP-сервер,
+    обработка идет в WEBHOOK_WORKERS потоках, обновления одного чата - по порядку.
+
+    WEBHOOK_URL - публичный адрес (https://example.com/telegram, обычно за обратным прокси),
+    WEBHOOK_SECRET - секрет, который Telegram передает в заголовке каждого запроса."""
+    updates = ShardedUpdateQueue(updater.dispatcher.process_update, workers=int(os.getenv('WEBHOOK_WORKERS', '8')))
+    updates.start()
+    server = start_webhook(updater.bot, updates)
+    wait_for_stop_signal()
+    server.shutdown()
+    updates.stop()
+    updater.stop()
+
+
+def start_webhook(telegram_bot, updates):
+    """Запустить прием обновлений на WEBHOOK_PORT и зарегистрировать WEBHOOK_URL в Telegram.
+    updates - получатель обновлений с методом submit(update)"""
+    url = os.environ['WEBHOOK_URL']
+    secret = os.environ['WEBHOOK_SECRET']
+    port = int(os.getenv('WEBHOOK_PORT', '8443'))
+    server = start_webhook_server(telegram_bot, updates, secret, port, path=urlsplit(url).path or "/")
+    telegram_bot.set_webhook(url, secret_token=secret, allowed_updates=['message', 'callback_query'],
+                             drop_pending_updates=True)
+    logger.info("Webhook: %s, порт %s", url, port)
+    return server
+
+
+def wait_for_stop_signal(alive=None):
+    """Ждать SIGINT/SIGTERM. Updater.idle() без start_polling завершает процесс сразу.
+
+    alive() проверяется раз в секунду: если он вернул False, ожидание прекращается
+    и функция возвращает False, после сигнала - True"""
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stopping.set())
+    while not stopping.wait(1):
+        if alive is not None and not alive():
+            return False
+    return True
 
 
 if __name__ == "__main__":
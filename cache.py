@@ -0,0 +1,58 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Кэш в памяти процесса: не больше maxsize записей, каждая живет не дольше ttl секунд.
+
+    Строку, прочитанную из базы, кладут через put() с версией кэша, взятой до чтения.
+    Если пока шло чтение кэш сбросили (invalidate или clear после коммита),
+    версия уже другая и устаревшая строка в кэш не попадет."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """Значение по ключу или None, если его нет или срок истек"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._items.move_to_end(key)
+                    self._hits += 1
+                    return value
+                del self._items[key]
+            self._misses += 1
+            return None
+
+    def put(self, key, value, version):
+        """Запомнить значение, если с момента version кэш не сбрасывали"""
+        with self._lock:
+            if version != self.version:
+                return
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.version += 1
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'size': len(self._items)}
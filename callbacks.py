@@ -0,0 +1,200 @@
+import base64
+import binascii
+import functools
+import logging
+from typing import NamedTuple
+
+from app_constants import CATEGORY_IDS
+
+logger = logging.getLogger(__name__)
+
+# Версия формата callback_data: первый символ строки.
+# Строки без него - кнопки старого формата ("take_15"), они разбираются отдельно.
+VERSION = "1"
+
+# Действия кнопок
+PICK_CATEGORY = 1      # клиент выбрал категорию
+ADMIN_CATEGORIES = 2   # список категорий в панели мастера
+ADMIN_REFRESH = 3
+ADMIN_BACK = 4
+ADMIN_CLOSE = 5
+SHOW_ORDERS = 6        # первая новая заявка категории
+NEXT_ORDER = 7
+PREV_ORDER = 8
+TAKE_ORDER = 9
+MY_ORDER = 10
+COMPLETE_ORDER = 11
+SEARCH_PAGE = 12       # страница результатов /search, номер страницы в cursor
+OFFER_ACCEPT = 13      # мастер принял автоматически предложенную заявку
+OFFER_DECLINE = 14
+
+# Имена действий для метрик и журналов
+ACTION_NAMES = {
+    PICK_CATEGORY: "pick_category",
+    ADMIN_CATEGORIES: "admin_categories",
+    ADMIN_REFRESH: "admin_refresh",
+    ADMIN_BACK: "admin_back",
+    ADMIN_CLOSE: "admin_close",
+    SHOW_ORDERS: "show_orders",
+    NEXT_ORDER: "next_order",
+    PREV_ORDER: "prev_order",
+    TAKE_ORDER: "take_order",
+    MY_ORDER: "my_order",
+    COMPLETE_ORDER: "complete_order",
+    SEARCH_PAGE: "search_page",
+    OFFER_ACCEPT: "offer_accept",
+    OFFER_DECLINE: "offer_decline",
+}
+
+# Сколько разных callback_data помнить разобранными: нажимают одни и те же кнопки
+DECODE_CACHE_SIZE = 4096
+
+# Код категории в кнопке - ее id из app_constants.CATEGORIES, 0 означает "все категории"
+_CODE_BY_CATEGORY = {"all": 0, **CATEGORY_IDS}
+_CATEGORY_BY_CODE = {code: key for key, code in _CODE_BY_CATEGORY.items()}
+
+
+class Callback(NamedTuple):
+    action: int
+    order_id: int = 0
+    category: str = "all"
+    cursor: int = 0
+
+
+def _write_varint(buffer, value):
+    while value > 0x7f:
+        buffer.append(value & 0x7f | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _read_varints(raw):
+    values, value, shift = [], 0, 0
+    for byte in raw:
+        if byte < 0x80:
+            values.append(value | byte << shift)
+            value, shift = 0, 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+    return values
+
+
+_FROM_URLSAFE = bytes.maketrans(b"-_", b"+/")
+
+
+def encode(action, order_id=0, category="all", cursor=0):
+    """Упаковать действие кнопки в callback_data (укладывается в 64 байта Telegram)"""
+    fields = [action, order_id, _CODE_BY_CATEGORY[category], cursor]
+    while fields[-1] == 0:
+        fields.pop()
+    buffer = bytearray()
+    for value in fields:
+        _write_varint(buffer, value)
+    return VERSION + base64.urlsafe_b64encode(bytes(buffer)).rstrip(b"=").decode("ascii")
+
+
+def decode(data):
+    """Разобрать callback_data. Для неизвестных данных возвращает Callback(0)"""
+    if not data:
+        return Callback(0)
+    try:
+        return _decode(data)
+    except (ValueError, IndexError, KeyError, TypeError):
+        logger.warning("Некорректные данные кнопки: %r", data)
+        return Callback(0)
+
+
+@functools.lru_cache(maxsize=DECODE_CACHE_SIZE)
+def _decode(data):
+    if data[0] != VERSION:
+        return _decode_legacy(data)
+    # Лишнее выравнивание "=" a2b_base64 пропускает
+    fields = _read_varints(binascii.a2b_base64(data[1:].encode("ascii").translate(_FROM_URLSAFE) + b"=="))
+    if len(fields) > 2:
+        fields[2] = _CATEGORY_BY_CODE[fields[2]]
+    return Callback(*fields)
+
+
+# Кнопки старого формата в уже отправленных сообщениях
+_LEGACY_EXACT = {
+    "admin_show_categories": Callback(ADMIN_CATEGORIES),
+    "admin_refresh": Callback(ADMIN_REFRESH),
+    "admin_back": Callback(ADMIN_BACK),
+    "admin_close": Callback(ADMIN_CLOSE),
+    "admin_all_orders": Callback(SHOW_ORDERS),
+}
+_LEGACY_CATEGORY_PREFIXES = {
+    "category_": PICK_CATEGORY,
+    "admin_category_": SHOW_ORDERS,
+    "admin_back_to_": SHOW_ORDERS,
+}
+_LEGACY_ORDER_PREFIXES = {
+    "take_": TAKE_ORDER,
+    "show_my_order_": MY_ORDER,
+    "complete_": COMPLETE_ORDER,
+    "next_": NEXT_ORDER,
+    "prev_": PREV_ORDER,
+}
+
+
+def _decode_legacy(data):
+    if data in _LEGACY_EXACT:
+        return _LEGACY_EXACT[data]
+    for prefix, action in _LEGACY_CATEGORY_PREFIXES.items():
+        if data.startswith(prefix):
+            category = data[len(prefix):]
+            return Callback(action, category=category) if category in _CODE_BY_CATEGORY else Callback(0)
+    for prefix, action in _LEGACY_ORDER_PREFIXES.items():
+        if data.startswith(prefix):
+            # next_/prev_ дополнительно несут категорию: next_15_doors_windows
+            order_id, _, category = data[len(prefix):].partition("_")
+            if not order_id.isdigit() or (category and category not in _CODE_BY_CATEGORY):
+                return Callback(0)
+            return Callback(action, int(order_id), category or "all")
+    return Callback(0)
+
+
+class CallbackRouter:
+    """Обработчик нажатий на кнопки: разбирает callback_data один раз
+    и вызывает handler(update, context, callback) по коду действия.
+
+    С coalescer (coalescer.RenderCoalescer) обработчик получает update.callback_query,
+    который отвечает на нажатие ровно один раз и не отправляет правку без изменений,
+    а нажатия с действиями из coalesce, которые только перерисовывают сообщение,
+    сливаются: частые нажатия на одно сообщение дают одну итоговую отрисовку."""
+
+    def __init__(self, handlers=None, unknown=None, coalescer=None, coalesce=()):
+        self.handlers = dict(handlers or {})
+        self.unknown = unknown
+        self.coalescer = coalescer
+        self.coalesce = frozenset(coalesce)
+
+    def register(self, action, handler):
+        self.handlers[action] = handler
+
+    def __call__(self, update, context):
+        callback = decode(update.callback_query.data)
+        handler = self.handlers.get(callback.action)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Кнопка %s", update.callback_query.data,
+                         extra={'order_id': callback.order_id or None, 'user_id': update.effective_user.id,
+                                'handler': ACTION_NAMES.get(callback.action, 'unknown')})
+        if self.coalescer is None:
+            return self._dispatch(handler, update, context, callback)
+
+        query = update.callback_query = self.coalescer.track(update.callback_query)
+        try:
+            if handler is not None and callback.action in self.coalesce:
+                return self.coalescer.submit(query, lambda: handler(update, context, callback))
+            return self._dispatch(handler, update, context, callback)
+        finally:
+            # Слитое или отброшенное нажатие тоже нужно подтвердить, иначе у кнопки крутятся часики
+            query.finish()
+
+    def _dispatch(self, handler, update, context, callback):
+        if handler is None:
+            if self.unknown:
+                return self.unknown(update, context, callback)
+            return update.callback_query.answer("Неизвестное действие")
+        return handler(update, context, callback)
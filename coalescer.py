@@ -0,0 +1,168 @@
+import threading
+import time
+
+from telegram.error import BadRequest
+
+from cache import LRUCache
+
+# Повторное нажатие той же кнопки того же сообщения в течение этого времени после
+# отрисовки не выполняется: кнопка еще старая, результат будет тем же
+REPEAT_WINDOW = 1.0
+# Сколько сообщений помнить (последнее нажатие и отпечаток текста) и сколько секунд
+MAX_MESSAGES = 10000
+RENDERED_TTL = 3600
+
+
+class TrackedQuery:
+    """Обертка CallbackQuery для обработчиков: answer() доходит до Telegram один раз,
+    а edit_message_text() не отправляется, если сообщение уже выглядит так же"""
+
+    def __init__(self, query, coalescer):
+        self._query = query
+        self._coalescer = coalescer
+        self._answered = False
+        # Ответ отправил finish(), а не обработчик: так бывает с отложенной отрисовкой,
+        # ее answer() приходит позже и ничего не экономит
+        self._finished = False
+        self._lock = threading.Lock()
+        message = query.message
+        self.message_key = (message.chat_id, message.message_id) if message is not None else None
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    def answer(self, *args, **kwargs):
+        with self._lock:
+            if self._answered:
+                if not self._finished:
+                    self._coalescer._count('answers_skipped')
+                return True
+            self._answered = True
+        return self._query.answer(*args, **kwargs)
+
+    def finish(self):
+        """Ответить на нажатие, если обработчик этого не сделал"""
+        with self._lock:
+            if self._answered:
+                return
+            self._answered = True
+            self._finished = True
+        self._query.answer()
+
+    def edit_message_text(self, text, **kwargs):
+        return self._coalescer.edit(self, text, **kwargs)
+
+
+class RenderCoalescer:
+    """Слияние частых нажатий на кнопки одного сообщения.
+
+    Пока отрисовка сообщения выполняется, следующие нажатия на него не запускают свою:
+    запоминается только последнее, и оно выполняется после текущей. Нажатие с теми же
+    данными, что и текущая или только что законченная отрисовка, отбрасывается.
+    Правка с тем же текстом и кнопками, что уже в сообщении, в Telegram не отправляется.
+    Счетчики показывают, сколько отрисовок и вызовов API удалось не делать."""
+
+    def __init__(self, window=REPEAT_WINDOW, max_messages=MAX_MESSAGES):
+        self.window = window
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._messages = {}
+        self._rendered = LRUCache(max_messages, RENDERED_TTL)
+        self._counters = {'callbacks': 0, 'coalesced': 0, 'edits': 0, 'edits_skipped': 0, 'answers_skipped': 0}
+
+    def track(self, query):
+        self._count('callbacks')
+        return TrackedQuery(query, self)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        # Каждая слитая отрисовка - это несостоявшаяся правка сообщения
+        stats['api_calls_saved'] = stats['coalesced'] + stats['edits_skipped'] + stats['answers_skipped']
+        return stats
+
+    def submit(self, query, render):
+        """Выполнить render() для нажатия query (TrackedQuery) или слить его с соседними"""
+        key = query.message_key
+        if key is None:
+            render()
+            return
+        with self._lock:
+            state = self._messages.get(key)
+            if state is None:
+                if len(self._messages) >= self.max_messages:
+                    self._forget_idle()
+                state = self._messages[key] = _MessageState()
+            if state.running:
+                # Слитыми считаются только нажатия, которые так и не будут отрисованы:
+                # повтор текущей отрисовки и ожидавшее нажатие, которое заменило новое
+                if query.data == state.data:
+                    self._counters['coalesced'] += 1
+                    return
+                if state.pending is not None:
+                    # Его ответ уже отправлен, отрисовка больше не нужна
+                    self._counters['coalesced'] += 1
+                state.pending = (query.data, render)
+                return
+            if query.data == state.data and time.monotonic() - state.finished_at < self.window:
+                self._counters['coalesced'] += 1
+                return
+            state.running = True
+            state.data = query.data
+
+        while render is not None:
+            try:
+                render()
+            except BaseException:
+                with self._lock:
+                    state.running = False
+                    state.pending = None
+                    state.data = None
+                raise
+            with self._lock:
+                state.finished_at = time.monotonic()
+                state.data, render = state.pending or (state.data, None)
+                state.pending = None
+                state.running = render is not None
+
+    def edit(self, query, text, **kwargs):
+        key = query.message_key
+        markup = kwargs.get('reply_markup')
+        digest = hash((text, kwargs.get('parse_mode'), markup.to_json() if markup is not None else None))
+        if key is not None and self._rendered.get(key) == digest:
+            self._count('edits_skipped')
+            return None
+        version = self._rendered.version
+        try:
+            result = query._query.edit_message_text(text, **kwargs)
+        except BadRequest as e:
+            # Сообщение отправлено не через edit (например, reply_text) и уже такое же
+            if 'not modified' not in str(e).lower():
+                raise
+            self._count('edits_skipped')
+            result = None
+        else:
+            self._count('edits')
+        if key is not None:
+            self._rendered.put(key, digest, version)
+        return result
+
+    def _forget_idle(self):
+        now = time.monotonic()
+        for key, state in list(self._messages.items()):
+            if not state.running and now - state.finished_at >= self.window:
+                del self._messages[key]
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+class _MessageState:
+    __slots__ = ('running', 'data', 'pending', 'finished_at')
+
+    def __init__(self):
+        self.running = False
+        self.data = None
+        self.pending = None
+        self.finished_at = 0.0
@@ -1,187 +1,1228 @@
+import logging
+import os
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 
+import metrics
+from app_constants import CATEGORIES, CATEGORY_IDS
+from cache import LRUCache
+from models import CompletedOrder, Order, OrderCard, OrderTimes, columns, row_factory
 
-def init_db():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute('''CREATE TABLE IF NOT EXISTS orders (
+logger = logging.getLogger(__name__)
+
+# Путь к базе можно переопределить через переменную окружения ORDERS_DB_PATH
+DB_PATH = os.getenv('ORDERS_DB_PATH', 'orders.db')
+
+# Сколько ждать освобождения блокировки, прежде чем отдать "database is locked"
+BUSY_TIMEOUT = 5.0
+# Размер кэша подготовленных запросов на одно соединение
+STATEMENT_CACHE_SIZE = 128
+# Кэш заявок по id и активных заявок мастеров: число записей и время жизни записи в секундах
+ORDER_CACHE_SIZE = int(os.getenv('ORDER_CACHE_SIZE', '2000'))
+ORDER_CACHE_TTL = float(os.getenv('ORDER_CACHE_TTL', '60'))
+
+# Настройки, которые применяются к каждому новому соединению
+CONNECTION_PRAGMAS = (
+    # Освобожденные страницы возвращаются постепенно через incremental_vacuum (см. archiver.py).
+    # Режим задается до journal_mode: переключение в WAL уже записывает заголовок новой базы.
+    # На уже созданной базе режим включается только после полного VACUUM: manage.py vacuum
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+)
+
+# Пересборка финансовых сводок по истории заявок за один проход.
+# {orders} - источник заявок: orders_all, а в миграциях до появления архива - orders.
+# Столбцы ключа сводок не бывают NULL: заявки без мастера или без категории учитываются под 0
+REBUILD_ROLLUPS = (
+    "DELETE FROM finance_rollup",
+    "DELETE FROM master_earnings",
+    "INSERT INTO finance_rollup (master_id, day, category_id, completed) "
+    "SELECT COALESCE(master_id, 0), date(COALESCE(completed_at, created_at)), COALESCE(category_id, 0), COUNT(*) "
+    "FROM {orders} WHERE status = 'completed' GROUP BY 1, 2, 3",
+    "INSERT INTO master_earnings (master_id, master_name, completed) "
+    "SELECT COALESCE(master_id, 0), MAX(master_name), COUNT(*) FROM {orders} WHERE status = 'completed' GROUP BY 1",
+)
+
+# Столбцы, которые выбираются для строк models.Order и models.OrderCard
+ORDER_COLUMNS = columns(Order)
+CARD_COLUMNS = columns(OrderCard)
+COMPLETED_COLUMNS = "id, master_id, master_name, category_id, COALESCE(completed_at, created_at) AS completed_at"
+TIMES_COLUMNS = ("id, user_id, category_id, status, master_id, CAST(strftime('%s', created_at) AS INTEGER) AS created_at, "
+                 "CAST(strftime('%s', assigned_at) AS INTEGER) AS assigned_at")
+
+_ROW_FACTORIES = {row_type: row_factory(row_type) for row_type in (Order, OrderCard, CompletedOrder, OrderTimes)}
+
+# Индексы таблицы orders на момент миграции 6 (пересоздаются вместе с таблицей)
+ORDER_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_new_created ON orders(created_at, id) WHERE status = 'new'",
+    "CREATE INDEX IF NOT EXISTS idx_orders_new_category "
+    "ON orders(category_id, created_at, id) WHERE status = 'new'",
+    "CREATE INDEX IF NOT EXISTS idx_orders_master_status ON orders(master_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_completed_created ON orders(created_at) WHERE status = 'completed'",
+)
+
+# Индекс FTS5 над заявками. Текст хранится только в orders: содержимое индекса берется
+# из представления orders_search, индекс обновляют триггеры. unicode61 приводит кириллицу
+# к нижнему регистру, но не знает, что ё - это е, поэтому ё заменяется на е и в индексе,
+# и в запросе. Стемминга для русского в FTS5 нет, окончания покрывает поиск по префиксу.
+# Префиксный индекс на 3 символа ускоряет короткие префиксы ("913", "гаг"); слова короче
+# ищутся целиком ("ул", "д"), иначе под них попадает почти каждая заявка.
+_FOLD = "replace(replace({}, 'ё', 'е'), 'Ё', 'Е')"
+_SEARCH_COLUMNS = ("description", "contacts", "username")
+
+
+def _search_values(row):
+    return ", ".join(_FOLD.format(f"{row}.{name}") for name in _SEARCH_COLUMNS)
+
+
+ORDERS_FTS = (
+    "CREATE VIEW IF NOT EXISTS orders_search AS SELECT id, "
+    + ", ".join(f"{_FOLD.format(name)} AS {name}" for name in _SEARCH_COLUMNS) + " FROM orders",
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+       description, contacts, username,
+       content='orders_search', content_rowid='id',
+       tokenize='unicode61 remove_diacritics 2', prefix='3')''',
+    f'''CREATE TRIGGER IF NOT EXISTS orders_fts_insert AFTER INSERT ON orders BEGIN
+       INSERT INTO orders_fts (rowid, description, contacts, username)
+       VALUES (new.id, {_search_values('new')});
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS orders_fts_delete AFTER DELETE ON orders BEGIN
+       INSERT INTO orders_fts (orders_fts, rowid, description, contacts, username)
+       VALUES ('delete', old.id, {_search_values('old')});
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS orders_fts_update AFTER UPDATE OF description, contacts, username ON orders
+       BEGIN
+       INSERT INTO orders_fts (orders_fts, rowid, description, contacts, username)
+       VALUES ('delete', old.id, {_search_values('old')});
+       INSERT INTO orders_fts (rowid, description, contacts, username)
+       VALUES (new.id, {_search_values('new')});
+       END''',
+)
+
+# Поиск по фрагменту телефона. unicode61 делит "+7 905 123-45-67" на отдельные числа, и
+# "9051234567" или "1234567" по ним не находятся. Поэтому контакты без разделителей номера
+# индексируются еще и триграммами (SQLite 3.34+): триграммы находят любую подстроку от трех
+# символов. Из числового запроса берутся только цифры (см. search_orders)
+_PHONE_SEPARATORS = " -()+."
+
+
+def _phone_value(row):
+    value = f"{row}.contacts"
+    for separator in _PHONE_SEPARATORS:
+        value = f"replace({value}, '{separator}', '')"
+    return value
+
+
+ORDERS_PHONE_FTS = (
+    f"CREATE VIEW IF NOT EXISTS orders_phones AS SELECT id, {_phone_value('orders')} AS contacts FROM orders",
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS orders_phone_fts USING fts5(
+       contacts, content='orders_phones', content_rowid='id', tokenize='trigram')''',
+    f'''CREATE TRIGGER IF NOT EXISTS orders_phone_fts_insert AFTER INSERT ON orders BEGIN
+       INSERT INTO orders_phone_fts (rowid, contacts) VALUES (new.id, {_phone_value('new')});
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS orders_phone_fts_delete AFTER DELETE ON orders BEGIN
+       INSERT INTO orders_phone_fts (orders_phone_fts, rowid, contacts) VALUES ('delete', old.id, {_phone_value('old')});
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS orders_phone_fts_update AFTER UPDATE OF contacts ON orders BEGIN
+       INSERT INTO orders_phone_fts (orders_phone_fts, rowid, contacts) VALUES ('delete', old.id, {_phone_value('old')});
+       INSERT INTO orders_phone_fts (rowid, contacts) VALUES (new.id, {_phone_value('new')});
+       END''',
+)
+
+# Не больше стольких слов из поискового запроса
+MAX_SEARCH_TERMS = 8
+# Слова короче этого ищутся целиком, а не как префикс
+MIN_PREFIX_LENGTH = 3
+# Поиск возвращает не больше стольких самых новых совпадений: точный подсчет и ранжирование
+# всех заявок с частым словом стоят пропорционально их числу, а мастеру достаточно "1000+"
+SEARCH_COUNT_LIMIT = 1000
+_SEARCH_TERM = re.compile(r"\w+")
+_NON_DIGITS = re.compile(r"[^0-9]")
+
+# Названия категорий из старых заявок, которых нет в app_constants, получают id начиная с этого
+LEGACY_CATEGORY_ID = 1000
+
+
+def _sync_categories(conn):
+    """Привести справочник categories к app_constants.CATEGORIES (id не меняются)"""
+    conn.executemany("INSERT INTO categories (id, key, label) VALUES (?, ?, ?) "
+                     "ON CONFLICT (id) DO UPDATE SET key = excluded.key, label = excluded.label", CATEGORIES)
+
+
+def _migrate_category_ids(conn):
+    """Миграция 6: справочник категорий и orders.category_id вместо названия категории.
+
+    SQLite не меняет тип столбца, поэтому orders пересоздается с тем же порядком столбцов
+    (order[3] теперь id категории). Названия, которых нет в справочнике, добавляются в него
+    с id от LEGACY_CATEGORY_ID, чтобы старые заявки не потеряли категорию."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS categories (
+                 id INTEGER PRIMARY KEY,
+                 key TEXT NOT NULL UNIQUE,
+                 label TEXT NOT NULL)''')
+    _sync_categories(conn)
+    known = set()
+    for key, label in conn.execute("SELECT key, label FROM categories").fetchall():
+        known.update((key, label))
+    legacy = conn.execute("SELECT DISTINCT category FROM orders WHERE category IS NOT NULL").fetchall()
+    next_id = LEGACY_CATEGORY_ID
+    for (name,) in legacy:
+        if name not in known:
+            conn.execute("INSERT INTO categories (id, key, label) VALUES (?, ?, ?)",
+                         (next_id, f"legacy_{next_id}", name))
+            next_id += 1
+
+    conn.execute('''CREATE TABLE orders_new (
                  id INTEGER PRIMARY KEY AUTOINCREMENT,
                  user_id INTEGER,
                  username TEXT,
-                 category TEXT,
+                 category_id INTEGER,
                  description TEXT,
                  contacts TEXT,
                  status TEXT DEFAULT 'new',
                  master_id INTEGER DEFAULT NULL,
                  master_name TEXT DEFAULT NULL,
-                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-    conn.commit()
-    conn.close()
-    print("База данных инициализирована")
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                 completed_at TIMESTAMP DEFAULT NULL)''')
+    conn.execute("INSERT INTO orders_new SELECT o.id, o.user_id, o.username, "
+                 "COALESCE((SELECT id FROM categories WHERE label = o.category), "
+                 "(SELECT id FROM categories WHERE key = o.category)), "
+                 "o.description, o.contacts, o.status, o.master_id, o.master_name, o.created_at, o.completed_at "
+                 "FROM orders AS o")
+    # Счетчик AUTOINCREMENT переносим как есть: id удаленных заявок не должны выдаваться снова
+    conn.execute("UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'orders') "
+                 "WHERE name = 'orders_new' AND EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'orders')")
+    conn.execute("DROP TABLE orders")
+    conn.execute("ALTER TABLE orders_new RENAME TO orders")
+    for statement in ORDER_INDEXES:
+        conn.execute(statement)
+
+    conn.execute("DROP TABLE order_counters")
+    conn.execute('''CREATE TABLE order_counters (
+                 status TEXT NOT NULL,
+                 category_id INTEGER NOT NULL,
+                 count INTEGER NOT NULL,
+                 PRIMARY KEY (status, category_id)) WITHOUT ROWID''')
+    conn.execute("INSERT INTO order_counters (status, category_id, count) "
+                 "SELECT status, COALESCE(category_id, 0), COUNT(*) FROM orders GROUP BY 1, 2")
+    conn.execute("DROP TABLE finance_rollup")
+    conn.execute('''CREATE TABLE finance_rollup (
+                 master_id INTEGER,
+                 day TEXT NOT NULL,
+                 category_id INTEGER,
+                 completed INTEGER NOT NULL,
+                 PRIMARY KEY (master_id, day, category_id)) WITHOUT ROWID''')
+    for statement in REBUILD_ROLLUPS:
+        conn.execute(statement.format(orders='orders'))
+
+
+# Миграции схемы: i-й элемент переводит базу в версию i + 1.
+# Текущая версия хранится в PRAGMA user_version.
+# Элемент - SQL-команды или функция, которая получает соединение.
+MIGRATIONS = (
+    # 1: индексы под основные запросы к заявкам
+    (
+        "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_new_created ON orders(created_at, id) WHERE status = 'new'",
+        "CREATE INDEX IF NOT EXISTS idx_orders_new_category "
+        "ON orders(category, created_at, id) WHERE status = 'new'",
+        "CREATE INDEX IF NOT EXISTS idx_orders_master_status ON orders(master_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_completed_created ON orders(created_at) WHERE status = 'completed'",
+    ),
+    # 2: очередь уведомлений мастерам (outbox), пишется в одной транзакции с заявкой
+    (
+        '''CREATE TABLE IF NOT EXISTS outbox (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           order_id INTEGER NOT NULL,
+           chat_id INTEGER NOT NULL,
+           status TEXT NOT NULL DEFAULT 'pending',
+           attempts INTEGER NOT NULL DEFAULT 0,
+           next_attempt_at REAL NOT NULL DEFAULT 0,
+           sent_at TIMESTAMP DEFAULT NULL)''',
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(next_attempt_at) WHERE status = 'pending'",
+    ),
+    # 3: состояния диалогов с клиентами (см. state_store.py)
+    (
+        '''CREATE TABLE IF NOT EXISTS conversations (
+           user_id INTEGER PRIMARY KEY,
+           state INTEGER NOT NULL,
+           category TEXT,
+           description TEXT,
+           updated_at REAL NOT NULL)''',
+        "CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at)",
+    ),
+    # 4: время завершения заявки и финансовые сводки, которые обновляются при завершении
+    (
+        "ALTER TABLE orders ADD COLUMN completed_at TIMESTAMP DEFAULT NULL",
+        '''CREATE TABLE IF NOT EXISTS finance_rollup (
+           master_id INTEGER,
+           day TEXT NOT NULL,
+           category TEXT,
+           completed INTEGER NOT NULL,
+           PRIMARY KEY (master_id, day, category)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS master_earnings (
+           master_id INTEGER PRIMARY KEY,
+           master_name TEXT,
+           completed INTEGER NOT NULL)''',
+        # Сводки заполняет миграция 6, когда в заявках уже есть category_id
+    ),
+    # 5: счетчики заявок по статусам и категориям, общие для всех процессов бота
+    (
+        '''CREATE TABLE IF NOT EXISTS order_counters (
+           status TEXT NOT NULL,
+           category TEXT NOT NULL,
+           count INTEGER NOT NULL,
+           PRIMARY KEY (status, category)) WITHOUT ROWID''',
+        "INSERT INTO order_counters (status, category, count) "
+        "SELECT status, COALESCE(category, ''), COUNT(*) FROM orders GROUP BY status, category",
+    ),
+    # 6: справочник категорий, в заявках вместо названия категории ее id
+    (
+        _migrate_category_ids,
+    ),
+    # 7: полнотекстовый поиск по описанию, контактам и имени клиента (см. search_orders)
+    (
+        *ORDERS_FTS,
+        "INSERT INTO orders_fts (orders_fts) VALUES ('rebuild')",
+    ),
+    # 8: архив завершенных заявок (см. archive_orders) и orders_all - живые и архивные заявки вместе.
+    # Индекс по одному status почти не отбирает строки, но планировщик предпочитал его частичным
+    # индексам и сортировал все новые заявки во временном B-дереве (около 1 с на 1 млн заявок)
+    (
+        "DROP INDEX IF EXISTS idx_orders_status",
+        '''CREATE TABLE IF NOT EXISTS orders_archive (
+           id INTEGER PRIMARY KEY,
+           user_id INTEGER,
+           username TEXT,
+           category_id INTEGER,
+           description TEXT,
+           contacts TEXT,
+           status TEXT,
+           master_id INTEGER,
+           master_name TEXT,
+           created_at TIMESTAMP,
+           completed_at TIMESTAMP)''',
+        "CREATE INDEX IF NOT EXISTS idx_orders_archive_created ON orders_archive(created_at)",
+        f"CREATE VIEW IF NOT EXISTS orders_all AS SELECT {ORDER_COLUMNS} FROM orders "
+        f"UNION ALL SELECT {ORDER_COLUMNS} FROM orders_archive",
+    ),
+    # 9: авто-распределение (см. auto_dispatch.py): категории мастеров и предложения заявок
+    (
+        '''CREATE TABLE IF NOT EXISTS master_skills (
+           master_id INTEGER NOT NULL,
+           category_id INTEGER NOT NULL,
+           master_name TEXT,
+           PRIMARY KEY (master_id, category_id)) WITHOUT ROWID''',
+        '''CREATE TABLE IF NOT EXISTS dispatch_offers (
+           id INTEGER PRIMARY KEY AUTOINCREMENT,
+           order_id INTEGER NOT NULL,
+           master_id INTEGER NOT NULL,
+           status TEXT NOT NULL DEFAULT 'pending',
+           expires_at REAL NOT NULL)''',
+        "CREATE INDEX IF NOT EXISTS idx_dispatch_offers_order ON dispatch_offers(order_id, master_id)",
+        "CREATE INDEX IF NOT EXISTS idx_dispatch_offers_pending ON dispatch_offers(expires_at) WHERE status = 'pending'",
+    ),
+    # 10: сроки заявок (см. sla.py): когда заявку взяли в работу. У взятых раньше заявок
+    # время неизвестно, для них берется время создания
+    (
+        "ALTER TABLE orders ADD COLUMN assigned_at TIMESTAMP DEFAULT NULL",
+        "UPDATE orders SET assigned_at = created_at WHERE status = 'in_progress'",
+        "CREATE INDEX IF NOT EXISTS idx_orders_in_progress_assigned ON orders(assigned_at) WHERE status = 'in_progress'",
+    ),
+    # 11: /finance показывает последние дни по категориям, сводки читаются по диапазону дней
+    (
+        "CREATE INDEX IF NOT EXISTS idx_finance_rollup_day ON finance_rollup(day, category_id, completed)",
+    ),
+    # 12: поиск по фрагменту телефона в контактах (см. ORDERS_PHONE_FTS)
+    (
+        *ORDERS_PHONE_FTS,
+        "INSERT INTO orders_phone_fts (orders_phone_fts) VALUES ('rebuild')",
+    ),
+)
+
+# Результаты claim_order
+CLAIM_WON = 'won'
+CLAIM_LOST = 'lost'  # заявку уже взял другой мастер
+CLAIM_BUSY = 'busy'  # у мастера уже есть заявка в работе
+
+# Результаты answer_offer, кроме результатов claim_order
+OFFER_DECLINED = 'declined'
+OFFER_EXPIRED = 'expired'  # предложение просрочено или уже закрыто
+
+# Переходы по новым заявкам в порядке (created_at, id): шаг -> (имя запроса, сравнение, направление)
+_NEW_ORDER_STEPS = {-1: ('prev', '<', 'DESC'), 0: ('at', '>=', 'ASC'), 1: ('next', '>', 'ASC')}
+
+
+def _new_order_queries():
+    """Запросы к списку новых заявок: для всех категорий и с суффиксом _by_category для одной"""
+    queries = {}
+    for suffix, where, params in (("", "status = 'new'", ()),
+                                  ("_by_category", "status = 'new' AND category_id = ?", (0,))):
+        queries['new_orders' + suffix] = (
+            f"SELECT {ORDER_COLUMNS} FROM orders WHERE {where} ORDER BY created_at ASC", params)
+        queries['new_order_position' + suffix] = (
+            f"SELECT COUNT(*) FROM orders WHERE {where} AND (created_at, id) < (?, ?)", (*params, '', 0))
+        for name, comparison, direction in _NEW_ORDER_STEPS.values():
+            queries[f'new_order_{name}{suffix}'] = (
+                f"SELECT {CARD_COLUMNS} FROM orders WHERE {where} AND (created_at, id) {comparison} (?, ?) "
+                f"ORDER BY created_at {direction}, id {direction} LIMIT 1", (*params, '', 0))
+        # После последней заявки - первая и наоборот
+        for name, direction in (('first', 'ASC'), ('last', 'DESC')):
+            queries[f'new_order_{name}{suffix}'] = (
+                f"SELECT {CARD_COLUMNS} FROM orders WHERE {where} "
+                f"ORDER BY created_at {direction}, id {direction} LIMIT 1", params)
+    return queries
+
+
+# Горячие запросы, которые обязаны идти по индексу (см. check_query_plans).
+# Функции чтения берут SQL отсюда, поэтому проверяется ровно то, что выполняется
+HOT_QUERIES = {
+    **_new_order_queries(),
+    'order_anchor': ("SELECT created_at, id FROM orders WHERE id = ?", (0,)),
+    'order_by_id': (f"SELECT {ORDER_COLUMNS} FROM orders_all WHERE id = ?", (0,)),
+    'master_active_orders': (f"SELECT {CARD_COLUMNS} FROM orders WHERE master_id = ? AND status = 'in_progress'", (0,)),
+    # Ранжируются только SEARCH_COUNT_LIMIT самых новых совпадений: FTS5 читает их по rowid
+    # и останавливается, поэтому время не растет вместе с числом подходящих заявок
+    'search_orders': (
+        f"SELECT {', '.join('orders.' + name for name in OrderCard._fields)} FROM "
+        "(SELECT rowid, rank FROM orders_fts WHERE orders_fts MATCH ? ORDER BY rowid DESC LIMIT ?) AS found "
+        "JOIN orders ON orders.id = found.rowid ORDER BY found.rank LIMIT ? OFFSET ?",
+        ('"бойлер"*', 1000, 5, 0)),
+    # Числовой запрос: фрагмент телефона (?1) или числа в тексте заявки (?2), новые заявки первыми
+    'search_orders_phone': (
+        f"SELECT {', '.join('orders.' + name for name in OrderCard._fields)} FROM "
+        "(SELECT rowid FROM orders_phone_fts WHERE orders_phone_fts MATCH ?1 "
+        "UNION SELECT rowid FROM orders_fts WHERE orders_fts MATCH ?2 ORDER BY rowid DESC LIMIT ?3) AS found "
+        "JOIN orders ON orders.id = found.rowid ORDER BY found.rowid DESC LIMIT ?4 OFFSET ?5",
+        ('"9051234"', '"905"* "1234"*', 1000, 5, 0)),
+    # UNION ALL в представлении не получает ORDER BY ... LIMIT, поэтому предел ставится в каждой части
+    'recent_completed_orders': (
+        "SELECT id, master_id, master_name, category_id, completed_at FROM ("
+        f"SELECT * FROM (SELECT {COMPLETED_COLUMNS}, created_at FROM orders WHERE status = 'completed' "
+        "ORDER BY created_at DESC, id DESC LIMIT ?1) "
+        f"UNION ALL SELECT * FROM (SELECT {COMPLETED_COLUMNS}, created_at FROM orders_archive "
+        "ORDER BY created_at DESC, id DESC LIMIT ?1)) "
+        "ORDER BY created_at DESC, id DESC LIMIT ?1", (5,)),
+    'undispatched_orders': (
+        "SELECT id, category_id, created_at FROM orders WHERE status = 'new' AND (created_at, id) > (?, ?) "
+        "AND NOT EXISTS (SELECT 1 FROM dispatch_offers WHERE dispatch_offers.order_id = orders.id "
+        "AND dispatch_offers.status = 'pending') ORDER BY created_at, id LIMIT ?", ('', 0, 100)),
+    'busy_masters': (
+        "SELECT master_id FROM master_skills WHERE EXISTS (SELECT 1 FROM orders "
+        "WHERE orders.master_id = master_skills.master_id AND orders.status = 'in_progress') "
+        "UNION SELECT master_id FROM dispatch_offers WHERE status = 'pending'", ()),
+    # Открытые заявки для планировщика сроков при запуске, каждая выборка - по своему частичному индексу
+    'sla_new_orders': (f"SELECT {TIMES_COLUMNS} FROM orders WHERE status = 'new' ORDER BY created_at", ()),
+    'sla_in_progress_orders': (
+        f"SELECT {TIMES_COLUMNS} FROM orders WHERE status = 'in_progress' ORDER BY assigned_at", ()),
+    'archive_candidates': (
+        "SELECT id FROM orders WHERE status = 'completed' AND created_at < ?1 "
+        "AND COALESCE(completed_at, created_at) < ?1 ORDER BY created_at LIMIT ?2", ('', 500)),
+}
+
+# У каждого потока диспетчера свое долгоживущее соединение.
+# В режиме WAL читатели не блокируются писателем и наоборот.
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+
+# Коммиты и заполнение кэшей в памяти идут под одной блокировкой,
+# чтобы кэш не пропустил и не учел дважды изменения параллельного коммита
+_commit_lock = threading.RLock()
+
+# Строки заявок по id и активные заявки мастера по его id. Функции записи сбрасывают
+# измененные ключи после коммита (см. _invalidate_order)
+_orders_cache = LRUCache(ORDER_CACHE_SIZE, ORDER_CACHE_TTL)
+_active_cache = LRUCache(ORDER_CACHE_SIZE, ORDER_CACHE_TTL)
+
+# Если в базу пишут другие процессы (supervisor.py), перед чтением из кэша
+# проверяется PRAGMA data_version отдельного соединения
+_other_writers = False
+_version_lock = threading.Lock()
+_version_conn = None
+_data_version = None
+
+
+def configure(db_path, other_writers=False):
+    """Сменить файл базы данных (закрывает все открытые соединения).
+
+    other_writers=True - базу меняют и другие процессы: кэш заявок сбрасывается
+    после каждого коммита в базу, чьим бы он ни был."""
+    global DB_PATH, _category_labels, _other_writers
+    close_connections()
+    DB_PATH = db_path
+    _category_labels = None
+    _other_writers = other_writers
+    _clear_caches()
+
+
+def _connect(db_path):
+    conn = sqlite3.connect(
+        db_path,
+        timeout=BUSY_TIMEOUT,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        # Время каждого запроса и число строк попадают в метрики (см. metrics.py)
+        factory=metrics.TimedConnection if metrics.ENABLED else sqlite3.Connection,
+    )
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection():
+    """Соединение текущего потока, создается при первом обращении"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.generation != _generation:
+        conn = _connect(DB_PATH)
+        _local.conn = conn
+        _local.generation = _generation
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+
+def close_connections():
+    """Закрыть соединения всех потоков (при остановке бота или смене базы)"""
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        for conn in _connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _connections.clear()
+
+
+@contextmanager
+def _write_transaction():
+    """Транзакция на запись. BEGIN IMMEDIATE сразу берет блокировку записи,
+    поэтому конкурирующие писатели ждут busy_timeout, а не падают посреди транзакции.
+
+    Внутри write_batch() транзакция становится точкой сохранения: ошибка откатывает
+    только ее изменения, а коммит общий для всей пачки."""
+    conn = get_connection()
+    depth = getattr(_local, 'depth', 0)
+    if depth:
+        yield from _savepoint(conn, depth)
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    _local.after_commit = []
+    _local.depth = 1
+    try:
+        yield conn
+        with _commit_lock:
+            conn.execute("COMMIT")
+            for hook in _local.after_commit:
+                hook()
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        _local.after_commit = []
+        _local.depth = 0
+
+
+def _savepoint(conn, depth):
+    name = f"sp{depth}"
+    hooks_count = len(_local.after_commit)
+    conn.execute(f"SAVEPOINT {name}")
+    _local.depth = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        conn.execute(f"ROLLBACK TO {name}")
+        conn.execute(f"RELEASE {name}")
+        del _local.after_commit[hooks_count:]
+        raise
+    finally:
+        _local.depth = depth
+    conn.execute(f"RELEASE {name}")
+
+
+def write_batch():
+    """Выполнить несколько функций записи в одной транзакции с одним fsync (group commit)"""
+    return _write_transaction()
+
+
+# Режимы PRAGMA synchronous, которые принимает set_synchronous
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def set_synchronous(mode):
+    """Режим синхронизации соединения текущего потока: 'OFF', 'NORMAL' или 'FULL'"""
+    if mode.upper() not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Неизвестный режим synchronous: {mode}")
+    get_connection().execute(f"PRAGMA synchronous = {mode}")
+
+
+def _select(conn, row_type, sql, params=()):
+    """Выполнить SELECT, строки которого курсор вернет как row_type (см. models.py)"""
+    cursor = conn.execute(sql, params)
+    cursor.row_factory = _ROW_FACTORIES[row_type]
+    return cursor
+
+
+def _after_commit(hook):
+    """Выполнить hook после успешного коммита текущей транзакции"""
+    _local.after_commit.append(hook)
+
+
+def _clear_caches():
+    _orders_cache.clear()
+    _active_cache.clear()
+
+
+def _check_data_version():
+    """Сбросить кэши, если с прошлой проверки в базе был коммит.
+
+    data_version соединения меняется после коммита любого другого соединения,
+    поэтому проверочное соединение отдельное и само ничего не пишет."""
+    global _version_conn, _data_version
+    with _version_lock:
+        if _version_conn is None or _version_conn[1] != _generation:
+            # Обычное соединение без замеров в metrics: проверка идет перед каждым чтением из кэша
+            conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            with _connections_lock:
+                _connections.append(conn)
+            _version_conn = (conn, _generation)
+            _data_version = None
+        version = _version_conn[0].execute("PRAGMA data_version").fetchone()[0]
+        if version != _data_version:
+            _data_version = version
+            _clear_caches()
+
+
+def _cached(cache, key, load):
+    """Значение из cache, а при промахе - load(), которое запоминается (кроме None).
+
+    Внутри транзакции записи кэш не используется: кэш сбрасывается только после коммита,
+    поэтому он не видит незакоммиченных изменений, а прочитанное в транзакции может откатиться"""
+    if getattr(_local, 'depth', 0):
+        return load()
+    if _other_writers:
+        _check_data_version()
+    value = cache.get(key)
+    if value is None:
+        version = cache.version
+        value = load()
+        if value is not None:
+            cache.put(key, value, version)
+    return value
+
+
+def _invalidate_order(order_id, master_id):
+    """После коммита сбросить в кэше заявку и активные заявки ее мастера"""
+    def hook():
+        _orders_cache.invalidate(order_id)
+        if master_id is not None:
+            _active_cache.invalidate(master_id)
+    _after_commit(hook)
+
+
+def cache_stats():
+    """Попадания и промахи кэшей заявок"""
+    return {'orders': _orders_cache.stats(), 'active': _active_cache.stats()}
+
+
+def _count_transition(conn, old_status, new_status, category_id):
+    """Учесть в таблице order_counters смену статуса заявки (None - заявки не было).
+
+    Счетчики меняются в той же транзакции, что и заявка, поэтому их видят все процессы
+    и они не расходятся с заявками после сбоя."""
+    if old_status == new_status:
+        return
+    category_id = category_id or 0
+    if old_status is not None:
+        conn.execute("UPDATE order_counters SET count = count - 1 WHERE status = ? AND category_id = ?",
+                     (old_status, category_id))
+    conn.execute("INSERT INTO order_counters (status, category_id, count) VALUES (?, ?, 1) "
+                 "ON CONFLICT (status, category_id) DO UPDATE SET count = count + 1", (new_status, category_id))
+
+
+def _migrate(conn):
+    """Применить недостающие миграции схемы"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        for statement in statements:
+            if callable(statement):
+                statement(conn)
+            else:
+                conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {number}")
+
+
+def check_query_plans():
+    """Проверить, что горячие запросы не сканируют таблицу orders целиком.
+
+    Проход по частичному индексу допустим: он содержит только нужные строки.
+    Проходы по FTS5 и по небольшим подзапросам (SCAN found) не проверяются.
+    Возвращает список (имя запроса, строка плана) для остальных SCAN orders."""
+    conn = get_connection()
+    partial_indexes = {row[1] for row in conn.execute("PRAGMA index_list(orders)") if row[4]}
+    problems = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            detail = row[3]
+            if detail.split()[:2] != ['SCAN', 'orders']:
+                continue
+            index_name = detail.rsplit(' ', 1)[-1] if ' INDEX ' in detail else None
+            if index_name not in partial_indexes:
+                problems.append((name, detail))
+    return problems
+
+
+def init_db():
+    """Инициализация базы данных"""
+    with _write_transaction() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS orders (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     user_id INTEGER,
+                     username TEXT,
+                     category TEXT,
+                     description TEXT,
+                     contacts TEXT,
+                     status TEXT DEFAULT 'new',
+                     master_id INTEGER DEFAULT NULL,
+                     master_name TEXT DEFAULT NULL,
+                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        _migrate(conn)
+        _sync_categories(conn)
+    global _category_labels
+    _category_labels = None
+    logger.info("База данных инициализирована")
+
+
+# Названия категорий по id, загружаются из таблицы categories один раз на процесс
+_category_labels = None
+
+
+def get_category_labels():
+    """Словарь {id категории: название}"""
+    global _category_labels
+    labels = _category_labels
+    if labels is None:
+        conn = get_connection()
+        labels = _category_labels = dict(conn.execute("SELECT id, label FROM categories").fetchall())
+    return labels
 
 
-def save_order(user_id, username, category, description, contacts):
-    """Сохранение заявки в базу данных"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute("INSERT INTO orders (user_id, username, category, description, contacts) VALUES (?, ?, ?, ?, ?)",
-                (user_id, username, category, description, contacts))
-    conn.commit()
-    conn.close()
-    return cur.lastrowid  # Возвращаем ID созданной заявки
+def category_label(category_id):
+    """Название категории для показа пользователю"""
+    return get_category_labels().get(category_id, 'Не указана')
+
+
+def save_order(user_id, username, category_id, description, contacts, notify_chat_ids=()):
+    """Сохранение заявки в базу данных (category_id - id из app_constants.CATEGORIES).
+
+    Для каждого чата из notify_chat_ids в той же транзакции пишется уведомление в outbox,
+    поэтому уведомления не теряются, даже если бот упадет сразу после сохранения."""
+    with _write_transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO orders (user_id, username, category_id, description, contacts) VALUES (?, ?, ?, ?, ?)",
+            (user_id, username, category_id, description, contacts))
+        order_id = cur.lastrowid
+        if notify_chat_ids:
+            conn.executemany("INSERT INTO outbox (order_id, chat_id) VALUES (?, ?)",
+                             [(order_id, chat_id) for chat_id in notify_chat_ids])
+        _count_transition(conn, None, 'new', category_id)
+    return order_id  # Возвращаем ID созданной заявки
 
 
 def get_new_orders():
     """Получение ВСЕХ новых заявок"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM orders WHERE status = 'new' ORDER BY created_at ASC")
-    orders = cur.fetchall()
-    conn.close()
-    return orders
+    conn = get_connection()
+    sql, _ = HOT_QUERIES['new_orders']
+    return _select(conn, Order, sql).fetchall()
 
 
 def get_new_orders_by_category(category_key=None):
     """Получение новых заявок с фильтром по категории"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-
-    category_mapping = {
-        "plumbing": "Сантехника 🚿",
-        "electrical": "Электрика ⚡",
-        "appliances": "Бытовая техника 🌀",
-        "furniture": "Сборка мебели 🛋️",
-        "doors_windows": "Двери/Окна 🚪",
-        "other": "Прочее 🔧"
-    }
+    conn = get_connection()
+    suffix, params = _new_orders_filter(category_key)
+    sql, _ = HOT_QUERIES['new_orders' + suffix]
+    return _select(conn, Order, sql, params).fetchall()
+
 
+def _new_orders_filter(category_key):
+    """Суффикс имени запроса в HOT_QUERIES и его параметры для категории"""
     if category_key and category_key != "all":
-        category_name = category_mapping.get(category_key, category_key)
-        cur.execute("SELECT * FROM orders WHERE status = 'new' AND category = ? ORDER BY created_at ASC",
-                    (category_name,))
-    else:
-        cur.execute("SELECT * FROM orders WHERE status = 'new' ORDER BY created_at ASC")
+        return "_by_category", (CATEGORY_IDS.get(category_key, 0),)
+    return "", ()
+
 
-    orders = cur.fetchall()
-    conn.close()
-    return orders
+def get_new_order_near(category_key=None, order_id=None, step=0):
+    """Новая заявка (OrderCard) рядом с order_id в порядке (created_at, id).
+
+    step=1 - следующая, step=-1 - предыдущая, step=0 - сама заявка или следующая,
+    если ее уже взяли. После последней заявки возвращается первая и наоборот."""
+    conn = get_connection()
+    suffix, params = _new_orders_filter(category_key)
+
+    anchor = None
+    if order_id is not None:
+        sql, _ = HOT_QUERIES['order_anchor']
+        anchor = conn.execute(sql, (order_id,)).fetchone()
+    if anchor:
+        name, _, _ = _NEW_ORDER_STEPS[(step > 0) - (step < 0)]
+        sql, _ = HOT_QUERIES[f'new_order_{name}{suffix}']
+        order = _select(conn, OrderCard, sql, (*params, *anchor)).fetchone()
+        if order:
+            return order
+
+    sql, _ = HOT_QUERIES[f"new_order_{'last' if step < 0 else 'first'}{suffix}"]
+    return _select(conn, OrderCard, sql, params).fetchone()
+
+
+def get_new_order_position(order, category_key=None):
+    """Порядковый номер новой заявки в списке (начиная с 1)"""
+    conn = get_connection()
+    suffix, params = _new_orders_filter(category_key)
+    sql, _ = HOT_QUERIES['new_order_position' + suffix]
+    cur = conn.execute(sql, (*params, order.created_at, order.id))
+    return cur.fetchone()[0] + 1
 
 
 def get_order_by_id(order_id):
-    """Получение заявки по ID"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM orders WHERE id = ?", (order_id,))
-    order = cur.fetchone()
-    conn.close()
-    return order
+    """Получение заявки по ID, в том числе из архива (через кэш заявок)"""
+    def load():
+        sql, _ = HOT_QUERIES['order_by_id']
+        return _select(get_connection(), Order, sql, (order_id,)).fetchone()
+    return _cached(_orders_cache, order_id, load)
 
 
-def update_order_status(order_id, status):
-    """Обновление статуса заявки"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute("UPDATE orders SET status = ? WHERE id = ?", (status, order_id))
-    conn.commit()
-    conn.close()
+def get_order_card(order_id):
+    """Заявка по ID в виде OrderCard"""
+    order = get_order_by_id(order_id)
+    if order is None:
+        return None
+    return OrderCard._make(getattr(order, field) for field in OrderCard._fields)
 
 
-def get_orders_stats():
-    """Получение статистики по заявкам"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
+def _set_status(conn, order_id, status, assignments="", params=()):
+    """Сменить статус заявки внутри транзакции и учесть это в счетчиках и финансовых сводках"""
+    row = conn.execute("SELECT status, category_id, master_id, master_name, date(COALESCE(completed_at, created_at)) "
+                       "FROM orders WHERE id = ?", (order_id,)).fetchone()
+    if status == 'completed':
+        assignments += ", completed_at = CURRENT_TIMESTAMP"
+    elif status == 'in_progress':
+        assignments += ", assigned_at = CURRENT_TIMESTAMP"
+    conn.execute(f"UPDATE orders SET status = ?{assignments} WHERE id = ?", (status, *params, order_id))
+    if not row:
+        return
+    old_status, category_id, master_id, master_name, completed_day = row
+    _invalidate_order(order_id, master_id)
+    _count_transition(conn, old_status, status, category_id)
+    if status == 'completed' and old_status != 'completed':
+        _add_completed(conn, master_id, master_name, category_id, None, 1)
+    elif old_status == 'completed' and status != 'completed':
+        _add_completed(conn, master_id, master_name, category_id, completed_day, -1)
 
-    cur.execute("SELECT COUNT(*) FROM orders")
-    total = cur.fetchone()[0] or 0
 
-    cur.execute("SELECT COUNT(*) FROM orders WHERE status = 'new'")
-    new = cur.fetchone()[0] or 0
+def _add_completed(conn, master_id, master_name, category_id, day, delta):
+    """Изменить финансовые сводки на delta завершенных заявок (day=None - сегодня).
+    Заявка без мастера или без категории учитывается под 0, как в REBUILD_ROLLUPS"""
+    master_id = master_id or 0
+    category_id = category_id or 0
+    conn.execute("INSERT INTO finance_rollup (master_id, day, category_id, completed) "
+                 "VALUES (?, COALESCE(?, date('now')), ?, ?) "
+                 "ON CONFLICT (master_id, day, category_id) DO UPDATE SET completed = completed + excluded.completed",
+                 (master_id, day, category_id, delta))
+    conn.execute("INSERT INTO master_earnings (master_id, master_name, completed) VALUES (?, ?, ?) "
+                 "ON CONFLICT (master_id) DO UPDATE SET completed = completed + excluded.completed, "
+                 "master_name = COALESCE(excluded.master_name, master_name)",
+                 (master_id, master_name, delta))
 
-    cur.execute("SELECT COUNT(*) FROM orders WHERE status = 'in_progress'")
-    in_progress = cur.fetchone()[0] or 0
 
-    cur.execute("SELECT COUNT(*) FROM orders WHERE status = 'completed'")
-    completed = cur.fetchone()[0] or 0
+def update_order_status(order_id, status):
+    """Обновление статуса заявки"""
+    with _write_transaction() as conn:
+        _set_status(conn, order_id, status)
+
 
-    conn.close()
+def get_orders_summary():
+    """Сводка по заявкам: количество по статусам и новых заявок по категориям.
 
+    Читает несколько строк order_counters, которые поддерживают функции записи."""
+    conn = get_connection()
+    total = 0
+    by_status = {}
+    new_by_category = {}
+    for status, category_id, count in conn.execute("SELECT status, category_id, count FROM order_counters"):
+        total += count
+        by_status[status] = by_status.get(status, 0) + count
+        if status == 'new':
+            new_by_category[category_id] = count
     return {
         'total': total,
-        'new': new,
-        'in_progress': in_progress,
-        'completed': completed
+        'new': by_status.get('new', 0),
+        'in_progress': by_status.get('in_progress', 0),
+        'completed': by_status.get('completed', 0),
+        'by_category': {key: new_by_category.get(category_id, 0) for key, category_id in CATEGORY_IDS.items()},
     }
 
 
+def get_orders_stats():
+    """Получение статистики по заявкам"""
+    summary = get_orders_summary()
+    del summary['by_category']
+    return summary
+
+
 def get_orders_count_by_category(category_key):
     """Получение количества новых заявок по категории"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-
-    category_mapping = {
-        "plumbing": "Сантехника 🚿",
-        "electrical": "Электрика ⚡",
-        "appliances": "Бытовая техника 🌀",
-        "furniture": "Сборка мебели 🛋️",
-        "doors_windows": "Двери/Окна 🚪",
-        "other": "Прочее 🔧"
-    }
-
-    category_name = category_mapping.get(category_key, category_key)
-    cur.execute("SELECT COUNT(*) FROM orders WHERE status = 'new' AND category = ?", (category_name,))
-    count = cur.fetchone()[0] or 0
-    conn.close()
-    return count
+    return get_orders_summary()['by_category'].get(category_key, 0)
 
 
 def get_master_active_orders(master_id):
-    """Получение активных заявок мастера"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM orders WHERE master_id = ? AND status = 'in_progress'", (master_id,))
-    orders = cur.fetchall()
-    conn.close()
-    return orders
+    """Получение активных заявок мастера (через кэш)"""
+    def load():
+        sql, _ = HOT_QUERIES['master_active_orders']
+        return tuple(_select(get_connection(), OrderCard, sql, (master_id,)))
+    return list(_cached(_active_cache, master_id, load))
+
+
+def claim_order(order_id, master_id, master_name):
+    """Взять новую заявку в работу одним условным UPDATE.
+
+    Заявка достается мастеру, только если она еще новая и у мастера нет другой
+    заявки в работе, поэтому из нескольких одновременных нажатий выигрывает одно.
+    Возвращает CLAIM_WON, CLAIM_LOST или CLAIM_BUSY."""
+    with _write_transaction() as conn:
+        rows = conn.execute(
+            "UPDATE orders SET status = 'in_progress', master_id = ?, master_name = ?, assigned_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status = 'new' "
+            "AND NOT EXISTS (SELECT 1 FROM orders WHERE master_id = ? AND status = 'in_progress') "
+            "RETURNING category_id",
+            (master_id, master_name, order_id, master_id)).fetchall()
+        if rows:
+            _count_transition(conn, 'new', 'in_progress', rows[0][0])
+            _invalidate_order(order_id, master_id)
+            return CLAIM_WON
+        busy = conn.execute("SELECT 1 FROM orders WHERE master_id = ? AND status = 'in_progress' LIMIT 1",
+                            (master_id,)).fetchone()
+    return CLAIM_BUSY if busy else CLAIM_LOST
 
 
 def assign_order_to_master(order_id, master_id, master_name):
     """Назначение заявки мастеру"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute("UPDATE orders SET status = 'in_progress', master_id = ?, master_name = ? WHERE id = ?",
-                (master_id, master_name, order_id))
-    conn.commit()
-    conn.close()
-    return True
+    return claim_order(order_id, master_id, master_name) == CLAIM_WON
 
 
 def complete_order(order_id):
     """Завершение заявки"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute("UPDATE orders SET status = 'completed' WHERE id = ?", (order_id,))
-    conn.commit()
-    conn.close()
+    with _write_transaction() as conn:
+        _set_status(conn, order_id, 'completed')
 
 
 def get_completed_orders_with_master():
-    """Получить все завершенные заказы с информацией о мастере"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, master_id, master_name, category, created_at FROM orders WHERE status = 'completed' ORDER BY created_at DESC")
-    orders = cur.fetchall()
-    conn.close()
-    return orders
+    """Получить все завершенные заказы с информацией о мастере, включая архив"""
+    conn = get_connection()
+    return _select(conn, CompletedOrder, f"SELECT {COMPLETED_COLUMNS} FROM orders_all WHERE status = 'completed' "
+                   "ORDER BY created_at DESC").fetchall()
 
 
 def get_master_earnings(master_id):
     """Получить статистику заработка мастера"""
-    conn = sqlite3.connect('orders.db')
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM orders WHERE master_id = ? AND status = 'completed'", (master_id,))
-    stats = cur.fetchone()[0] or 0
-    conn.close()
-    return stats
+    conn = get_connection()
+    row = conn.execute("SELECT completed FROM master_earnings WHERE master_id = ?", (master_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def get_recent_completed_orders(limit=5):
+    """Последние завершенные заказы (CompletedOrder), включая архив"""
+    conn = get_connection()
+    sql, _ = HOT_QUERIES['recent_completed_orders']
+    return _select(conn, CompletedOrder, sql, (limit,)).fetchall()
+
+
+def get_finance_summary():
+    """Итоги по завершенным заказам из сводной таблицы: всего и по мастерам"""
+    conn = get_connection()
+    by_master = conn.execute("SELECT master_id, master_name, completed FROM master_earnings "
+                             "WHERE completed > 0 ORDER BY completed DESC").fetchall()
+    return {
+        'total': sum(row[2] for row in by_master),
+        'by_master': by_master,
+    }
+
+
+def get_finance_by_day(since_day):
+    """Завершенные заказы по дням и категориям начиная с since_day ('YYYY-MM-DD')"""
+    conn = get_connection()
+    return conn.execute("SELECT day, category_id, SUM(completed) FROM finance_rollup WHERE day >= ? "
+                        "GROUP BY day, category_id ORDER BY day, category_id", (since_day,)).fetchall()
+
+
+def rebuild_finance_rollups():
+    """Пересобрать финансовые сводки по всей истории заявок, включая архив"""
+    with _write_transaction() as conn:
+        for statement in REBUILD_ROLLUPS:
+            conn.execute(statement.format(orders='orders_all'))
+
+
+def archive_orders(completed_before, limit):
+    """Перенести до limit заявок, завершенных раньше completed_before ('YYYY-MM-DD HH:MM:SS'),
+    из orders в orders_archive. Возвращает число перенесенных заявок.
+
+    Одна короткая транзакция на пачку: блокировка записи держится, пока переносится limit строк.
+    Счетчики order_counters и финансовые сводки не меняются - заявки остаются завершенными,
+    а из поиска (orders_fts) архивные заявки уходят вместе со строкой orders."""
+    with _write_transaction() as conn:
+        sql, _ = HOT_QUERIES['archive_candidates']
+        ids = [row[0] for row in conn.execute(sql, (completed_before, limit)).fetchall()]
+        if not ids:
+            return 0
+        placeholders = ", ".join("?" * len(ids))
+        conn.execute(f"INSERT INTO orders_archive ({ORDER_COLUMNS}) "
+                     f"SELECT {ORDER_COLUMNS} FROM orders WHERE id IN ({placeholders})", ids)
+        conn.execute(f"DELETE FROM orders WHERE id IN ({placeholders})", ids)
+    return len(ids)
+
+
+def free_pages():
+    """(свободные страницы файла базы, размер страницы в байтах, включен ли incremental_vacuum)"""
+    conn = get_connection()
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    incremental = conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    return free, page_size, incremental
+
+
+def incremental_vacuum(pages):
+    """Вернуть системе до pages свободных страниц с конца файла (нужен auto_vacuum = INCREMENTAL)"""
+    with _write_transaction() as conn:
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+
+
+def vacuum():
+    """Полный VACUUM: пересобирает файл и включает режим auto_vacuum = INCREMENTAL.
+
+    Пока он идет, запись в базу ждет, поэтому запускать его нужно вручную (manage.py vacuum)."""
+    conn = get_connection()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+
+def claim_outbox_batch(limit):
+    """Забрать до limit готовых к отправке уведомлений: (id, order_id, chat_id, attempts)"""
+    with _write_transaction() as conn:
+        return conn.execute(
+            "UPDATE outbox SET status = 'sending', attempts = attempts + 1 "
+            "WHERE id IN (SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+            "ORDER BY next_attempt_at LIMIT ?) "
+            "RETURNING id, order_id, chat_id, attempts", (time.time(), limit)).fetchall()
+
+
+def finish_outbox_batch(sent_ids, retries, failed_ids):
+    """Отметить результат отправки: доставленные, отложенные [(id, next_attempt_at)] и брошенные"""
+    with _write_transaction() as conn:
+        conn.executemany("UPDATE outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP WHERE id = ?",
+                         [(outbox_id,) for outbox_id in sent_ids])
+        conn.executemany("UPDATE outbox SET status = 'pending', next_attempt_at = ? WHERE id = ?",
+                         [(retry_at, outbox_id) for outbox_id, retry_at in retries])
+        conn.executemany("UPDATE outbox SET status = 'failed' WHERE id = ?",
+                         [(outbox_id,) for outbox_id in failed_ids])
+
+
+def release_outbox():
+    """Вернуть в очередь уведомления, которые отправлялись в момент остановки бота"""
+    with _write_transaction() as conn:
+        return conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'").rowcount
+
+
+def get_orders_by_ids(order_ids):
+    """Получение нескольких заявок по ID (OrderCard)"""
+    conn = get_connection()
+    placeholders = ", ".join("?" * len(order_ids))
+    return _select(conn, OrderCard, f"SELECT {CARD_COLUMNS} FROM orders WHERE id IN ({placeholders})",
+                   tuple(order_ids)).fetchall()
+
+
+def get_open_order_times():
+    """Новые заявки и заявки в работе (OrderTimes) и наибольший id заявки - для загрузки sla.py"""
+    conn = get_connection()
+    orders = []
+    for name in ('sla_new_orders', 'sla_in_progress_orders'):
+        sql, _ = HOT_QUERIES[name]
+        orders.extend(_select(conn, OrderTimes, sql))
+    last_id = conn.execute("SELECT MAX(id) FROM orders").fetchone()[0] or 0
+    return orders, last_id
+
+
+def get_order_times(order_ids):
+    """Заявки по ID (OrderTimes), только из orders: архивные заявки завершены"""
+    conn = get_connection()
+    placeholders = ", ".join("?" * len(order_ids))
+    return _select(conn, OrderTimes, f"SELECT {TIMES_COLUMNS} FROM orders WHERE id IN ({placeholders})",
+                   tuple(order_ids)).fetchall()
+
+
+def get_order_times_after(after_id, limit):
+    """Заявки (OrderTimes) с id больше after_id по возрастанию id: новые заявки других процессов"""
+    return _select(get_connection(), OrderTimes, f"SELECT {TIMES_COLUMNS} FROM orders WHERE id > ? ORDER BY id LIMIT ?",
+                   (after_id, limit)).fetchall()
+
+
+def set_master_skills(master_id, master_name, category_ids):
+    """Категории, заявки которых предлагаются мастеру автоматически (пустой список - не предлагать)"""
+    with _write_transaction() as conn:
+        conn.execute("DELETE FROM master_skills WHERE master_id = ?", (master_id,))
+        conn.executemany("INSERT INTO master_skills (master_id, category_id, master_name) VALUES (?, ?, ?)",
+                         [(master_id, category_id, master_name) for category_id in category_ids])
+
+
+def get_master_categories(master_id):
+    """id категорий, заявки которых предлагаются мастеру"""
+    conn = get_connection()
+    return [row[0] for row in conn.execute(
+        "SELECT category_id FROM master_skills WHERE master_id = ? ORDER BY category_id", (master_id,))]
+
+
+def get_master_skills():
+    """Все мастера, включившие авто-распределение: [(master_id, master_name, category_id)]"""
+    conn = get_connection()
+    return conn.execute("SELECT master_id, master_name, category_id FROM master_skills").fetchall()
+
+
+def get_busy_masters():
+    """Мастера с заявкой в работе или с предложением, на которое они еще не ответили"""
+    sql, _ = HOT_QUERIES['busy_masters']
+    return {row[0] for row in get_connection().execute(sql)}
+
+
+def get_undispatched_orders(after, limit):
+    """Новые заявки без ожидающего ответа предложения в порядке поступления,
+    начиная после after = (created_at, id): [(id, category_id, created_at)]"""
+    sql, _ = HOT_QUERIES['undispatched_orders']
+    return get_connection().execute(sql, (*after, limit)).fetchall()
+
+
+def get_offered_masters(order_ids):
+    """Кому уже предлагались заявки: {order_id: {master_id, ...}}"""
+    order_ids = list(order_ids)
+    offered = {}
+    if not order_ids:
+        return offered
+    placeholders = ", ".join("?" * len(order_ids))
+    for order_id, master_id in get_connection().execute(
+            f"SELECT order_id, master_id FROM dispatch_offers WHERE order_id IN ({placeholders})", order_ids):
+        offered.setdefault(order_id, set()).add(master_id)
+    return offered
+
+
+def create_offers(offers, expires_at):
+    """Записать предложения [(order_id, master_id)], действующие до expires_at (unix-время)"""
+    with _write_transaction() as conn:
+        conn.executemany("INSERT INTO dispatch_offers (order_id, master_id, expires_at) VALUES (?, ?, ?)",
+                         [(order_id, master_id, expires_at) for order_id, master_id in offers])
+
+
+def expire_offers(now):
+    """Закрыть просроченные предложения и предложения заявок, которые уже взяли. Возвращает число просроченных"""
+    conn = get_connection()
+    if not conn.execute("SELECT 1 FROM dispatch_offers WHERE status = 'pending' LIMIT 1").fetchone():
+        return 0
+    with _write_transaction() as conn:
+        expired = conn.execute("UPDATE dispatch_offers SET status = 'expired' WHERE status = 'pending' "
+                               "AND expires_at <= ?", (now,)).rowcount
+        conn.execute("UPDATE dispatch_offers SET status = 'lost' WHERE status = 'pending' AND NOT EXISTS "
+                     "(SELECT 1 FROM orders WHERE orders.id = dispatch_offers.order_id AND orders.status = 'new')")
+    return expired
+
+
+def answer_offer(order_id, master_id, master_name, accept):
+    """Ответ мастера на предложение заявки.
+
+    Согласие берет заявку через claim_order в той же транзакции и возвращает его результат,
+    отказ - OFFER_DECLINED. Если предложение уже не ждет ответа - OFFER_EXPIRED."""
+    with _write_transaction() as conn:
+        row = conn.execute("SELECT id FROM dispatch_offers WHERE order_id = ? AND master_id = ? "
+                           "AND status = 'pending' AND expires_at > ?", (order_id, master_id, time.time())).fetchone()
+        if row is None:
+            return OFFER_EXPIRED
+        if not accept:
+            conn.execute("UPDATE dispatch_offers SET status = 'declined' WHERE id = ?", row)
+            return OFFER_DECLINED
+        result = claim_order(order_id, master_id, master_name)
+        conn.execute("UPDATE dispatch_offers SET status = ? WHERE id = ?",
+                     ('accepted' if result == CLAIM_WON else 'lost', row[0]))
+    return result
+
+
+def search_query(text):
+    """Выражение MATCH для FTS5 из текста запроса: должны встретиться все слова,
+    каждое как префикс (кроме коротких). Пустая строка, если слов нет"""
+    terms = _SEARCH_TERM.findall(text.lower().replace('ё', 'е'))[:MAX_SEARCH_TERMS]
+    return " ".join(f'"{term}"*' if len(term) >= MIN_PREFIX_LENGTH else f'"{term}"' for term in terms)
+
+
+def phone_query(text):
+    """Выражение MATCH для поиска по телефону: цифры запроса без разделителей
+    ('905 123-45' -> '"90512345"'). Пустая строка, если в запросе есть буквы или цифр меньше трех"""
+    if any(char.isalpha() for char in text):
+        return ""
+    digits = _NON_DIGITS.sub("", text)
+    return f'"{digits}"' if len(digits) >= MIN_PREFIX_LENGTH else ""
+
+
+def search_orders(text, limit, offset=0):
+    """Заявки (OrderCard), подходящие под запрос, от самых релевантных (bm25)
+    среди SEARCH_COUNT_LIMIT самых новых совпадений.
+
+    Запрос из одних цифр и разделителей ищется еще и как фрагмент телефона в контактах,
+    такие результаты идут от новых заявок к старым.
+    Возвращает (заявки, всего найдено), всего - не больше SEARCH_COUNT_LIMIT."""
+    match = search_query(text)
+    if not match:
+        return [], 0
+    conn = get_connection()
+    phone = phone_query(text)
+    if phone:
+        sql, _ = HOT_QUERIES['search_orders_phone']
+        orders = _select(conn, OrderCard, sql, (phone, match, SEARCH_COUNT_LIMIT, limit, offset)).fetchall()
+        total = conn.execute("SELECT COUNT(*) FROM (SELECT rowid FROM orders_phone_fts WHERE orders_phone_fts MATCH ?1 "
+                             "UNION SELECT rowid FROM orders_fts WHERE orders_fts MATCH ?2 ORDER BY rowid DESC LIMIT ?3)",
+                             (phone, match, SEARCH_COUNT_LIMIT)).fetchone()[0]
+        return orders, total
+    sql, _ = HOT_QUERIES['search_orders']
+    orders = _select(conn, OrderCard, sql, (match, SEARCH_COUNT_LIMIT, limit, offset)).fetchall()
+    total = conn.execute("SELECT COUNT(*) FROM (SELECT 1 FROM orders_fts WHERE orders_fts MATCH ? "
+                         "ORDER BY rowid DESC LIMIT ?)", (match, SEARCH_COUNT_LIMIT)).fetchone()[0]
+    return orders, total
+
+
+def save_conversations(saved, deleted, expired_before):
+    """Записать состояния диалогов [(user_id, state, category, description, updated_at)],
+    удалить завершенные и устаревшие"""
+    with _write_transaction() as conn:
+        conn.executemany("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?)", saved)
+        conn.executemany("DELETE FROM conversations WHERE user_id = ?", [(user_id,) for user_id in deleted])
+        conn.execute("DELETE FROM conversations WHERE updated_at < ?", (expired_before,))
+
+
+def load_conversation(user_id, updated_after):
+    """Состояние диалога пользователя: (state, category, description, updated_at)"""
+    conn = get_connection()
+    return conn.execute("SELECT state, category, description, updated_at FROM conversations "
+                        "WHERE user_id = ? AND updated_at >= ?", (user_id, updated_after)).fetchone()
+
+
+def load_conversations(updated_after, limit):
+    """Самые свежие состояния диалогов, от новых к старым"""
+    conn = get_connection()
+    return conn.execute("SELECT user_id, state, category, description, updated_at FROM conversations "
+                        "WHERE updated_at >= ? ORDER BY updated_at DESC LIMIT ?", (updated_after, limit)).fetchall()
@@ -0,0 +1,182 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Запись пачками (см. DatabaseExecutor): DB_BATCH_SIZE=1 - каждая запись в своей транзакции.
+# DB_SYNCHRONOUS - режим fsync потока записи (FULL, NORMAL, OFF), по умолчанию NORMAL из database.PRAGMAS
+DB_BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', '100'))
+DB_BATCH_WINDOW = float(os.getenv('DB_BATCH_WINDOW_MS', '2')) / 1000
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS') or None
+
+
+class _Pool:
+    """Очередь задач и потоки, которые ее разбирают"""
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, fn, args, kwargs):
+        future = Future()
+        self.queue.put((fn, args, kwargs, future, time.perf_counter()))
+        return future
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f"{self.name}-{number}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            fn, args, kwargs, future, enqueued_at = job
+            self.record_wait(time.perf_counter() - enqueued_at)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def record_wait(self, wait):
+        with self.lock:
+            self.completed += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'completed': self.completed,
+                'avg_wait': self.wait_total / self.completed if self.completed else 0.0,
+                'max_wait': self.wait_max,
+            }
+
+
+class _BatchWriter(_Pool):
+    """Поток записи с group commit: задачи, накопившиеся за batch_window секунд
+    (но не больше batch_size), выполняются в одной транзакции. Каждая задача
+    получает свой результат, ошибка одной задачи откатывает только ее изменения."""
+
+    def __init__(self, batch_size, batch_window, synchronous):
+        if synchronous is not None and synchronous.upper() not in database.SYNCHRONOUS_MODES:
+            # В потоке записи ошибка остановила бы его молча, поэтому режим проверяется сразу
+            raise ValueError(f"Неизвестный режим synchronous: {synchronous}")
+        super().__init__("db-writer", 1)
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.synchronous = synchronous
+        self.batches = 0
+
+    def run(self):
+        if self.synchronous:
+            database.set_synchronous(self.synchronous)
+        stopping = False
+        while not stopping:
+            job = self.queue.get()
+            if job is None:
+                return
+            jobs = [job]
+            deadline = time.perf_counter() + self.batch_window
+            while len(jobs) < self.batch_size:
+                try:
+                    job = self.queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                jobs.append(job)
+            self.execute(jobs)
+
+    def execute(self, jobs):
+        started = time.perf_counter()
+        results = []
+        try:
+            with database.write_batch():
+                for fn, args, kwargs, future, enqueued_at in jobs:
+                    self.record_wait(started - enqueued_at)
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        results.append((future, fn(*args, **kwargs)))
+                    except Exception as e:
+                        future.set_exception(e)
+        except BaseException as e:
+            # Не удался сам коммит: ни одна задача пачки не сохранена
+            for future, _ in results:
+                future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        with self.lock:
+            self.batches += 1
+        # Результаты отдаются только после коммита
+        for future, result in results:
+            future.set_result(result)
+
+    def stats(self):
+        stats = super().stats()
+        with self.lock:
+            stats['batches'] = self.batches
+            stats['avg_batch'] = self.completed / self.batches if self.batches else 0.0
+        return stats
+
+
+class DatabaseExecutor:
+    """Выполнение функций database.py вне потоков диспетчера.
+
+    Чтение идет в пул потоков, у каждого свое соединение, и в режиме WAL они работают
+    параллельно. Запись выполняет один поток по очереди - так SQLite не упирается
+    в блокировку и не отвечает "database is locked". Оба метода возвращают Future.
+
+    Записи объединяются в пачки (см. _BatchWriter): batch_size=1 отключает объединение,
+    synchronous задает режим fsync ('FULL' - каждый коммит переживет отключение питания,
+    'NORMAL' - может потеряться последний коммит, 'OFF' - только для тестов)."""
+
+    def __init__(self, readers=4, batch_size=100, batch_window=0.002, synchronous=None):
+        self._readers = _Pool("db-reader", readers)
+        self._writer = _BatchWriter(batch_size, batch_window, synchronous)
+
+    def start(self):
+        self._readers.start()
+        self._writer.start()
+
+    def shutdown(self):
+        """Выполнить уже поставленные задачи и остановить потоки"""
+        self._writer.stop()
+        self._readers.stop()
+
+    def read(self, fn, *args, **kwargs):
+        return self._readers.submit(fn, args, kwargs)
+
+    def write(self, fn, *args, **kwargs):
+        return self._writer.submit(fn, args, kwargs)
+
+    def stats(self):
+        """Глубина очередей и время ожидания в них - признак насыщения"""
+        return {'read': self._readers.stats(), 'write': self._writer.stats()}
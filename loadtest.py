@@ -0,0 +1,925 @@
+"""Нагрузочный прогон обработчиков bot.py без Telegram.
+
+Поддельные Update/CallbackContext/Bot проигрывают сценарии клиентов
+(/start -> категория -> описание -> контакты) и мастеров (/admin, листание заявок,
+взять, /complete) на временной базе, число потоков растет ступенями.
+По каждой ступени печатаются пропускная способность, p50/p95/p99 по шагам и размер базы.
+
+    python loadtest.py --threads 1,4,16 --sessions 200 --preload 1000
+
+С --ingress вместо сценариев замеряется прием обновлений /start через поддельный
+Bot API: long polling против webhook (ShardedUpdateQueue), --api-latency задает
+задержку ответа на sendMessage:
+
+    python loadtest.py --ingress webhook --updates 2000 --workers 8 --api-latency 50
+
+С --dispatch проигрывается авто-распределение (auto_dispatch.py): заявки поступают
+с частотой --rate, мастера отвечают на предложения с задержкой, иногда отказываются
+или молчат; печатается время от записи заявки до ее принятия мастером:
+
+    python loadtest.py --dispatch --orders 3000 --masters 300 --rate 100 --offer-timeout 2
+
+С --conversations замеряется память на состояния диалогов --users клиентов, остановившихся
+на шаге контактов: словари user_states/user_data, как было до state_store.py, против
+ConversationStore без предела и с пределом MAX_CONVERSATIONS:
+
+    python loadtest.py --conversations --users 1000000
+
+С --codec сравнивается разбор нажатий: шаблоны CallbackQueryHandler и цепочка if/elif
+из bot.py до callbacks.py против callbacks.decode() и CallbackRouter, --callbacks нажатий:
+
+    python loadtest.py --codec --callbacks 1000000
+
+С --writes замеряется запись заявок (save_order) через DatabaseExecutor: --clients
+клиентов ждут каждый своей записи, для каждого размера пачки из --batch-sizes печатается
+число записей в секунду; --synchronous задает режим fsync писателя:
+
+    python loadtest.py --writes --batch-sizes 1,10,100 --orders 5000 --synchronous FULL
+
+С --logging сравнивается, сколько стоит журнал одной новой заявки в потоке обработчика:
+восемь print(), как было до app_logging.py, против записи через очередь в JSON при
+включенном и выключенном уровне INFO (вывод в --log-output, по умолчанию os.devnull):
+
+    python loadtest.py --logging --orders 100000
+
+С --rows замеряются время и память на выборку --orders заявок: кортежи SELECT *, как
+было до models.py, против строк Order и OrderCard со списком нужных столбцов:
+
+    python loadtest.py --rows --orders 100000
+
+С --search замеряется /search: база наполняется до каждого размера из --search-sizes,
+и для нескольких запросов печатается время search_orders (FTS5) и того же поиска
+сканированием LIKE '%…%':
+
+    python loadtest.py --search --search-sizes 10000,100000,1000000
+
+При одинаковых параметрах и --seed сценарии повторяются, так что цифры
+разных версий database.py можно сравнивать между собой."""
+import argparse
+import gc
+import heapq
+import http.client
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+OFFLINE_TOKEN = '123456:offline'
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # Токен не нужен: запросы к Telegram заменены поддельным ботом
+    sys.modules['config'] = types.SimpleNamespace(BOT_TOKEN=OFFLINE_TOKEN)
+
+import app_logging
+import bot
+import state_store
+import callbacks
+import database
+import metrics
+from app_constants import CATEGORY_IDS, REPAIR_CATEGORIES
+from auto_dispatch import AutoDispatcher
+from db_executor import DatabaseExecutor
+from models import Order, OrderCard
+from notifier import Notifier, OutboxWorker
+from telegram import Bot
+from telegram.ext import Updater
+from telegram.utils.request import Request
+from webhook import SECRET_HEADER, ShardedUpdateQueue, start_webhook_server
+
+FIRST_MASTER_ID = 1_000_000
+FIRST_CUSTOMER_ID = 2_000_000
+
+
+class FakeBot:
+    """Bot, который только считает вызовы"""
+    id = 1
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, parse_mode=None, **kwargs):
+        with self._lock:
+            self.calls += 1
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = f"User{user_id}"
+        self.username = f"user{user_id}"
+
+
+class FakeMessage:
+    def __init__(self, chat_id, text, message_id=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.replies = []
+
+    def reply_text(self, text, reply_markup=None, parse_mode=None, **kwargs):
+        self.replies.append((text, reply_markup))
+
+
+class FakeCallbackQuery:
+    def __init__(self, chat_id, data, message_id):
+        self.data = data
+        self.message = FakeMessage(chat_id, None, message_id)
+        self.answers = []
+        self.edits = []
+
+    def answer(self, text=None, show_alert=False, **kwargs):
+        self.answers.append(text)
+
+    def edit_message_text(self, text, reply_markup=None, parse_mode=None, **kwargs):
+        self.edits.append((text, reply_markup))
+
+
+class FakeUpdate:
+    def __init__(self, user, message=None, callback_query=None):
+        self.effective_user = user
+        self.effective_chat = types.SimpleNamespace(id=user.id)
+        self.message = message
+        self.callback_query = callback_query
+
+
+class FakeContext:
+    def __init__(self, fake_bot, user_data):
+        self.bot = fake_bot
+        self.user_data = user_data
+        self.job_queue = None
+
+
+_message_ids = itertools.count(1)
+
+
+class Session:
+    """Один пользователь: отправляет команды, текст и нажатия, замеряя каждый шаг"""
+
+    def __init__(self, runner, user_id):
+        self.runner = runner
+        self.user = FakeUser(user_id)
+        self.user_data = {}
+        # Кнопки сценария находятся в одном сообщении: в ответе на /admin или /start
+        self.message_id = next(_message_ids)
+
+    def _run(self, step, handler, update):
+        started = time.perf_counter()
+        handler(update, FakeContext(self.runner.bot, self.user_data))
+        self.runner.record(step, time.perf_counter() - started)
+        return update
+
+    def text(self, step, handler, text):
+        return self._run(step, handler, FakeUpdate(self.user, message=FakeMessage(self.user.id, text)))
+
+    def press(self, step, action, order_id=0, category="all"):
+        data = callbacks.encode(action, order_id, category)
+        query = FakeCallbackQuery(self.user.id, data, self.message_id)
+        return self._run(step, bot.callback_router, FakeUpdate(self.user, callback_query=query))
+
+
+def customer_session(session, rng):
+    category = rng.choice(list(REPAIR_CATEGORIES))
+    session.text("start", bot.start_command, "/start")
+    session.press("pick_category", callbacks.PICK_CATEGORY, category=category)
+    session.text("description", bot.handle_text_messages, "Течет кран на кухне, " + "подробности " * rng.randint(1, 20))
+    session.text("contacts", bot.handle_text_messages, f"+7 900 {rng.randint(1000000, 9999999)}, ул. Ленина, д. 10")
+
+
+def master_session(session, rng):
+    category = rng.choice(["all", *REPAIR_CATEGORIES])
+    session.text("admin", bot.admin_command, "/admin")
+    session.press("admin_categories", callbacks.ADMIN_CATEGORIES)
+    session.press("show_orders", callbacks.SHOW_ORDERS, category=category)
+    for _ in range(rng.randint(1, 5)):
+        action = callbacks.NEXT_ORDER if rng.random() < 0.7 else callbacks.PREV_ORDER
+        step = "next_order" if action == callbacks.NEXT_ORDER else "prev_order"
+        session.press(step, action, session.user_data.get('current_order_id', 0), category)
+    order_id = session.user_data.get('current_order_id')
+    if order_id:
+        session.press("take_order", callbacks.TAKE_ORDER, order_id)
+    update = session.text("complete", bot.complete_command, "/complete")
+    text, markup = update.message.replies[-1]
+    if markup:
+        for row in markup.inline_keyboard:
+            session.press("complete_order", callbacks.COMPLETE_ORDER, callbacks.decode(row[0].callback_data).order_id)
+
+
+class Runner:
+    def __init__(self, master_share, seed):
+        self.bot = FakeBot()
+        self.master_share = master_share
+        self.seed = seed
+        self.histograms = {}
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, step, seconds):
+        histogram = self.histograms.get(step)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(step, metrics.Histogram())
+        histogram.record(seconds)
+
+    def run_level(self, threads, sessions, level):
+        self.histograms = {}
+        self.errors = 0
+        per_thread = sessions // threads
+        workers = [threading.Thread(target=self._worker, args=(level, number, per_thread))
+                   for number in range(threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return time.perf_counter() - started, per_thread * threads
+
+    def _worker(self, level, number, count):
+        rng = random.Random(f"{self.seed}-{level}-{number}")
+        for index in range(count):
+            try:
+                if rng.random() < self.master_share:
+                    # У каждого потока свой мастер: один мастер не работает в двух потоках сразу
+                    master_id = FIRST_MASTER_ID + number
+                    master_session(Session(self, master_id), rng)
+                else:
+                    customer_id = FIRST_CUSTOMER_ID + (level * 10_000 + number) * 10_000 + index
+                    customer_session(Session(self, customer_id), rng)
+            except Exception:
+                with self._lock:
+                    self.errors += 1
+                if self.errors == 1:
+                    bot.logger.exception("Ошибка в сценарии")
+
+
+def preload(count, seed):
+    rng = random.Random(seed)
+    categories = list(CATEGORY_IDS.values())
+    with database.write_batch():
+        for index in range(count):
+            database.save_order(FIRST_CUSTOMER_ID - 1 - index, f"preload{index}", rng.choice(categories),
+                                "Заявка для прогрева базы", "+7 900 000-00-00")
+
+
+# Словарь нарочно маленький: каждое слово есть в заметной доле заявок, для поиска это худший случай
+SEED_WORDS = ("бойлер", "кран", "смеситель", "розетка", "проводка", "стиральная", "машина", "холодильник",
+              "шкаф", "кровать", "дверь", "окно", "замок", "течет", "не", "включается", "сломался", "собрать",
+              "заменить", "починить", "кухня", "ванная", "срочно", "вечером", "подъезд", "этаж")
+SEED_STREETS = ("Петровская", "Чехова", "Греческая", "Фрунзе", "Ленина", "Пушкинская", "Александровская")
+
+
+def seed_orders(count, seed, first=0, batch=10_000):
+    """Быстро наполнить orders заявками first..count-1 во всех статусах (1% новых, 1% в работе)
+    в обход счетчиков и сводок: для замеров чтения, а не для сценариев"""
+    rng = random.Random(f"{seed}:{first}")
+    categories = list(CATEGORY_IDS.values())
+    for start in range(first, count, batch):
+        rows = []
+        for index in range(start, min(count, start + batch)):
+            status = 'new' if index % 100 == 0 else 'in_progress' if index % 100 == 1 else 'completed'
+            description = " ".join(rng.choice(SEED_WORDS) for _ in range(rng.randint(4, 10)))
+            contacts = f"ул. {rng.choice(SEED_STREETS)}, {rng.randint(1, 150)}, +7 9{rng.randint(0, 10**9 - 1):09d}"
+            rows.append((FIRST_CUSTOMER_ID + index, f"customer{index}", rng.choice(categories), description,
+                         contacts, status, None if status == 'new' else FIRST_MASTER_ID + index % 500))
+        with database.write_batch():
+            database.get_connection().executemany(
+                "INSERT INTO orders (user_id, username, category_id, description, contacts, status, master_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def database_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    """Поддельный Bot API: отдает заготовленные обновления через getUpdates
+    и считает ответы бота (sendMessage)"""
+    daemon_threads = True
+
+    def __init__(self, updates=(), latency=0.0):
+        super().__init__(("127.0.0.1", 0), _FakeTelegramHandler)
+        self.updates = list(updates)
+        self.latency = latency
+        self.sent = 0
+        self.all_sent = threading.Event()
+        self.expected = len(self.updates)
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def get_updates(self, offset, limit):
+        with self.lock:
+            return [update for update in self.updates[offset - 1:offset - 1 + limit]] if offset else self.updates[:limit]
+
+    def message_sent(self):
+        with self.lock:
+            self.sent += 1
+            if self.sent >= self.expected:
+                self.all_sent.set()
+
+
+class _FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params = json.loads(body) if body else {}
+        if method == "getUpdates":
+            result = self.server.get_updates(int(params.get('offset', 0)), int(params.get('limit', 100)))
+            if not result:
+                time.sleep(0.05)
+        elif method == "sendMessage":
+            time.sleep(self.server.latency)
+            self.server.message_sent()
+            result = {'message_id': 1, 'date': 0, 'chat': {'id': params['chat_id'], 'type': 'private'},
+                      'text': params.get('text', '')}
+        elif method == "getMe":
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'loadtest_bot'}
+        else:
+            result = True
+        response = json.dumps({'ok': True, 'result': result}).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_updates(count):
+    """Обновления /start от count разных чатов"""
+    return [{
+        'update_id': number,
+        'message': {
+            'message_id': number, 'date': 0, 'text': '/start',
+            'chat': {'id': FIRST_CUSTOMER_ID + number, 'type': 'private'},
+            'from': {'id': FIRST_CUSTOMER_ID + number, 'is_bot': False, 'first_name': f'User{number}'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    } for number in range(1, count + 1)]
+
+
+def run_ingress(mode, count, workers, clients, latency):
+    """Обновления в секунду от приема до ответа бота: long polling против webhook"""
+    updates = start_updates(count)
+    telegram = FakeTelegram(updates if mode == "polling" else (), latency)
+    telegram.expected = count
+    threading.Thread(target=telegram.serve_forever, daemon=True).start()
+    fake_bot = Bot(OFFLINE_TOKEN, base_url=telegram.base_url, request=Request(con_pool_size=workers + 8))
+    updater = Updater(bot=fake_bot, use_context=True)
+    bot.register_handlers(updater.dispatcher, run_async=mode == "polling")
+
+    started = time.perf_counter()
+    if mode == "polling":
+        updater.start_polling(poll_interval=0, timeout=0)
+        telegram.all_sent.wait()
+        elapsed = time.perf_counter() - started
+    else:
+        secret = "loadtest-secret"
+        queue = ShardedUpdateQueue(updater.dispatcher.process_update, workers=workers)
+        queue.start()
+        server = start_webhook_server(fake_bot, queue, secret, 0, host="127.0.0.1")
+        port = server.server_address[1]
+
+        def post(chunk):
+            connection = http.client.HTTPConnection("127.0.0.1", port)
+            for update in chunk:
+                connection.request("POST", "/telegram", json.dumps(update).encode("utf-8"),
+                                   {'Content-Type': 'application/json', SECRET_HEADER: secret})
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise RuntimeError(f"webhook ответил {response.status}")
+            connection.close()
+
+        started = time.perf_counter()
+        senders = [threading.Thread(target=post, args=(updates[number::clients],)) for number in range(clients)]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        telegram.all_sent.wait()
+        elapsed = time.perf_counter() - started
+        server.shutdown()
+        queue.stop()
+    updater.stop()
+    telegram.shutdown()
+    return elapsed
+
+
+class SimulatedMasters:
+    """Мастера для --dispatch: вместо отправки сообщения планируют ответ на предложение.
+
+    Мастер отвечает через 0.1-1 с: в accept_share случаев принимает, в половине остальных
+    отказывается, иначе молчит до истечения предложения. Принятую заявку выполняет за 0.5-2.5 с."""
+
+    def __init__(self, seed, accept_share):
+        self.rng = random.Random(seed)
+        self.accept_share = accept_share
+        self.dispatcher = None
+        self.created_at = {}
+        self.assigned = metrics.Histogram()
+        self.answers = {'accepted': 0, 'declined': 0, 'silent': 0, 'late': 0}
+        self._events = []
+        self._order = itertools.count()
+        self._lock = threading.Condition()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="masters", daemon=True)
+        self._thread.start()
+
+    def notify(self, chat_id, text, parse_mode=None, callback=None, reply_markup=None):
+        order_id = callbacks.decode(reply_markup.inline_keyboard[0][0].callback_data).order_id
+        roll = self.rng.random()
+        if roll < self.accept_share:
+            self._schedule(self.rng.uniform(0.1, 1.0), self._answer, order_id, chat_id, True)
+        elif roll < self.accept_share + (1 - self.accept_share) / 2:
+            self._schedule(self.rng.uniform(0.1, 1.0), self._answer, order_id, chat_id, False)
+        else:
+            self.answers['silent'] += 1
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._lock.notify()
+        self._thread.join()
+
+    def _answer(self, order_id, master_id, accept):
+        result = database.answer_offer(order_id, master_id, f"Master{master_id}", accept)
+        if result == database.CLAIM_WON:
+            self.answers['accepted'] += 1
+            self.assigned.record(time.monotonic() - self.created_at[order_id])
+            self._schedule(self.rng.uniform(0.5, 2.5), database.complete_order, order_id)
+        else:
+            self.answers['declined' if result == database.OFFER_DECLINED else 'late'] += 1
+        self.dispatcher.wake()
+
+    def _schedule(self, delay, action, *args):
+        with self._lock:
+            heapq.heappush(self._events, (time.monotonic() + delay, next(self._order), action, args))
+            self._lock.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopping and (not self._events or self._events[0][0] > time.monotonic()):
+                    self._lock.wait(self._events[0][0] - time.monotonic() if self._events else None)
+                if self._stopping:
+                    return
+                _, _, action, args = heapq.heappop(self._events)
+            action(*args)
+            if action is database.complete_order:
+                self.dispatcher.wake()
+
+
+def run_dispatch(count, masters, rate, timeout, accept_share, seed):
+    """Время от записи заявки до принятия мастером при авто-распределении"""
+    rng = random.Random(seed)
+    categories = list(CATEGORY_IDS.values())
+    for number in range(masters):
+        database.set_master_skills(FIRST_MASTER_ID + number, f"Master{number}",
+                                   rng.sample(categories, rng.randint(1, 3)))
+    simulated = SimulatedMasters(seed, accept_share)
+    dispatcher = AutoDispatcher(simulated, bot.offer_message, timeout=timeout, interval=0.1)
+    simulated.dispatcher = dispatcher
+    dispatcher.start()
+
+    started = time.monotonic()
+    for index in range(count):
+        delay = started + index / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        order_id = database.save_order(FIRST_CUSTOMER_ID + index, f"customer{index}", rng.choice(categories),
+                                       "Заявка для авто-распределения", "+7 900 000-00-00")
+        simulated.created_at[order_id] = time.monotonic()
+        dispatcher.wake()
+    # Ждем, пока заявки разберут или предлагать их станет некому
+    idle_since = time.monotonic()
+    assigned = 0
+    while time.monotonic() - idle_since < timeout * 3:
+        time.sleep(0.2)
+        if simulated.assigned.count != assigned:
+            assigned = simulated.assigned.count
+            idle_since = time.monotonic()
+    elapsed = time.monotonic() - started
+    dispatcher.stop()
+    simulated.stop()
+    return simulated, dispatcher.stats(), elapsed
+
+
+def run_writes(batch_sizes, count, clients, synchronous, seed):
+    """Записей заявок в секунду для каждого размера пачки"""
+    rng = random.Random(seed)
+    categories = [rng.choice(list(CATEGORY_IDS.values())) for _ in range(count)]
+    print(f"Заявок: {count} на каждый размер пачки, клиентов: {clients}, synchronous: {synchronous or 'как в боте'}")
+    print(f"  {'пачка':>6}{'записей/с':>12}{'средняя пачка':>16}")
+    for batch_size in batch_sizes:
+        db = DatabaseExecutor(readers=1, batch_size=batch_size, synchronous=synchronous)
+        db.start()
+
+        def client(number):
+            for index in range(number, count, clients):
+                db.write(database.save_order, FIRST_CUSTOMER_ID + index, f"customer{index}", categories[index],
+                         "Заявка для замера записи", "+7 900 000-00-00").result()
+
+        threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        stats = db.stats()['write']
+        db.shutdown()
+        print(f"  {batch_size:>6}{count / elapsed:>12.0f}{stats['avg_batch']:>16.1f}")
+
+
+def run_rows(count, seed):
+    """Время и память на выборку count заявок: кортежи SELECT * против Order и OrderCard"""
+    seed_orders(count, seed)
+    conn = database.get_connection()
+    variants = [
+        ("кортежи, SELECT * (до)", lambda: conn.execute("SELECT * FROM orders LIMIT ?", (count,)).fetchall()),
+        ("Order, все столбцы", lambda: database._select(
+            conn, Order, f"SELECT {database.ORDER_COLUMNS} FROM orders LIMIT ?", (count,)).fetchall()),
+        ("OrderCard, столбцы карточки", lambda: database._select(
+            conn, OrderCard, f"SELECT {database.CARD_COLUMNS} FROM orders LIMIT ?", (count,)).fetchall()),
+    ]
+    print(f"Заявок: {count}, на каждые 100 000 строк:")
+    print(f"  {'строки':<32}{'мс':>10}{'МБ':>10}{'байт/строка':>14}")
+    for name, build in variants:
+        elapsed, size = measure(build, repeat=5)
+        print(f"  {name:<32}{elapsed / count * 1e5 * 1000:>10.1f}{size / count * 1e5 / 1024 / 1024:>10.1f}"
+              f"{size / count:>14.0f}")
+
+
+SEARCH_QUERIES = ("бойлер", "Чехова", "течет кран", "стиральная не включается", "9051")
+
+
+def like_search(text, limit):
+    """Тот же поиск без FTS5: каждое слово ищется подстрокой в описании, контактах и имени.
+    LIKE в SQLite не различает регистр только у латиницы, поэтому слова берутся как есть"""
+    terms = database._SEARCH_TERM.findall(text)[:database.MAX_SEARCH_TERMS]
+    where = " AND ".join(f"(description LIKE ?{number} OR contacts LIKE ?{number} OR username LIKE ?{number})"
+                         for number in range(1, len(terms) + 1))
+    params = [f"%{term}%" for term in terms]
+    conn = database.get_connection()
+    orders = database._select(conn, OrderCard, f"SELECT {database.CARD_COLUMNS} FROM orders WHERE {where} "
+                              f"ORDER BY id DESC LIMIT {limit}", params).fetchall()
+    total = conn.execute(f"SELECT COUNT(*) FROM orders WHERE {where}", params).fetchone()[0]
+    return orders, total
+
+
+def run_search(sizes, seed, repeat=5):
+    """Время поиска FTS5 и LIKE для каждого размера базы"""
+    print(f"  {'заявок':>9}  {'запрос':<26}{'найдено':>9}{'FTS5 мс':>10}{'LIKE мс':>10}")
+    seeded = 0
+    for size in sizes:
+        seed_orders(size, seed, first=seeded)
+        seeded = size
+        for text in SEARCH_QUERIES:
+            timings = {}
+            for name, search in (("fts", lambda: database.search_orders(text, 5)),
+                                 ("like", lambda: like_search(text, 5))):
+                best = None
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    _, total = search()
+                    elapsed = time.perf_counter() - started
+                    best = elapsed if best is None else min(best, elapsed)
+                timings[name] = (best, total)
+            # FTS5 считает не больше SEARCH_COUNT_LIMIT самых новых совпадений, LIKE - все
+            found = f"{timings['fts'][1]}/{timings['like'][1]}"
+            print(f"  {size:>9}  {text:<26}{found:>9}{timings['fts'][0] * 1000:>10.2f}{timings['like'][0] * 1000:>10.1f}")
+
+
+def legacy_order_prints(order_id, username, user_id, category, description, contacts, output):
+    """Вывод о новой заявке, как в handle_text_messages до app_logging.py"""
+    print(f"✅ Заявка #{order_id} сохранена", file=output)
+    print(f"\n🎉 НОВАЯ ЗАЯВКА #{order_id}", file=output)
+    print(f"👤 Пользователь: {username} (ID: {user_id})", file=output)
+    print(f"📦 Категория: {category}", file=output)
+    print(f"📝 Описание: {description}", file=output)
+    print(f"📞 Контакты: {contacts}", file=output)
+    print("📨 Уведомления поставлены в очередь", file=output)
+    print("=" * 50, file=output)
+
+
+def run_logging(count, path):
+    """Время журнала одной заявки: в потоке обработчика и вместе с записью фоновым потоком"""
+    logger = logging.getLogger("bot")
+    category, description, contacts = "plumbing", "Течет кран на кухне", "+7 900 000-00-00"
+    print(f"Заявок: {count}, вывод: {path}")
+    print(f"  {'журнал':<34}{'мкс в обработчике':>20}{'мкс всего':>12}")
+    # Консоль пишет построчно, поэтому и файл открыт с построчной буферизацией
+    with open(path, "w", buffering=1, encoding="utf-8") as output:
+        started = time.perf_counter()
+        for index in range(count):
+            legacy_order_prints(index, f"customer{index}", FIRST_CUSTOMER_ID + index,
+                                category, description, contacts, output)
+        elapsed = time.perf_counter() - started
+        print(f"  {'print, 8 строк (до)':<34}{elapsed / count * 1e6:>20.2f}{elapsed / count * 1e6:>12.2f}")
+
+        for name, level in (("logging JSON, INFO", "INFO"), ("logging JSON, INFO выключен", "WARNING")):
+            listener = app_logging.setup_logging(level=level, fmt="json", stream=output)
+            started = time.perf_counter()
+            for index in range(count):
+                logger.info("Новая заявка #%s от %s: %s", index, f"customer{index}", category,
+                            extra={'order_id': index, 'user_id': FIRST_CUSTOMER_ID + index, 'handler': 'text'})
+            elapsed = time.perf_counter() - started
+            listener.stop()
+            total = time.perf_counter() - started
+            print(f"  {name:<34}{elapsed / count * 1e6:>20.2f}{total / count * 1e6:>12.2f}")
+
+
+def measure(build, repeat=1):
+    """Лучшее время build() из repeat прогонов и память, которую занимает его результат (по tracemalloc).
+
+    Время замеряется отдельными прогонами без трассировки, она замедляет выделение памяти"""
+    elapsed = None
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        build()
+        run = time.perf_counter() - started
+        elapsed = run if elapsed is None else min(elapsed, run)
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed, size
+
+
+def legacy_conversations(users):
+    """Состояния диалогов, как их хранил bot.py до state_store.py: строка состояния
+    в user_states и словарь context.user_data на каждого клиента"""
+    user_states, user_data = {}, {}
+    for index in range(users):
+        user_id = FIRST_CUSTOMER_ID + index
+        user_states[user_id] = 'awaiting_contacts'
+        user_data[user_id] = {'category': 'plumbing', 'category_name': REPAIR_CATEGORIES['plumbing'],
+                              'description': f"Течет кран на кухне, заявка {index}"}
+    return user_states, user_data
+
+
+def store_conversations(users, max_size):
+    store = state_store.ConversationStore(max_size=max_size, persist=False)
+    for index in range(users):
+        user_id = FIRST_CUSTOMER_ID + index
+        store.set(user_id, state_store.STATE_AWAITING_DESCRIPTION, category='plumbing')
+        store.set(user_id, state_store.STATE_AWAITING_CONTACTS, description=f"Течет кран на кухне, заявка {index}")
+    return store
+
+
+def run_conversations(users):
+    """Память и время на состояния диалогов users клиентов"""
+    variants = [
+        ("user_states + user_data (до)", lambda: legacy_conversations(users)),
+        ("ConversationStore без предела", lambda: store_conversations(users, users)),
+        (f"ConversationStore, предел {state_store.MAX_CONVERSATIONS}",
+         lambda: store_conversations(users, state_store.MAX_CONVERSATIONS)),
+    ]
+    print(f"Клиентов: {users}")
+    print(f"  {'хранилище':<42}{'МБ':>10}{'байт/клиент':>14}{'мкс/клиент':>12}")
+    for name, build in variants:
+        elapsed, size = measure(build)
+        print(f"  {name:<42}{size / 1024 / 1024:>10.1f}{size / users:>14.0f}{elapsed / users * 1e6:>12.2f}")
+
+
+# Одни и те же нажатия в старом текстовом формате и в формате callbacks.encode()
+CODEC_PAYLOADS = [
+    ("category_electrical", callbacks.encode(callbacks.PICK_CATEGORY, category="electrical")),
+    ("admin_show_categories", callbacks.encode(callbacks.ADMIN_CATEGORIES)),
+    ("admin_back", callbacks.encode(callbacks.ADMIN_BACK)),
+    ("admin_category_doors_windows", callbacks.encode(callbacks.SHOW_ORDERS, category="doors_windows")),
+    ("next_123456_plumbing", callbacks.encode(callbacks.NEXT_ORDER, 123456, "plumbing")),
+    ("prev_123456_all", callbacks.encode(callbacks.PREV_ORDER, 123456)),
+    ("take_123456", callbacks.encode(callbacks.TAKE_ORDER, 123456)),
+    ("show_my_order_123456", callbacks.encode(callbacks.MY_ORDER, 123456)),
+    ("complete_123456", callbacks.encode(callbacks.COMPLETE_ORDER, 123456)),
+]
+_LEGACY_PATTERNS = (re.compile("^category_"), re.compile("^complete_"))
+
+
+def legacy_route(data):
+    """Копия разбора callback_data в bot.py до callbacks.py (без вызова обработчиков):
+    шаблоны CallbackQueryHandler по очереди, затем цепочка if/elif из handle_admin_actions"""
+    if _LEGACY_PATTERNS[0].match(data):
+        if data.startswith("category_"):
+            return "pick_category", data[9:]
+        return None
+    if _LEGACY_PATTERNS[1].match(data):
+        if data.startswith("complete_"):
+            return "complete_order", data.split("_")[1]
+        return None
+    if data == "admin_show_categories":
+        return "admin_categories",
+    elif data == "admin_refresh":
+        return "admin_refresh",
+    elif data == "admin_back":
+        return "admin_back",
+    elif data == "admin_close":
+        return "admin_close",
+    elif data == "admin_all_orders":
+        return "show_orders", "all"
+    elif data.startswith("admin_category_"):
+        return "show_orders", data.split("_")[2]
+    elif data.startswith("take_"):
+        return "take_order", int(data.split("_")[1])
+    elif data.startswith("admin_back_to_"):
+        return "show_orders", data.split("_")[3]
+    elif data.startswith("show_my_order_"):
+        return "my_order", data.split("_")[3]
+    elif data.startswith("next_") or data.startswith("prev_"):
+        parts = data.split("_", 2)
+        if len(parts) == 3:
+            action, order_id, category_key = parts
+            return "show_orders", category_key, int(order_id), 1 if action == "next" else -1
+    elif data.startswith("complete_"):
+        return "complete_order", data.split("_")[1]
+    return None
+
+
+def run_codec(count):
+    """Время разбора одного нажатия: старая цепочка, decode() и CallbackRouter"""
+    router = callbacks.CallbackRouter({action: lambda update, context, callback: callback
+                                       for action in callbacks.ACTION_NAMES})
+    user = FakeUser(FIRST_CUSTOMER_ID)
+    legacy = [data for data, _ in CODEC_PAYLOADS]
+    encoded = [data for _, data in CODEC_PAYLOADS]
+    updates = [types.SimpleNamespace(callback_query=types.SimpleNamespace(data=data), effective_user=user)
+               for data in encoded]
+    variants = [
+        ("if/elif и шаблоны (до)", legacy_route, legacy),
+        # Разбор без кэша - первое нажатие на кнопку, дальше decode() берет результат из кэша
+        ("разбор без кэша, новый формат", callbacks._decode.__wrapped__, encoded),
+        ("разбор без кэша, старый формат", callbacks._decode.__wrapped__, legacy),
+        ("decode(), новый формат", callbacks.decode, encoded),
+        ("decode(), старый формат", callbacks.decode, legacy),
+        ("CallbackRouter, новый формат", lambda update: router(update, None), updates),
+    ]
+    rounds = max(1, count // len(CODEC_PAYLOADS))
+    print(f"Нажатий: {rounds * len(CODEC_PAYLOADS)}, самые длинные данные кнопки: "
+          f"{max(map(len, legacy))} байт в старом формате, {max(map(len, encoded))} в новом")
+    for name, route, payloads in variants:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for payload in payloads:
+                route(payload)
+        elapsed = time.perf_counter() - started
+        print(f"  {name:<32}{elapsed / (rounds * len(payloads)) * 1e9:>8.0f} нс/нажатие")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон обработчиков бота без Telegram")
+    parser.add_argument('--threads', default="1,2,4,8,16", help="ступени числа потоков через запятую")
+    parser.add_argument('--sessions', type=int, default=400, help="сценариев на ступень")
+    parser.add_argument('--master-share', type=float, default=0.3, help="доля сценариев мастеров")
+    parser.add_argument('--preload', type=int, default=1000, help="заявок в базе до начала прогона")
+    parser.add_argument('--seed', default="1")
+    parser.add_argument('--db', help="файл базы (по умолчанию временный)")
+    parser.add_argument('--ingress', choices=['polling', 'webhook'],
+                        help="вместо сценариев замерить прием обновлений: long polling или webhook")
+    parser.add_argument('--updates', type=int, default=2000, help="обновлений для --ingress")
+    parser.add_argument('--workers', type=int, default=8, help="потоков обработки в режиме webhook")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа sendMessage, мс")
+    parser.add_argument('--dispatch', action='store_true', help="вместо сценариев проиграть авто-распределение")
+    parser.add_argument('--orders', type=int, default=3000, help="заявок для --dispatch, --writes, --rows и --logging")
+    parser.add_argument('--masters', type=int, default=300, help="мастеров для --dispatch")
+    parser.add_argument('--rate', type=float, default=100, help="заявок в секунду для --dispatch")
+    parser.add_argument('--offer-timeout', type=float, default=2.0, help="срок ответа на предложение, с")
+    parser.add_argument('--accept-share', type=float, default=0.8, help="доля принятых предложений")
+    parser.add_argument('--conversations', action='store_true',
+                        help="вместо сценариев замерить память на состояния диалогов")
+    parser.add_argument('--users', type=int, default=1_000_000, help="клиентов для --conversations")
+    parser.add_argument('--codec', action='store_true', help="вместо сценариев замерить разбор нажатий на кнопки")
+    parser.add_argument('--callbacks', type=int, default=1_000_000, help="нажатий для --codec")
+    parser.add_argument('--writes', action='store_true', help="вместо сценариев замерить скорость записи заявок")
+    parser.add_argument('--batch-sizes', default="1,10,100", help="размеры пачки записи для --writes")
+    parser.add_argument('--clients', type=int, default=100, help="одновременных клиентов для --writes")
+    parser.add_argument('--synchronous', choices=['FULL', 'NORMAL', 'OFF'],
+                        help="режим fsync писателя для --writes (по умолчанию как в боте)")
+    parser.add_argument('--logging', action='store_true', help="вместо сценариев замерить стоимость журнала заявки")
+    parser.add_argument('--log-output', default=os.devnull, help="куда писать журнал для --logging")
+    parser.add_argument('--rows', action='store_true', help="вместо сценариев замерить выборку строк заявок")
+    parser.add_argument('--search', action='store_true', help="вместо сценариев замерить поиск FTS5 против LIKE")
+    parser.add_argument('--search-sizes', default="10000,100000", help="размеры базы для --search через запятую")
+    args = parser.parse_args()
+
+    if args.logging:
+        run_logging(args.orders, args.log_output)
+        return
+    if args.codec:
+        run_codec(args.callbacks)
+        return
+    if args.conversations:
+        run_conversations(args.users)
+        return
+
+    listener = app_logging.setup_logging(level='WARNING', fmt='text')
+    workdir = None
+    if args.db:
+        db_path = args.db
+    else:
+        workdir = tempfile.TemporaryDirectory()
+        db_path = os.path.join(workdir.name, "orders.db")
+    if args.rows or args.search:
+        # Замеряется сама выборка, без учета запросов в метриках
+        metrics.ENABLED = False
+    database.configure(db_path)
+    database.init_db()
+    if args.writes or args.rows or args.search:
+        try:
+            if args.writes:
+                run_writes([int(value) for value in args.batch_sizes.split(",")], args.orders, args.clients,
+                           args.synchronous, args.seed)
+            elif args.rows:
+                run_rows(args.orders, args.seed)
+            else:
+                run_search([int(value) for value in args.search_sizes.split(",")], args.seed)
+        finally:
+            database.close_connections()
+            listener.stop()
+            if workdir:
+                workdir.cleanup()
+        return
+    if not args.dispatch:
+        preload(args.preload, args.seed)
+
+    levels = [int(value) for value in args.threads.split(",")]
+    runner = Runner(args.master_share, args.seed)
+    bot.ADMIN_IDS.extend(FIRST_MASTER_ID + number for number in range(max(levels)))
+    bot.db.start()
+    bot.conversations.start()
+    bot.notifier = Notifier(runner.bot, rate=1_000_000, per_chat_interval=0)
+    bot.notifier.start()
+    bot.outbox_worker = OutboxWorker(bot.notifier, bot.new_order_notification_text)
+    bot.outbox_worker.start()
+
+    try:
+        if args.ingress:
+            elapsed = run_ingress(args.ingress, args.updates, args.workers, max(levels), args.api_latency / 1000)
+            print(f"{args.ingress}: {args.updates} обновлений за {elapsed:.2f} с ({args.updates / elapsed:.0f} в секунду)")
+            return
+        if args.dispatch:
+            simulated, stats, elapsed = run_dispatch(args.orders, args.masters, args.rate, args.offer_timeout,
+                                                     args.accept_share, args.seed)
+            h = simulated.assigned
+            print(f"Заявок: {args.orders}, мастеров: {args.masters}, {args.rate:.0f} заявок/с, "
+                  f"срок ответа {args.offer_timeout:.1f} с, прогон {elapsed:.1f} с")
+            print(f"Принято мастерами: {h.count}, осталось в /admin: {args.orders - h.count}")
+            if h.count:
+                print(f"До принятия, с: среднее {h.total / h.count:.2f}, p50 {h.percentile(50):.2f}, "
+                      f"p95 {h.percentile(95):.2f}, p99 {h.percentile(99):.2f}, max {h.max:.2f}")
+            print(f"Предложений: {stats['offered']}, просрочено: {stats['expired']}, "
+                  f"ответы: {simulated.answers}, проходов: {stats['runs']}")
+            return
+        print(f"База: {db_path}, заявок заранее: {args.preload}, сценариев на ступень: {args.sessions}")
+        for level, threads in enumerate(levels):
+            elapsed, sessions = runner.run_level(threads, args.sessions, level)
+            steps = sum(h.count for h in runner.histograms.values())
+            print(f"\nПотоков: {threads}  сценариев: {sessions}  за {elapsed:.2f} с  "
+                  f"({sessions / elapsed:.0f} сценариев/с, {steps / elapsed:.0f} шагов/с)  ошибок: {runner.errors}")
+            print(f"  {'шаг':<18}{'кол-во':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+            for step, h in sorted(runner.histograms.items()):
+                print(f"  {step:<18}{h.count:>8}{h.percentile(50) * 1000:>10.2f}"
+                      f"{h.percentile(95) * 1000:>10.2f}{h.percentile(99) * 1000:>10.2f}")
+            write_stats = bot.db.stats()['write']
+            print(f"  база {database_size(db_path) / 1024 / 1024:.1f} МБ, заявок {database.get_orders_stats()['total']}, "
+                  f"средняя пачка записи {write_stats['avg_batch']:.1f}, уведомлений {runner.bot.calls}")
+            render_stats = bot.renders.stats()
+            print(f"  нажатий {render_stats['callbacks']}, слито {render_stats['coalesced']}, "
+                  f"правок {render_stats['edits']}, правок без изменений {render_stats['edits_skipped']}, "
+                  f"лишних ответов {render_stats['answers_skipped']}")
+    finally:
+        bot.outbox_worker.stop()
+        bot.notifier.stop()
+        bot.conversations.stop()
+        bot.db.shutdown()
+        database.close_connections()
+        listener.stop()
+        if workdir:
+            workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
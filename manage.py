@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+
+import database
+from archiver import ARCHIVE_AFTER_DAYS, ARCHIVE_BATCH_SIZE, OrderArchiver
+
+
+def backfill_rollups(args):
+    """Пересобрать финансовые сводки по истории заявок"""
+    database.init_db()
+    database.rebuild_finance_rollups()
+    summary = database.get_finance_summary()
+    print(f"Сводки пересобраны: {summary['total']} завершенных заказов, мастеров: {len(summary['by_master'])}")
+
+
+def archive(args):
+    """Перенести старые завершенные заявки в orders_archive"""
+    database.init_db()
+    archived = OrderArchiver(after_days=args.days, batch_size=args.batch, pause=0).run_once()
+    print(f"Перенесено в архив: {archived}")
+
+
+def vacuum(args):
+    """Пересобрать файл базы и включить возврат свободного места (auto_vacuum = INCREMENTAL)"""
+    database.init_db()
+    free, page_size, _ = database.free_pages()
+    before = os.path.getsize(database.DB_PATH)
+    database.vacuum()
+    after = os.path.getsize(database.DB_PATH)
+    print(f"Свободных страниц было: {free} ({free * page_size / 1e6:.1f} МБ), "
+          f"размер файла: {before / 1e6:.1f} -> {after / 1e6:.1f} МБ")
+
+
+def check_plans(args):
+    """Проверить, что горячие запросы идут по индексам (код выхода 1, если нет)"""
+    database.init_db()
+    problems = database.check_query_plans()
+    for name, detail in problems:
+        print(f"{name}: {detail}")
+    print(f"Проверено запросов: {len(database.HOT_QUERIES)}, со сканированием таблицы: {len(problems)}")
+    return 1 if problems else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обслуживание базы заявок")
+    parser.add_argument("--db", help="путь к файлу базы (по умолчанию orders.db или ORDERS_DB_PATH)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("backfill-rollups", help=backfill_rollups.__doc__).set_defaults(handler=backfill_rollups)
+    archive_parser = commands.add_parser("archive", help=archive.__doc__)
+    archive_parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS,
+                                help="переносить заявки, завершенные раньше, чем столько дней назад")
+    archive_parser.add_argument("--batch", type=int, default=ARCHIVE_BATCH_SIZE, help="заявок в одной транзакции")
+    archive_parser.set_defaults(handler=archive)
+    commands.add_parser("vacuum", help=vacuum.__doc__).set_defaults(handler=vacuum)
+    commands.add_parser("check-plans", help=check_plans.__doc__).set_defaults(handler=check_plans)
+
+    args = parser.parse_args()
+    if args.db:
+        database.configure(args.db)
+    status = args.handler(args)
+    database.close_connections()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
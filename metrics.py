@@ -0,0 +1,300 @@
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Bot
+from telegram.error import TelegramError
+
+logger = logging.getLogger(__name__)
+
+# Сбор метрик можно выключить переменной окружения METRICS_ENABLED=0
+ENABLED = os.getenv('METRICS_ENABLED', '1') != '0'
+# Запросы дольше этого порога попадают в журнал медленных запросов вместе с планом
+SLOW_QUERY_SECONDS = float(os.getenv('SLOW_QUERY_MS', '50')) / 1000
+SLOW_QUERY_LOG_SIZE = 50
+
+
+class Histogram:
+    """Гистограмма в духе HDR: логарифмические корзины, в каждой 16 линейных.
+    Запись O(1), точность перцентилей около 6%, значения хранятся в микросекундах."""
+
+    SUB_BUCKETS = 16
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @classmethod
+    def _index(cls, micros):
+        if micros < cls.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - 5
+        return (shift + 1) * cls.SUB_BUCKETS + (micros >> shift) - cls.SUB_BUCKETS
+
+    @classmethod
+    def _upper_bound(cls, index):
+        if index < cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.SUB_BUCKETS - 1
+        return ((index % cls.SUB_BUCKETS + cls.SUB_BUCKETS + 1) << shift) - 1
+
+    def record(self, seconds):
+        index = self._index(int(seconds * 1_000_000))
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, percent):
+        """Значение перцентиля в секундах"""
+        with self._lock:
+            threshold = self.count * percent / 100
+            seen = 0
+            for index in sorted(self._counts):
+                seen += self._counts[index]
+                if seen >= threshold:
+                    return min(self._upper_bound(index) / 1_000_000, self.max)
+        return 0.0
+
+
+class Registry:
+    """Хранилище метрик процесса: гистограммы, счетчики и журнал медленных запросов"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self._lock = threading.Lock()
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.slow_queries.clear()
+
+
+registry = Registry()
+
+
+def timed(name):
+    """Декоратор: время выполнения обработчика в гистограмму handler:<name>"""
+    def decorator(handler):
+        if not ENABLED:
+            return handler
+        histogram = registry.histogram(f"handler:{name}")
+
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                histogram.record(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+# В журнал медленных запросов попадают только выборки и изменения данных. BEGIN IMMEDIATE
+# ждет блокировку записи, а COMMIT и PRAGMA - диск: плана у них нет, их время видно в гистограммах
+_PLANNED_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+def record_query(connection, sql, params, seconds, rows):
+    """Учесть выполненный SQL-запрос; медленный запрос записать в журнал вместе с планом"""
+    registry.histogram(f"sql:{sql}").record(seconds)
+    registry.increment(f"sql_rows:{sql}", max(rows, 0))
+    if seconds >= SLOW_QUERY_SECONDS and sql.lstrip()[:7].upper().startswith(_PLANNED_STATEMENTS):
+        try:
+            plan = [row[3] for row in sqlite3.Cursor(connection).execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.Error:
+            plan = []
+        registry.slow_queries.append((time.time(), seconds, sql, plan))
+        logger.warning("Медленный запрос %.1f мс: %s | %s", seconds * 1000, sql, "; ".join(plan))
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, который замеряет время запроса от execute до выборки результата.
+
+    Выборка учитывается, когда строки забраны fetchone/fetchall, когда итерация по курсору
+    дошла до конца или когда курсор закрыт раньше"""
+    __slots__ = ('_sql', '_params', '_elapsed', '_rows')
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        super().execute(sql, params)
+        self._elapsed = time.perf_counter() - started
+        self._sql = sql
+        self._params = params
+        self._rows = 0
+        if self.description is None:
+            self._sql = None
+            record_query(self.connection, sql, params, self._elapsed, self.rowcount)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_params)
+        self._sql = None
+        record_query(self.connection, sql, (), time.perf_counter() - started, self.rowcount)
+        return self
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._finish(time.perf_counter() - started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._finish(time.perf_counter() - started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._finish(time.perf_counter() - started, len(rows))
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._finish(time.perf_counter() - started, 0)
+            raise
+        if self._sql is not None:
+            self._elapsed += time.perf_counter() - started
+            self._rows += 1
+        return row
+
+    def close(self):
+        self._finish(0.0, 0)
+        super().close()
+
+    def _finish(self, elapsed, rows):
+        if getattr(self, '_sql', None) is not None:
+            record_query(self.connection, self._sql, self._params, self._elapsed + elapsed, self._rows + rows)
+            self._sql = None
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение, все запросы которого проходят через TimedCursor"""
+
+    def execute(self, sql, params=()):
+        return self.cursor(TimedCursor).execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor(TimedCursor).executemany(sql, seq_of_params)
+
+
+class InstrumentedBot(Bot):
+    """Bot, который считает вызовы Telegram API, ошибки и время ответа по методам"""
+
+    def _post(self, endpoint, *args, **kwargs):
+        if not ENABLED:
+            return super()._post(endpoint, *args, **kwargs)
+        registry.increment(f"telegram_calls:{endpoint}")
+        started = time.perf_counter()
+        try:
+            return super()._post(endpoint, *args, **kwargs)
+        except TelegramError as e:
+            registry.increment(f"telegram_errors:{endpoint}:{type(e).__name__}")
+            raise
+        finally:
+            registry.histogram(f"telegram:{endpoint}").record(time.perf_counter() - started)
+
+
+def render_text(limit=10):
+    """Короткий отчет для команды /metrics"""
+    lines = []
+    handlers = sorted((name[8:], h) for name, h in registry.histograms.items()
+                      if name.startswith("handler:") and h.count)
+    if handlers:
+        lines.append("⏱ Обработчики (p50/p95/p99, мс):")
+        for name, h in handlers:
+            lines.append(f"• {name}: {h.percentile(50) * 1000:.1f}/{h.percentile(95) * 1000:.1f}/"
+                         f"{h.percentile(99) * 1000:.1f} ({h.count})")
+
+    queries = sorted(((name[4:], h) for name, h in registry.histograms.items() if name.startswith("sql:")),
+                     key=lambda item: item[1].total, reverse=True)
+    if queries:
+        lines.append("\n🗄 Запросы по суммарному времени (p95, мс):")
+        for sql, h in queries[:limit]:
+            sql = " ".join(sql.split())
+            lines.append(f"• {h.total * 1000:.0f} мс, {h.count} раз, p95 {h.percentile(95) * 1000:.2f}: {sql[:70]}")
+        lines.append(f"• Медленных запросов: {len(registry.slow_queries)}")
+
+    calls = {name[15:]: value for name, value in registry.counters.items() if name.startswith("telegram_calls:")}
+    if calls:
+        errors = sum(value for name, value in registry.counters.items() if name.startswith("telegram_errors:"))
+        lines.append(f"\n📡 Telegram API: {sum(calls.values())} вызовов, {errors} ошибок")
+        for endpoint, value in sorted(calls.items(), key=lambda item: item[1], reverse=True)[:limit]:
+            lines.append(f"• {endpoint}: {value}")
+    return "\n".join(lines) or "Метрик пока нет"
+
+
+def _label(value):
+    return " ".join(value.split()).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+def render_prometheus():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for name, h in sorted(registry.histograms.items()):
+        if not h.count:
+            continue
+        kind, _, label = name.partition(":")
+        metric = f"repair_bot_{kind}_seconds"
+        for quantile in (50, 95, 99):
+            lines.append(f'{metric}{{name="{_label(label)}",quantile="0.{quantile}"}} {h.percentile(quantile):.6f}')
+        lines.append(f'{metric}_count{{name="{_label(label)}"}} {h.count}')
+        lines.append(f'{metric}_sum{{name="{_label(label)}"}} {h.total:.6f}')
+    for name, value in sorted(registry.counters.items()):
+        kind, _, label = name.partition(":")
+        lines.append(f'repair_bot_{kind}_total{{name="{_label(label)}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """Отдавать метрики Prometheus на http://host:port/metrics в фоновом потоке"""
+    server = ThreadingHTTPServer((host, port), _PrometheusHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -1,17 +1,84 @@
 from enum import Enum
+from typing import NamedTuple, Optional
 
-class OrderState(Enum):
-    PENDING = "ожидает мастера"
-    ACCEPTED = "принят мастером"
-    COMPLETED = "выполнен"
-
-# Модель заявки. Позже это будет таблица в БД.
-class Order:
-    def __init__(self, user_id, category, description, address, phone):
-        self.user_id = user_id
-        self.category = category
-        self.description = description
-        self.address = address
-        self.phone = phone
-        self.state = OrderState.PENDING
-        self.master_id = None
\ No newline at end of file
+
+class OrderState(str, Enum):
+    """Статус заявки, значение совпадает со строкой в orders.status"""
+    NEW = "new"
+    IN_PROGRESS = "in_progress"
+    COMPLETED = "completed"
+
+    @property
+    def label(self):
+        return _STATE_LABELS[self]
+
+
+_STATE_LABELS = {
+    OrderState.NEW: "ожидает мастера",
+    OrderState.IN_PROGRESS: "принят мастером",
+    OrderState.COMPLETED: "выполнен",
+}
+
+
+# Строки таблицы orders. Имена полей совпадают с именами столбцов, поэтому список
+# столбцов для SELECT берется из _fields. NamedTuple не создает __dict__ у экземпляров,
+# а доступ по индексу (order[0]) продолжает работать.
+
+class Order(NamedTuple):
+    """Заявка целиком, в порядке столбцов таблицы"""
+    id: int
+    user_id: int
+    username: Optional[str]
+    category_id: Optional[int]
+    description: str
+    contacts: str
+    status: str
+    master_id: Optional[int]
+    master_name: Optional[str]
+    created_at: str
+    completed_at: Optional[str]
+
+
+class OrderCard(NamedTuple):
+    """Заявка в карточке мастера и в уведомлении: без user_id и данных о завершении"""
+    id: int
+    username: Optional[str]
+    category_id: Optional[int]
+    description: str
+    contacts: str
+    status: str
+    created_at: str
+
+
+class OrderTimes(NamedTuple):
+    """Заявка в планировщике сроков (sla.py): время - секунды Unix"""
+    id: int
+    user_id: int
+    category_id: Optional[int]
+    status: str
+    master_id: Optional[int]
+    created_at: int
+    assigned_at: Optional[int]
+
+
+class CompletedOrder(NamedTuple):
+    """Строка финансового отчета"""
+    id: int
+    master_id: Optional[int]
+    master_name: Optional[str]
+    category_id: Optional[int]
+    completed_at: str
+
+
+def columns(row_type):
+    """Список столбцов для SELECT строк row_type"""
+    return ", ".join(row_type._fields)
+
+
+def row_factory(row_type):
+    """row_factory для курсора sqlite3: кортеж строки сразу становится row_type.
+
+    tuple.__new__ принимает готовый кортеж целиком, без разбора аргументов по именам,
+    как это делает конструктор NamedTuple."""
+    new = tuple.__new__
+    return lambda cursor, row: new(row_type, row)
@@ -0,0 +1,264 @@
+import logging
+import queue
+import threading
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, TimedOut
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и 1 в секунду в один чат
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+
+
+class TokenBucket:
+    """Ограничитель скорости: в среднем rate событий в секунду, всплеск до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Занять токен и вернуть, сколько секунд нужно подождать до его появления"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+class _Job:
+    __slots__ = ('chat_id', 'text', 'parse_mode', 'callback', 'reply_markup', 'attempt', 'queued_at')
+
+    def __init__(self, chat_id, text, parse_mode, callback, reply_markup=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.callback = callback
+        self.reply_markup = reply_markup
+        self.attempt = 0
+        self.queued_at = time.monotonic()
+
+
+class Notifier:
+    """Фоновая рассылка сообщений пулом потоков.
+
+    Обработчик только ставит сообщение в очередь и сразу возвращается.
+    Потоки соблюдают общий лимит бота и интервал между сообщениями в один чат,
+    на 429 ждут retry_after, на сетевые ошибки повторяют с экспоненциальной паузой."""
+
+    def __init__(self, bot, workers=4, rate=GLOBAL_RATE, per_chat_interval=PER_CHAT_INTERVAL,
+                 max_attempts=5, backoff=1.0):
+        self.bot = bot
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._bucket = TokenBucket(rate)
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._chat_next_send = {}
+        self._paused_until = 0.0
+        self._counters = {'queued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'rate_limited': 0}
+        self._wait_total = 0.0
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"notifier-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        """Дождаться отправки уже поставленных сообщений и остановить потоки"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self, chat_id, text, parse_mode=None, callback=None, reply_markup=None):
+        """Поставить сообщение в очередь. callback(ok) вызывается после доставки или отказа"""
+        self._queue.put(_Job(chat_id, text, parse_mode, callback, reply_markup))
+        self._count('queued')
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            delivered = stats['sent'] + stats['failed']
+            stats['avg_wait'] = self._wait_total / delivered if delivered else 0.0
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            ok = self._deliver(job)
+            with self._lock:
+                self._counters['sent' if ok else 'failed'] += 1
+                self._wait_total += time.monotonic() - job.queued_at
+            if job.callback:
+                try:
+                    job.callback(ok)
+                except Exception:
+                    logger.exception("Ошибка в обработчике результата отправки")
+
+    def _wait_turn(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(now, self._paused_until, self._chat_next_send.get(chat_id, 0.0))
+            self._chat_next_send[chat_id] = send_at + self.per_chat_interval
+            if len(self._chat_next_send) > 10000:
+                self._chat_next_send = {chat: at for chat, at in self._chat_next_send.items() if at > now}
+        if send_at > now:
+            time.sleep(send_at - now)
+        self._bucket.acquire()
+
+    def _deliver(self, job):
+        while True:
+            job.attempt += 1
+            self._wait_turn(job.chat_id)
+            try:
+                self.bot.send_message(chat_id=job.chat_id, text=job.text, parse_mode=job.parse_mode,
+                                      reply_markup=job.reply_markup)
+                return True
+            except RetryAfter as e:
+                # Флуд-контроль действует на весь бот: притормаживаем все потоки
+                self._count('rate_limited')
+                with self._lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                if job.attempt >= self.max_attempts:
+                    return False
+            except BadRequest as e:
+                # Повтор не поможет: сообщение или чат некорректны
+                logger.warning("Telegram отклонил сообщение в чат %s: %s", job.chat_id, e)
+                return False
+            except (TimedOut, NetworkError) as e:
+                if job.attempt >= self.max_attempts:
+                    logger.warning("Не удалось отправить сообщение в чат %s: %s", job.chat_id, e)
+                    return False
+                time.sleep(self.backoff * 2 ** (job.attempt - 1))
+            except TelegramError as e:
+                logger.warning("Telegram отклонил сообщение в чат %s: %s", job.chat_id, e)
+                return False
+            self._count('retried')
+
+
+class OutboxWorker:
+    """Доставка уведомлений из таблицы outbox.
+
+    Поток забирает готовые записи пачками, отдает их Notifier и одной транзакцией
+    отмечает результат. Неудачные попытки откладываются с экспоненциальной паузой.
+    При старте записи, которые отправлялись в момент падения, возвращаются в очередь.
+
+    wakeup - событие для wake(); супервизор передает multiprocessing.Event,
+    чтобы рабочие процессы будили поток после записи заявки."""
+
+    def __init__(self, notifier, render, batch_size=50, interval=1.0, max_attempts=8, backoff=5.0, wakeup=None):
+        self.notifier = notifier
+        self.render = render
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._wakeup = wakeup or threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._sent = []
+        self._retries = []
+        self._failed = []
+        self._in_flight = 0
+        self._counters = {'claimed': 0, 'sent': 0, 'retried': 0, 'failed': 0}
+        self._started_at = None
+
+    def start(self):
+        released = database.release_outbox()
+        if released:
+            logger.info("Возвращено в очередь недоставленных уведомлений: %s", released)
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Перестать забирать записи, дождаться уже отданных в Notifier и сохранить результат"""
+        deadline = time.monotonic() + timeout
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        while self._in_flight and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._flush()
+
+    def wake(self):
+        """Разбудить поток сразу после записи новых уведомлений"""
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = self._in_flight
+        elapsed = time.monotonic() - self._started_at if self._started_at else 0.0
+        stats['sent_per_sec'] = stats['sent'] / elapsed if elapsed else 0.0
+        return stats
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            self._flush()
+            rows = database.claim_outbox_batch(self.batch_size)
+            if not rows:
+                self._wakeup.wait(self.interval)
+                continue
+            with self._lock:
+                self._counters['claimed'] += len(rows)
+                self._in_flight += len(rows)
+            orders = {order.id: order for order in database.get_orders_by_ids({row[1] for row in rows})}
+            for outbox_id, order_id, chat_id, attempts in rows:
+                order = orders.get(order_id)
+                if order is None:
+                    self._done(outbox_id, attempts, False, final=True)
+                    continue
+                self.notifier.notify(chat_id, self.render(order), parse_mode='Markdown',
+                                     callback=lambda ok, outbox_id=outbox_id, attempts=attempts:
+                                     self._done(outbox_id, attempts, ok))
+
+    def _done(self, outbox_id, attempts, ok, final=False):
+        with self._lock:
+            self._in_flight -= 1
+            if ok:
+                self._sent.append(outbox_id)
+                self._counters['sent'] += 1
+            elif final or attempts >= self.max_attempts:
+                self._failed.append(outbox_id)
+                self._counters['failed'] += 1
+            else:
+                self._retries.append((outbox_id, time.time() + self.backoff * 2 ** (attempts - 1)))
+                self._counters['retried'] += 1
+        self._wakeup.set()
+
+    def _flush(self):
+        with self._lock:
+            sent, retries, failed = self._sent, self._retries, self._failed
+            self._sent, self._retries, self._failed = [], [], []
+        if sent or retries or failed:
+            database.finish_outbox_batch(sent, retries, failed)
@@ -2,10 +2,14 @@
 chcp 65001 >nul
 title 🤖 Repair Bot 24/7
 
+rem Супервизор сам перезапускает упавшие рабочие процессы (см. supervisor.py),
+rem а этот цикл - сам супервизор, если он завершился (например, остановился прием обновлений)
+if "%BOT_WORKERS%"=="" set BOT_WORKERS=4
+
 :start
-echo [%date% %time%] Запускаем бота...
-python bot.py
+echo [%date% %time%] Запускаем бота, процессов: %BOT_WORKERS%
+python supervisor.py
 
-echo [%date% %time%] Бот остановился, перезапуск через 10 секунд...
+echo [%date% %time%] Бот остановился с кодом %errorlevel%, перезапуск через 10 секунд...
 timeout /t 10 /nobreak
-goto start
\ No newline at end of file
+goto start
@@ -0,0 +1,267 @@
+import heapq
+import logging
+import os
+import threading
+import time
+
+import database
+from app_constants import CATEGORY_IDS, SLA_DEFAULT_MINUTES, SLA_MAX_ALERTS, SLA_MINUTES
+from models import OrderState
+
+logger = logging.getLogger(__name__)
+
+# Планировщик сроков включен по умолчанию, SLA_ENABLED=0 выключает напоминания
+SLA_ENABLED = os.getenv('SLA_ENABLED', '1') == '1'
+# Как часто супервизор подбирает заявки, созданные рабочими процессами
+SLA_SYNC_INTERVAL = float(os.getenv('SLA_SYNC_INTERVAL', '30'))
+# Заявок в одном запросе к базе при срабатывании сроков и при подборе новых заявок
+SLA_FETCH_SIZE = 500
+
+# Уведомления, которые готовит render(event, order, waited_minutes) -> (text, reply_markup)
+ESCALATE = 'escalate'  # всем мастерам: новая заявка долго ждет
+CUSTOMER = 'customer'  # клиенту: заявка ждет, мастерам напомнили
+REMIND = 'remind'      # мастеру: заявка долго в работе
+
+# Статусы, у которых есть сроки
+_OPEN_STATES = {state.value: state for state in (OrderState.NEW, OrderState.IN_PROGRESS)}
+
+
+def category_thresholds(minutes=SLA_MINUTES):
+    """Сроки из app_constants по id категории: {category_id: {статус: секунды}}"""
+    return {category_id: _thresholds(minutes[key]) for key, category_id in CATEGORY_IDS.items() if key in minutes}
+
+
+def _thresholds(pair):
+    new_minutes, in_progress_minutes = pair
+    return {OrderState.NEW: new_minutes * 60, OrderState.IN_PROGRESS: in_progress_minutes * 60}
+
+
+class SlaScheduler:
+    """Напоминания о заявках, которые долго ждут мастера или долго в работе.
+
+    Сроки хранятся в памяти в куче (heapq) - ближайший всегда наверху. При запуске куча
+    заполняется одним проходом по частичным индексам открытых заявок, дальше каждое
+    событие заявки (создана, взята, завершена) стоит O(log n). В очереди заданий Updater
+    стоит одно задание на ближайший срок, таблица заявок периодически не просматривается.
+
+    Когда срок наступает, состояние заявки перечитывается из базы: заявку могли взять
+    или завершить в другом процессе (supervisor.py), тогда срок пересчитывается
+    или пропадает. Новая заявка, которую никто не взял, отправляется всем мастерам,
+    а клиент получает сообщение, что заявка не забыта; мастеру заявки в работе
+    приходит напоминание. Сроки задаются по категориям в app_constants.SLA_MINUTES,
+    напоминания повторяются не больше max_alerts раз. Напоминания, срок которых прошел,
+    пока бот не работал, не отправляются: после запуска ждется следующий срок."""
+
+    def __init__(self, notifier, render, masters, thresholds=None, default=SLA_DEFAULT_MINUTES,
+                 max_alerts=SLA_MAX_ALERTS, sync_interval=None):
+        self.notifier = notifier
+        self.render = render
+        self.masters = masters
+        self.thresholds = category_thresholds() if thresholds is None else thresholds
+        self.default = _thresholds(default)
+        self.max_alerts = max_alerts
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        # Куча (срок, id заявки, статус, номер напоминания) и действующий срок каждой заявки.
+        # Записи кучи, которые не совпадают с действующим сроком, устарели и пропускаются
+        self._heap = []
+        self._deadlines = {}
+        # Заявки, по которым уже были напоминания и которые, насколько известно, еще открыты
+        self._overdue = {state: set() for state in _OPEN_STATES.values()}
+        self._last_id = 0
+        self._job_queue = None
+        # Поставленное задание на ближайший срок и этот срок
+        self._job = None
+        self._armed_at = None
+        self._counters = {'escalated': 0, 'customers': 0, 'reminded': 0, 'rescheduled': 0, 'fired': 0}
+
+    def start(self, job_queue):
+        """Загрузить открытые заявки и поставить задание в job_queue (telegram.ext.JobQueue)"""
+        logger.info("Сроки заявок: отслеживается %s", self.load())
+        self._job_queue = job_queue
+        if self.sync_interval:
+            job_queue.run_repeating(self._on_sync, self.sync_interval, name="sla-sync")
+        with self._lock:
+            self._arm()
+        job_queue.start()
+
+    def load(self):
+        """Заполнить кучу открытыми заявками из базы. Возвращает число отслеживаемых заявок"""
+        orders, last_id = database.get_open_order_times()
+        now = time.time()
+        with self._lock:
+            self._heap = []
+            self._deadlines = {}
+            for order in orders:
+                self._schedule_order(order, now, push=False)
+            heapq.heapify(self._heap)
+            self._last_id = last_id
+            return len(self._deadlines)
+
+    def sync(self):
+        """Подобрать заявки, созданные после последней известной (в других процессах)"""
+        while True:
+            orders = database.get_order_times_after(self._last_id, SLA_FETCH_SIZE)
+            if not orders:
+                return
+            now = time.time()
+            with self._lock:
+                for order in orders:
+                    if order.id not in self._deadlines:
+                        self._schedule_order(order, now)
+                self._last_id = max(self._last_id, orders[-1].id)
+                self._arm()
+
+    def order_created(self, order_id, category_id):
+        with self._lock:
+            self._schedule(order_id, OrderState.NEW, category_id, time.time(), 1)
+            self._last_id = max(self._last_id, order_id)
+            self._arm()
+
+    def order_assigned(self, order_id, category_id):
+        with self._lock:
+            self._overdue[OrderState.NEW].discard(order_id)
+            self._schedule(order_id, OrderState.IN_PROGRESS, category_id, time.time(), 1)
+            self._arm()
+
+    def order_closed(self, order_id):
+        with self._lock:
+            # Запись в куче остается и будет пропущена, когда дойдет до верха
+            self._deadlines.pop(order_id, None)
+            for overdue in self._overdue.values():
+                overdue.discard(order_id)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats['tracked'] = len(self._deadlines)
+            stats['overdue_new'] = len(self._overdue[OrderState.NEW])
+            stats['overdue_in_progress'] = len(self._overdue[OrderState.IN_PROGRESS])
+        return stats
+
+    def run_due(self, now=None):
+        """Разослать напоминания по наступившим срокам. Возвращает число сработавших сроков"""
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, order_id, state, number = heapq.heappop(self._heap)
+                if self._deadlines.get(order_id) == (deadline, state, number):
+                    del self._deadlines[order_id]
+                    due.append((order_id, state, number))
+        for start in range(0, len(due), SLA_FETCH_SIZE):
+            chunk = due[start:start + SLA_FETCH_SIZE]
+            orders = {order.id: order for order in database.get_order_times([order_id for order_id, _, _ in chunk])}
+            for order_id, state, number in chunk:
+                order = orders.get(order_id)
+                if order is not None and order.status == state:
+                    self._alert(order, state, number, now)
+                    with self._lock:
+                        self._overdue[state].add(order_id)
+                        if order_id not in self._deadlines:
+                            self._schedule(order_id, state, order.category_id, self._since(order), number + 1)
+                    continue
+                # Заявку взяли или завершили в другом процессе. Если срок в новом статусе
+                # уже прошел, напоминание уйдет сразу, а не через период
+                with self._lock:
+                    self._overdue[state].discard(order_id)
+                    if order is not None and order_id not in self._deadlines:
+                        self._schedule_order(order, now, catch_up=True)
+                        self._arm()
+                self._count('rescheduled')
+        self._count('fired', len(due))
+        return len(due)
+
+    def _alert(self, order, state, number, now):
+        waited = int((now - self._since(order)) // 60)
+        if state == OrderState.NEW:
+            text, reply_markup = self.render(ESCALATE, order, waited)
+            for master_id in self.masters():
+                self.notifier.notify(master_id, text, parse_mode='Markdown', reply_markup=reply_markup)
+            self._count('escalated')
+            if number == 1:
+                text, reply_markup = self.render(CUSTOMER, order, waited)
+                self.notifier.notify(order.user_id, text, parse_mode='Markdown', reply_markup=reply_markup)
+                self._count('customers')
+        elif order.master_id is not None:
+            text, reply_markup = self.render(REMIND, order, waited)
+            self.notifier.notify(order.master_id, text, parse_mode='Markdown', reply_markup=reply_markup)
+            self._count('reminded')
+
+    @staticmethod
+    def _since(order):
+        if order.status == OrderState.IN_PROGRESS and order.assigned_at is not None:
+            return order.assigned_at
+        return order.created_at
+
+    def _schedule_order(self, order, now, push=True, catch_up=False):
+        """Срок заявки из базы: ближайшее напоминание после now, а с catch_up - последнее
+        уже наступившее, если оно есть (вызывается под self._lock)"""
+        state = _OPEN_STATES.get(order.status)
+        if state is None:
+            return
+        since = self._since(order)
+        passed = int((now - since) // self._threshold(order.category_id, state))
+        number = max(1, passed if catch_up else passed + 1)
+        self._schedule(order.id, state, order.category_id, since, number, push)
+
+    def _schedule(self, order_id, state, category_id, since, number, push=True):
+        """Поставить number-е напоминание по заявке (вызывается под self._lock)"""
+        if number > self.max_alerts:
+            self._deadlines.pop(order_id, None)
+            return
+        deadline = since + number * self._threshold(category_id, state)
+        self._deadlines[order_id] = (deadline, state, number)
+        entry = (deadline, order_id, state, number)
+        if not push:
+            self._heap.append(entry)
+            return
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._deadlines) + 1000:
+            # Устаревших записей стало больше, чем действующих: куча пересобирается за O(n)
+            self._heap = [(deadline, order_id, state, number)
+                          for order_id, (deadline, state, number) in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def _threshold(self, category_id, state):
+        return self.thresholds.get(category_id, self.default)[state]
+
+    def _arm(self):
+        """Поставить задание на ближайший срок, если оно еще не стоит раньше (вызывается под self._lock).
+
+        Задание на более поздний срок снимается, в очереди всегда не больше одного задания.
+        Сработав, оно разошлет то, что наступило к этому времени, и поставит следующее."""
+        if self._job_queue is None or not self._heap:
+            return
+        deadline = self._heap[0][0]
+        if self._job is not None:
+            if self._armed_at <= deadline:
+                return
+            self._job.schedule_removal()
+        self._armed_at = deadline
+        self._job = self._job_queue.run_once(self._on_job, max(0.0, deadline - time.time()), name="sla")
+
+    def _on_job(self, context):
+        now = time.time()
+        with self._lock:
+            if context.job is not self._job:
+                # Снятое задание, которое успело запуститься: следующее уже стоит
+                return
+            self._job = None
+            self._armed_at = None
+        try:
+            self.run_due(now)
+        except Exception:
+            logger.exception("Ошибка проверки сроков заявок")
+        with self._lock:
+            self._arm()
+
+    def _on_sync(self, context):
+        try:
+            self.sync()
+        except Exception:
+            logger.exception("Ошибка подбора новых заявок для сроков")
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Коды состояний диалога с клиентом
+STATE_MAIN = 0
+STATE_AWAITING_CATEGORY = 1
+STATE_AWAITING_DESCRIPTION = 2
+STATE_AWAITING_CONTACTS = 3
+
+# Сколько диалогов держать в памяти и сколько хранить брошенный диалог
+MAX_CONVERSATIONS = 100_000
+CONVERSATION_TTL = 24 * 60 * 60
+
+
+class Conversation:
+    """Состояние диалога одного пользователя"""
+    __slots__ = ('state', 'category', 'description', 'touched')
+
+    def __init__(self, state=STATE_MAIN, category=None, description=None, touched=0.0):
+        self.state = state
+        self.category = category
+        self.description = description
+        self.touched = touched
+
+
+class ConversationStore:
+    """Состояния диалогов с вытеснением по LRU и TTL.
+
+    В памяти хранится не больше max_size записей, давно не обновлявшиеся записи
+    удаляются. При persist=True изменения пачками пишутся в SQLite фоновым потоком,
+    так что после перезапуска клиент продолжает с того же шага.
+
+    write_through=True записывает каждое изменение сразу: так работают процессы
+    супервизора (см. supervisor.py), чтобы перезапущенный процесс не терял последний шаг."""
+
+    def __init__(self, max_size=MAX_CONVERSATIONS, ttl=CONVERSATION_TTL, persist=True, flush_interval=1.0,
+                 write_through=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persist = persist
+        self.flush_interval = flush_interval
+        self.write_through = write_through and persist
+        self._items = OrderedDict()
+        self._dirty = {}
+        self._lock = threading.Lock()
+        # Запись в базу по одной: иначе более старый снимок может закоммититься позже нового
+        self._flush_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, user_id):
+        """Диалог пользователя или None, если его нет или он устарел"""
+        now = time.time()
+        with self._lock:
+            conversation = self._items.get(user_id)
+            if conversation is not None:
+                if now - conversation.touched <= self.ttl:
+                    self._items.move_to_end(user_id)
+                    return conversation
+                self._forget(user_id)
+                return None
+            if user_id in self._dirty:
+                # Вытеснена из памяти, но еще не записана в базу
+                snapshot = self._dirty[user_id]
+                if snapshot is None or now - snapshot[3] > self.ttl:
+                    return None
+                conversation = Conversation(*snapshot)
+                self._put(user_id, conversation, now)
+                return conversation
+        if self.persist:
+            # Запись могла быть вытеснена из памяти, но остаться в базе
+            row = database.load_conversation(user_id, now - self.ttl)
+            if row:
+                with self._lock:
+                    conversation = self._items.get(user_id)
+                    if conversation is None and user_id not in self._dirty:
+                        conversation = Conversation(*row)
+                        self._put(user_id, conversation, now)
+                    return conversation
+        return None
+
+    def state(self, user_id):
+        conversation = self.get(user_id)
+        return conversation.state if conversation else STATE_MAIN
+
+    def set(self, user_id, state, **fields):
+        """Перевести диалог в состояние state и обновить поля category/description"""
+        conversation = self.get(user_id) or Conversation()
+        now = time.time()
+        with self._lock:
+            conversation.state = state
+            for name, value in fields.items():
+                setattr(conversation, name, value)
+            conversation.touched = now
+            self._put(user_id, conversation, now)
+            self._mark_dirty(user_id, conversation)
+        if self.write_through:
+            self.flush()
+
+    def reset(self, user_id):
+        """Завершить диалог"""
+        with self._lock:
+            self._forget(user_id)
+        if self.write_through:
+            self.flush()
+
+    def load(self):
+        """Восстановить недавние диалоги из базы после перезапуска"""
+        now = time.time()
+        rows = database.load_conversations(now - self.ttl, self.max_size)
+        with self._lock:
+            for user_id, state, category, description, touched in reversed(rows):
+                self._items[user_id] = Conversation(state, category, description, touched)
+        return len(rows)
+
+    def start(self):
+        if self.persist:
+            self._thread = threading.Thread(target=self._run, name="conversations", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def flush(self):
+        """Записать накопленные изменения в базу одной транзакцией"""
+        if not self.persist:
+            return
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+            saved = [(user_id, *snapshot) for user_id, snapshot in dirty.items() if snapshot is not None]
+            deleted = [user_id for user_id, snapshot in dirty.items() if snapshot is None]
+            try:
+                database.save_conversations(saved, deleted, time.time() - self.ttl)
+            except Exception:
+                # Вернем изменения в очередь, если их еще не перекрыли более свежие
+                with self._lock:
+                    for user_id, snapshot in dirty.items():
+                        self._dirty.setdefault(user_id, snapshot)
+                raise
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Не удалось сохранить состояния диалогов")
+
+    def _put(self, user_id, conversation, now):
+        items = self._items
+        items[user_id] = conversation
+        items.move_to_end(user_id)
+        # Слева лежат самые давно обновлявшиеся записи: сначала снимаем устаревшие,
+        # затем вытесняем лишние (в базе они остаются)
+        while items:
+            oldest_id, oldest = next(iter(items.items()))
+            if now - oldest.touched > self.ttl:
+                self._forget(oldest_id)
+            elif len(items) > self.max_size:
+                items.popitem(last=False)
+            else:
+                break
+
+    def _forget(self, user_id):
+        self._items.pop(user_id, None)
+        if self.persist:
+            self._dirty[user_id] = None
+
+    def _mark_dirty(self, user_id, conversation):
+        if self.persist:
+            self._dirty[user_id] = (conversation.state, conversation.category, conversation.description,
+                                    conversation.touched)
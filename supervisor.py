@@ -0,0 +1,304 @@
+"""Запуск бота в несколько процессов.
+
+Супервизор принимает обновления (long polling или webhook, см. BOT_MODE) и раздает их
+BOT_WORKERS рабочим процессам по ID чата: обновления одного чата всегда попадают
+в один процесс и обрабатываются по порядку. Общее состояние процессов живет в SQLite:
+счетчики заявок (order_counters), диалоги (пишутся сразу, без отложенной записи)
+и очередь уведомлений (outbox), которую доставляет сам супервизор.
+Упавший процесс перезапускается, его очередь обновлений сохраняется.
+
+    set BOT_WORKERS=4
+    python supervisor.py"""
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from multiprocessing.connection import wait
+
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import Updater
+
+import app_logging
+import bot
+import database
+from archiver import OrderArchiver
+from auto_dispatch import AUTO_DISPATCH, AutoDispatcher
+from notifier import Notifier, OutboxWorker
+from sla import SLA_ENABLED, SLA_SYNC_INTERVAL, SlaScheduler
+from state_store import ConversationStore
+from webhook import ShardedUpdateQueue, shard_key
+
+logger = logging.getLogger(__name__)
+
+# Упавший процесс перезапускается сразу; если он падает снова в течение STABLE_UPTIME
+# секунд после старта, пауза перед перезапуском удваивается, но не больше RESTART_MAX_DELAY
+STABLE_UPTIME = 60.0
+RESTART_DELAY = 0.5
+RESTART_MAX_DELAY = 30.0
+# Пауза после ошибки getUpdates удваивается с каждой ошибкой подряд, но не больше POLL_MAX_DELAY
+POLL_RETRY_DELAY = 1.0
+POLL_MAX_DELAY = 60.0
+
+
+class _OutboxSignal:
+    """Заменяет OutboxWorker в рабочем процессе: будит поток доставки в супервизоре"""
+
+    def __init__(self, wakeup):
+        self._wakeup = wakeup
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stats(self):
+        return {}
+
+
+def worker_main(number, updates, wakeup, db_path, threads):
+    """Рабочий процесс: обрабатывает обновления своей доли чатов в threads потоках"""
+    # Ctrl+C получают все процессы консоли, а останавливает рабочих супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    listener = app_logging.setup_logging()
+    # Заявки меняют и другие процессы, кэш заявок сверяется с PRAGMA data_version
+    database.configure(db_path, other_writers=True)
+    bot.conversations = ConversationStore(write_through=True)
+    bot.outbox_worker = _OutboxSignal(wakeup)
+    bot.db.start()
+    bot.conversations.start()
+
+    telegram_bot = bot.create_bot(threads + 4)
+    updater = Updater(bot=telegram_bot, use_context=True)
+    bot.register_handlers(updater.dispatcher, run_async=False)
+    processing = ShardedUpdateQueue(updater.dispatcher.process_update, workers=threads)
+    processing.start()
+    logger.info("Рабочий процесс %s запущен", number)
+
+    while True:
+        try:
+            data = updates.recv()
+        except EOFError:
+            break
+        if data is None:
+            break
+        processing.submit(Update.de_json(data, telegram_bot), timeout=None)
+
+    processing.stop()
+    updater.stop()
+    bot.conversations.stop()
+    bot.db.shutdown()
+    database.close_connections()
+    listener.stop()
+
+
+class Supervisor:
+    """Рабочие процессы с очередью обновлений у каждого.
+
+    submit() выбирает процесс по ID чата, поэтому Supervisor можно передать
+    в start_webhook_server вместо ShardedUpdateQueue.
+
+    Очередь процесса - буфер в супервизоре и Pipe, в который его перекладывает отдельный
+    поток. multiprocessing.Queue не подходит: процесс, убитый во время get(), оставляет
+    ее блокировку занятой, и перезапущенный процесс уже ничего из нее не получит.
+    У Pipe один читатель и нет общих блокировок, новый процесс читает с того же места."""
+
+    def __init__(self, workers, threads, db_path, wakeup, queue_size=1000):
+        self._context = multiprocessing.get_context('spawn')
+        self.workers = workers
+        self.threads = threads
+        self.db_path = db_path
+        self.wakeup = wakeup
+        self._buffers = [queue.Queue(queue_size) for _ in range(workers)]
+        self._pipes = [self._context.Pipe(duplex=False) for _ in range(workers)]
+        self._feeders = []
+        self._processes = [None] * workers
+        self._started_at = [0.0] * workers
+        self._restart_at = [0.0] * workers
+        self._failures = [0] * workers
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._monitor_thread = None
+        self.restarts = 0
+
+    def start(self):
+        for number in range(self.workers):
+            self._spawn(number)
+            feeder = threading.Thread(target=self._feed, args=(number,), name=f"feeder-{number}", daemon=True)
+            feeder.start()
+            self._feeders.append(feeder)
+        self._monitor_thread = threading.Thread(target=self._monitor, name="supervisor", daemon=True)
+        self._monitor_thread.start()
+
+    def stop(self, timeout=10.0):
+        """Дать процессам обработать принятые обновления и остановить их"""
+        self._stopping.set()
+        if self._monitor_thread:
+            self._monitor_thread.join()
+        for buffer in self._buffers:
+            buffer.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Процесс %s не остановился, завершаем принудительно", process.name)
+                process.terminate()
+                process.join()
+
+    def submit(self, update, timeout=5.0):
+        try:
+            self._buffers[shard_key(update) % self.workers].put(update.to_dict(), timeout=timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def _spawn(self, number):
+        process = self._context.Process(
+            target=worker_main, name=f"bot-worker-{number}",
+            args=(number, self._pipes[number][0], self.wakeup, self.db_path, self.threads))
+        process.start()
+        with self._lock:
+            self._processes[number] = process
+            self._started_at[number] = time.monotonic()
+
+    def _feed(self, number):
+        buffer = self._buffers[number]
+        writer = self._pipes[number][1]
+        while True:
+            data = buffer.get()
+            # Если процесс упал, send ждет, пока перезапущенный не начнет читать
+            writer.send(data)
+            if data is None:
+                return
+
+    def _monitor(self):
+        while not self._stopping.is_set():
+            now = time.monotonic()
+            for number, process in enumerate(self._processes):
+                if process is None:
+                    if now >= self._restart_at[number]:
+                        self._spawn(number)
+                        self.restarts += 1
+                elif not process.is_alive():
+                    process.join()
+                    if now - self._started_at[number] >= STABLE_UPTIME:
+                        self._failures[number] = 0
+                    else:
+                        self._failures[number] += 1
+                    delay = 0.0
+                    if self._failures[number]:
+                        delay = min(RESTART_MAX_DELAY, RESTART_DELAY * 2 ** (self._failures[number] - 1))
+                    logger.error("Процесс %s завершился с кодом %s, перезапуск через %.1f с",
+                                 process.name, process.exitcode, delay)
+                    with self._lock:
+                        self._processes[number] = None
+                    self._restart_at[number] = now + delay
+            sentinels = [process.sentinel for process in self._processes if process is not None]
+            if sentinels:
+                wait(sentinels, timeout=0.2)
+            else:
+                time.sleep(0.2)
+
+
+def poll_updates(telegram_bot, supervisor, stopping):
+    """Long polling в супервизоре: getUpdates и раздача обновлений процессам.
+
+    Ошибки Telegram и сети не останавливают поток: на 429 он ждет retry_after,
+    на остальные (в том числе Conflict и Unauthorized) повторяет с растущей паузой.
+    Если поток все же завершился не по stopping, супервизор завершается с ошибкой (см. main)"""
+    offset = None
+    webhook_deleted = False
+    failures = 0
+    try:
+        while not stopping.is_set():
+            try:
+                if not webhook_deleted:
+                    telegram_bot.delete_webhook(drop_pending_updates=True)
+                    webhook_deleted = True
+                updates = telegram_bot.get_updates(offset=offset, timeout=5,
+                                                   allowed_updates=['message', 'callback_query'])
+            except RetryAfter as e:
+                logger.warning("getUpdates: флуд-контроль, пауза %.0f с", e.retry_after)
+                stopping.wait(e.retry_after)
+                continue
+            except Exception as e:
+                failures += 1
+                delay = min(POLL_MAX_DELAY, POLL_RETRY_DELAY * 2 ** (failures - 1))
+                logger.warning("Ошибка getUpdates (%s подряд): %r, повтор через %.0f с", failures, e, delay)
+                stopping.wait(delay)
+                continue
+            failures = 0
+            for update in updates:
+                supervisor.submit(update, timeout=None)
+                offset = update.update_id + 1
+    except Exception:
+        logger.exception("Прием обновлений остановлен")
+        raise
+
+
+def main():
+    listener = app_logging.setup_logging()
+    workers = int(os.getenv('BOT_WORKERS', str(os.cpu_count() or 2)))
+    threads = int(os.getenv('WORKER_THREADS', '4'))
+    database.init_db()
+
+    # Уведомления отправляет только супервизор: так соблюдается общий лимит Telegram на бота
+    telegram_bot = bot.create_bot(8)
+    wakeup = multiprocessing.get_context('spawn').Event()
+    notifier = Notifier(telegram_bot)
+    notifier.start()
+    outbox_worker = OutboxWorker(notifier, bot.new_order_notification_text, wakeup=wakeup)
+    outbox_worker.start()
+    # Архивирование тоже только здесь, чтобы процессы не переносили одни и те же заявки
+    archiver = OrderArchiver()
+    archiver.start()
+    # Предложения заявок тоже рассылает супервизор, ответы мастеров обрабатывают рабочие процессы
+    auto_dispatcher = AutoDispatcher(notifier, bot.offer_message) if AUTO_DISPATCH else None
+    if auto_dispatcher:
+        auto_dispatcher.start()
+    # Сроки заявок тоже здесь: заявки рабочих процессов подбираются раз в SLA_SYNC_INTERVAL секунд,
+    # а взятые и завершенные в них заявки сверяются с базой, когда наступает их срок
+    job_queue = Updater(bot=telegram_bot, use_context=True).job_queue
+    if SLA_ENABLED:
+        SlaScheduler(notifier, bot.sla_message, bot.sla_masters, sync_interval=SLA_SYNC_INTERVAL).start(job_queue)
+
+    supervisor = Supervisor(workers, threads, database.DB_PATH, wakeup)
+    supervisor.start()
+    logger.info("Запущено рабочих процессов: %s, потоков в каждом: %s", workers, threads)
+
+    stopping = threading.Event()
+    exit_code = 0
+    if os.getenv('BOT_MODE', 'polling') == 'webhook':
+        server = bot.start_webhook(telegram_bot, supervisor)
+        bot.wait_for_stop_signal()
+        server.shutdown()
+    else:
+        poller = threading.Thread(target=poll_updates, args=(telegram_bot, supervisor, stopping),
+                                  name="polling", daemon=True)
+        poller.start()
+        if not bot.wait_for_stop_signal(alive=poller.is_alive):
+            # Без приема обновлений супервизор бесполезен: выходим с ошибкой, run_forever.bat перезапустит
+            logger.critical("Поток приема обновлений завершился, супервизор останавливается")
+            exit_code = 1
+        stopping.set()
+        poller.join()
+
+    supervisor.stop()
+    job_queue.stop()
+    if auto_dispatcher:
+        auto_dispatcher.stop()
+    archiver.stop()
+    outbox_worker.stop()
+    notifier.stop()
+    database.close_connections()
+    listener.stop()
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    """Пустая база заявок во временном каталоге на время теста"""
+    original = database.DB_PATH
+    path = str(tmp_path / "orders.db")
+    database.configure(path)
+    database.init_db()
+    yield path
+    database.configure(original)
@@ -0,0 +1,119 @@
+import sqlite3
+import threading
+
+import pytest
+
+import database
+
+
+def create_order():
+    return database.save_order(100, "customer", 1, "Течет кран", "+7 900 000-00-00")
+
+
+def status(order_id):
+    return database.get_order_by_id(order_id).status
+
+
+def active(master_id):
+    return [order.id for order in database.get_master_active_orders(master_id)]
+
+
+def test_claim_and_complete_are_never_stale(db_path):
+    order_id = create_order()
+    assert status(order_id) == 'new'
+    assert active(1000) == []
+
+    assert database.claim_order(order_id, 1000, "Мастер") == database.CLAIM_WON
+    assert status(order_id) == 'in_progress'
+    assert active(1000) == [order_id]
+
+    database.complete_order(order_id)
+    assert status(order_id) == 'completed'
+    assert active(1000) == []
+
+
+def test_reads_are_served_from_cache(db_path):
+    order_id = create_order()
+    status(order_id)
+    before = database.cache_stats()['orders']
+    status(order_id)
+    after = database.cache_stats()['orders']
+    assert after['hits'] == before['hits'] + 1
+
+
+def test_savepoint_rollback_in_write_batch(db_path):
+    order_id, other_id = create_order(), create_order()
+    assert status(order_id) == 'new'
+
+    with database.write_batch():
+        assert database.claim_order(other_id, 1001, "Другой") == database.CLAIM_WON
+        with pytest.raises(RuntimeError):
+            with database.write_batch():
+                assert database.claim_order(order_id, 1000, "Мастер") == database.CLAIM_WON
+                # Чтение внутри транзакции видит незакоммиченные изменения
+                assert status(order_id) == 'in_progress'
+                assert active(1000) == [order_id]
+                raise RuntimeError("откат точки сохранения")
+
+    assert status(order_id) == 'new'
+    assert active(1000) == []
+    assert status(other_id) == 'in_progress'
+    assert active(1001) == [other_id]
+
+
+def test_rolled_back_batch_leaves_no_stale_entries(db_path):
+    order_id = create_order()
+    assert status(order_id) == 'new'
+
+    with pytest.raises(RuntimeError):
+        with database.write_batch():
+            database.claim_order(order_id, 1000, "Мастер")
+            assert status(order_id) == 'in_progress'
+            raise RuntimeError("откат всей пачки")
+
+    assert status(order_id) == 'new'
+    assert active(1000) == []
+
+
+def test_other_writers_see_commits_of_other_connections(db_path):
+    database.configure(db_path, other_writers=True)
+    order_id = create_order()
+    assert status(order_id) == 'new'
+    assert active(1000) == []
+
+    # Заявку берет другой процесс: у него свое соединение и свой кэш
+    other = sqlite3.connect(db_path, isolation_level=None)
+    other.execute("UPDATE orders SET status = 'in_progress', master_id = 1000 WHERE id = ?", (order_id,))
+    assert status(order_id) == 'in_progress'
+    assert active(1000) == [order_id]
+
+    other.execute("UPDATE orders SET status = 'completed' WHERE id = ?", (order_id,))
+    other.close()
+    assert status(order_id) == 'completed'
+    assert active(1000) == []
+
+
+def test_concurrent_reads_do_not_cache_stale_rows(db_path):
+    order_ids = [create_order() for _ in range(20)]
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            for order_id in order_ids:
+                database.get_order_by_id(order_id)
+            database.get_master_active_orders(1000)
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in readers:
+        thread.start()
+    try:
+        for order_id in order_ids:
+            assert database.claim_order(order_id, 1000, "Мастер") == database.CLAIM_WON
+            database.complete_order(order_id)
+    finally:
+        stop.set()
+        for thread in readers:
+            thread.join()
+
+    assert [status(order_id) for order_id in order_ids] == ['completed'] * len(order_ids)
+    assert active(1000) == []
@@ -0,0 +1,50 @@
+import pytest
+
+import callbacks
+from app_constants import CATEGORY_IDS
+from callbacks import Callback, decode, encode
+
+# Все категории, включая ключи с подчеркиванием (doors_windows), на которых ломается split("_")
+CATEGORIES = ["all", *CATEGORY_IDS]
+
+
+@pytest.mark.parametrize("action", list(callbacks.ACTION_NAMES))
+def test_codec_round_trip(action):
+    for category in CATEGORIES:
+        for order_id, cursor in ((0, 0), (15, 0), (2 ** 40, 3)):
+            data = encode(action, order_id, category, cursor)
+            assert len(data.encode("utf-8")) <= 64
+            assert decode(data) == Callback(action, order_id, category, cursor)
+
+
+def test_legacy_exact_buttons():
+    assert decode("admin_show_categories") == Callback(callbacks.ADMIN_CATEGORIES)
+    assert decode("admin_refresh") == Callback(callbacks.ADMIN_REFRESH)
+    assert decode("admin_back") == Callback(callbacks.ADMIN_BACK)
+    assert decode("admin_close") == Callback(callbacks.ADMIN_CLOSE)
+    assert decode("admin_all_orders") == Callback(callbacks.SHOW_ORDERS)
+
+
+@pytest.mark.parametrize("category", CATEGORIES)
+def test_legacy_category_buttons(category):
+    if category != "all":
+        assert decode(f"category_{category}") == Callback(callbacks.PICK_CATEGORY, category=category)
+    assert decode(f"admin_category_{category}") == Callback(callbacks.SHOW_ORDERS, category=category)
+    assert decode(f"admin_back_to_{category}") == Callback(callbacks.SHOW_ORDERS, category=category)
+
+
+@pytest.mark.parametrize("category", CATEGORIES)
+def test_legacy_order_buttons(category):
+    assert decode(f"next_15_{category}") == Callback(callbacks.NEXT_ORDER, 15, category)
+    assert decode(f"prev_15_{category}") == Callback(callbacks.PREV_ORDER, 15, category)
+    assert decode("take_15") == Callback(callbacks.TAKE_ORDER, 15)
+    assert decode("show_my_order_15") == Callback(callbacks.MY_ORDER, 15)
+    assert decode("complete_15") == Callback(callbacks.COMPLETE_ORDER, 15)
+
+
+@pytest.mark.parametrize("data", [
+    "", "1", "1!!!", "category_", "category_unknown", "admin_category_doors", "next_15_doors",
+    "next_x_plumbing", "take_", "take_15x", "complete_-1", "unknown_15",
+])
+def test_unknown_data(data):
+    assert decode(data) == Callback(0)
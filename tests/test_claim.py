@@ -0,0 +1,88 @@
+import random
+import threading
+
+import pytest
+
+import database
+from db_executor import DatabaseExecutor
+
+ORDERS = 20
+MASTERS = 50
+
+
+def create_orders(count):
+    return [database.save_order(100 + index, f"user{index}", index % 6 + 1, "Течет кран", "+7 900 000-00-00")
+            for index in range(count)]
+
+
+def race(order_ids, claim):
+    """Каждый мастер в своем потоке перебирает заявки в случайном порядке, пока не возьмет одну.
+    Возвращает [(order_id, master_id, результат)] всех попыток"""
+    barrier = threading.Barrier(MASTERS)
+    attempts = []
+    lock = threading.Lock()
+
+    def master(master_id):
+        candidates = list(order_ids)
+        random.Random(master_id).shuffle(candidates)
+        barrier.wait()
+        for order_id in candidates:
+            result = claim(order_id, master_id, f"Мастер {master_id}")
+            with lock:
+                attempts.append((order_id, master_id, result))
+            if result == database.CLAIM_WON:
+                return
+
+    threads = [threading.Thread(target=master, args=(1000 + index,)) for index in range(MASTERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return attempts
+
+
+def check_claims(order_ids, attempts):
+    winners = [(order_id, master_id) for order_id, master_id, result in attempts if result == database.CLAIM_WON]
+    assert len(winners) == ORDERS
+    assert sorted(order_id for order_id, _ in winners) == sorted(order_ids)
+    # У мастера не больше одной заявки в работе
+    assert len({master_id for _, master_id in winners}) == ORDERS
+
+    conn = database.get_connection()
+    rows = dict(conn.execute("SELECT id, master_id FROM orders WHERE status = 'in_progress'").fetchall())
+    assert rows == dict(winners)
+    assert conn.execute("SELECT COUNT(*) FROM orders WHERE status = 'new'").fetchone()[0] == 0
+
+    counters = {(status, category_id): count for status, category_id, count in conn.execute(
+        "SELECT status, category_id, count FROM order_counters WHERE count != 0")}
+    actual = {(status, category_id): count for status, category_id, count in conn.execute(
+        "SELECT status, category_id, COUNT(*) FROM orders GROUP BY status, category_id")}
+    assert counters == actual
+
+
+def test_concurrent_claims(db_path):
+    order_ids = create_orders(ORDERS)
+    attempts = race(order_ids, database.claim_order)
+    check_claims(order_ids, attempts)
+
+
+@pytest.mark.parametrize("batch_size", [1, 100])
+def test_concurrent_claims_through_executor(db_path, batch_size):
+    order_ids = create_orders(ORDERS)
+    db = DatabaseExecutor(readers=2, batch_size=batch_size)
+    db.start()
+    try:
+        attempts = race(order_ids, lambda *args: db.write(database.claim_order, *args).result(timeout=10))
+    finally:
+        db.shutdown()
+    check_claims(order_ids, attempts)
+
+
+def test_busy_master_cannot_claim_second_order(db_path):
+    first, second = create_orders(2)
+    assert database.claim_order(first, 1000, "Мастер") == database.CLAIM_WON
+    assert database.claim_order(second, 1000, "Мастер") == database.CLAIM_BUSY
+    assert database.claim_order(first, 1001, "Другой") == database.CLAIM_LOST
+
+    database.complete_order(first)
+    assert database.claim_order(second, 1000, "Мастер") == database.CLAIM_WON
@@ -0,0 +1,84 @@
+import threading
+import types
+
+from callbacks import NEXT_ORDER, SHOW_ORDERS, CallbackRouter, encode
+from coalescer import RenderCoalescer
+
+
+class FakeQuery:
+    """Нажатие на кнопку сообщения 1 в чате 1: считает ответы и правки, отправленные в Telegram"""
+
+    def __init__(self, data, calls):
+        self.data = data
+        self.message = types.SimpleNamespace(chat_id=1, message_id=1)
+        self.calls = calls
+
+    def answer(self, *args, **kwargs):
+        self.calls.append(('answer', self.data))
+        return True
+
+    def edit_message_text(self, text, **kwargs):
+        self.calls.append(('edit', text))
+
+
+def make_router(coalescer, started, release):
+    """Обработчик отвечает на нажатие и перерисовывает сообщение. Первая отрисовка
+    ждет release, чтобы следующие нажатия пришли, пока она выполняется"""
+    def handler(update, context, callback):
+        started.set()
+        release.wait(5)
+        update.callback_query.answer()
+        update.callback_query.edit_message_text(f"заявка {callback.order_id}")
+
+    return CallbackRouter({SHOW_ORDERS: handler, NEXT_ORDER: handler}, coalescer=coalescer,
+                          coalesce={SHOW_ORDERS, NEXT_ORDER})
+
+
+def press(router, data, calls):
+    update = types.SimpleNamespace(callback_query=FakeQuery(data, calls),
+                                   effective_user=types.SimpleNamespace(id=1))
+    router(update, None)
+
+
+def test_pending_press_that_is_rendered_is_not_counted():
+    coalescer = RenderCoalescer()
+    calls = []
+    started, release = threading.Event(), threading.Event()
+    router = make_router(coalescer, started, release)
+
+    first = threading.Thread(target=press, args=(router, encode(SHOW_ORDERS), calls))
+    first.start()
+    assert started.wait(5)
+    # Повтор текущей отрисовки отбрасывается, из двух ожидающих остается последнее
+    press(router, encode(SHOW_ORDERS), calls)
+    press(router, encode(NEXT_ORDER, 1), calls)
+    press(router, encode(NEXT_ORDER, 2), calls)
+    release.set()
+    first.join(5)
+
+    assert [text for kind, text in calls if kind == 'edit'] == ["заявка 0", "заявка 2"]
+    assert len([kind for kind, _ in calls if kind == 'answer']) == 4
+    stats = coalescer.stats()
+    assert (stats['callbacks'], stats['coalesced'], stats['edits']) == (4, 2, 2)
+    # Ответ отложенной отрисовки уже отправлен за нее и ничего не экономит
+    assert stats['answers_skipped'] == 0
+    assert stats['api_calls_saved'] == 2
+
+
+def test_repeated_answer_and_unchanged_edit_are_saved():
+    coalescer = RenderCoalescer(window=0.0)
+    calls = []
+
+    def handler(update, context, callback):
+        update.callback_query.answer()
+        update.callback_query.answer("еще раз")
+        update.callback_query.edit_message_text("список")
+
+    router = CallbackRouter({SHOW_ORDERS: handler}, coalescer=coalescer, coalesce={SHOW_ORDERS})
+    press(router, encode(SHOW_ORDERS), calls)
+    press(router, encode(SHOW_ORDERS), calls)
+
+    assert calls == [('answer', encode(SHOW_ORDERS)), ('edit', "список"), ('answer', encode(SHOW_ORDERS))]
+    stats = coalescer.stats()
+    assert (stats['coalesced'], stats['edits'], stats['edits_skipped'], stats['answers_skipped']) == (0, 1, 1, 2)
+    assert stats['api_calls_saved'] == 3
@@ -0,0 +1,26 @@
+import pytest
+
+import database
+from db_executor import DatabaseExecutor
+
+# Значения PRAGMA synchronous
+SYNCHRONOUS_VALUES = {'OFF': 0, 'NORMAL': 1, 'FULL': 2}
+
+
+def writer_synchronous(db):
+    return db.write(lambda: database.get_connection().execute("PRAGMA synchronous").fetchone()[0]).result(timeout=10)
+
+
+@pytest.mark.parametrize("mode", [None, 'FULL', 'off'])
+def test_writer_synchronous_mode(db_path, mode):
+    db = DatabaseExecutor(readers=1, synchronous=mode)
+    db.start()
+    try:
+        assert writer_synchronous(db) == SYNCHRONOUS_VALUES[(mode or 'NORMAL').upper()]
+    finally:
+        db.shutdown()
+
+
+def test_unknown_synchronous_mode_fails_at_construction():
+    with pytest.raises(ValueError):
+        DatabaseExecutor(synchronous='SOMETIMES')
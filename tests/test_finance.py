@@ -0,0 +1,63 @@
+import sqlite3
+
+import database
+
+
+def finance(since_day='2000-01-01'):
+    return database.get_finance_summary()['total'], database.get_finance_by_day(since_day)
+
+
+def test_complete_order_without_category(db_path):
+    order_id = database.save_order(100, "customer", None, "Течет кран", "+7 900 000-00-00")
+    assert database.claim_order(order_id, 1000, "Мастер") == database.CLAIM_WON
+    database.complete_order(order_id)
+
+    total, by_day = finance()
+    assert total == 1
+    assert [(category_id, completed) for _, category_id, completed in by_day] == [(0, 1)]
+    assert database.get_master_earnings(1000) == 1
+
+
+def test_complete_unassigned_order(db_path):
+    order_id = database.save_order(100, "customer", 1, "Течет кран", "+7 900 000-00-00")
+    database.update_order_status(order_id, 'completed')
+
+    assert finance()[0] == 1
+    assert database.get_finance_summary()['by_master'] == [(0, None, 1)]
+    # Возврат в работу снимает заявку со сводок
+    database.update_order_status(order_id, 'new')
+    total, by_day = finance()
+    assert total == 0 and all(completed == 0 for _, _, completed in by_day)
+
+
+def test_migrate_legacy_orders_without_master_or_category(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE orders (
+                 id INTEGER PRIMARY KEY AUTOINCREMENT,
+                 user_id INTEGER,
+                 username TEXT,
+                 category TEXT,
+                 description TEXT,
+                 contacts TEXT,
+                 status TEXT DEFAULT 'new',
+                 master_id INTEGER DEFAULT NULL,
+                 master_name TEXT DEFAULT NULL,
+                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    conn.executemany("INSERT INTO orders (user_id, category, description, status, master_id, master_name) "
+                     "VALUES (100, ?, 'Заявка', 'completed', ?, ?)",
+                     [(None, None, None), (None, 1000, "Мастер"), ("Сантехника", None, None)])
+    conn.commit()
+    conn.close()
+
+    original = database.DB_PATH
+    database.configure(path)
+    try:
+        database.init_db()
+        total, by_day = finance()
+        assert total == 3
+        by_master = {master_id: completed for master_id, _, completed in database.get_finance_summary()['by_master']}
+        assert by_master == {0: 2, 1000: 1}
+        assert sum(completed for _, _, completed in by_day) == 3
+    finally:
+        database.configure(original)
@@ -0,0 +1,54 @@
+import sqlite3
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def conn():
+    metrics.registry.reset()
+    conn = sqlite3.connect(":memory:", isolation_level=None, factory=metrics.TimedConnection)
+    conn.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, status TEXT)")
+    conn.executemany("INSERT INTO orders (status) VALUES (?)", [("new",), ("new",), ("completed",)])
+    yield conn
+    conn.close()
+    metrics.registry.reset()
+
+
+def recorded(sql):
+    histogram = metrics.registry.histograms.get(f"sql:{sql}")
+    return (histogram.count if histogram else 0), metrics.registry.counters.get(f"sql_rows:{sql}")
+
+
+def test_select_consumed_by_iteration_is_recorded(conn):
+    sql = "SELECT id FROM orders WHERE status = ?"
+    assert [row[0] for row in conn.execute(sql, ("new",))] == [1, 2]
+    assert recorded(sql) == (1, 2)
+
+
+def test_select_closed_before_the_end_is_recorded(conn):
+    sql = "SELECT id FROM orders"
+    cursor = conn.execute(sql)
+    next(cursor)
+    cursor.close()
+    assert recorded(sql) == (1, 1)
+
+
+def test_fetch_methods_record_once(conn):
+    sql = "SELECT id FROM orders"
+    assert len(conn.execute(sql).fetchall()) == 3
+    assert len(conn.execute(sql).fetchmany(2)) == 2
+    assert conn.execute(sql).fetchone() == (1,)
+    assert recorded(sql) == (3, 6)
+
+
+def test_slow_log_skips_transaction_statements(conn, monkeypatch):
+    monkeypatch.setattr(metrics, 'SLOW_QUERY_SECONDS', 0.0)
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("UPDATE orders SET status = 'in_progress' WHERE id = 1")
+    conn.execute("COMMIT")
+    conn.execute("PRAGMA user_version")
+    assert [sql for _, _, sql, _ in metrics.registry.slow_queries] == [
+        "UPDATE orders SET status = 'in_progress' WHERE id = 1"]
+    assert recorded("BEGIN IMMEDIATE")[0] == 1
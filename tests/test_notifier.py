@@ -0,0 +1,135 @@
+import threading
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+from notifier import Notifier
+
+# Запас на неточность таймеров при сравнении пауз
+EPSILON = 0.01
+
+
+class FakeBot:
+    """Bot с заготовленными ошибками: errors[chat_id] - исключения по очереди попыток,
+    когда они кончаются, сообщения уходят. Время каждой попытки записывается"""
+
+    def __init__(self, errors=None, always=None):
+        self.errors = {chat_id: list(chat_errors) for chat_id, chat_errors in (errors or {}).items()}
+        self.always = always
+        self.attempts = []
+        self.raised = threading.Event()
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, parse_mode=None, reply_markup=None):
+        with self._lock:
+            self.attempts.append((chat_id, time.monotonic()))
+            chat_errors = self.errors.get(chat_id)
+            error = chat_errors.pop(0) if chat_errors else self.always
+        if error is not None:
+            self.raised.set()
+            raise error
+
+    def times(self, chat_id):
+        return [at for chat, at in self.attempts if chat == chat_id]
+
+
+def run(bot, messages, **kwargs):
+    """Отправить сообщения [(chat_id, text)] и дождаться результатов. Возвращает (notifier, результаты)"""
+    kwargs.setdefault('per_chat_interval', 0.0)
+    kwargs.setdefault('backoff', 0.05)
+    notifier = Notifier(bot, workers=4, rate=1000, **kwargs)
+    results = {}
+    done = threading.Semaphore(0)
+
+    def finished(chat_id, text):
+        def callback(ok):
+            results[(chat_id, text)] = ok
+            done.release()
+        return callback
+
+    notifier.start()
+    try:
+        for chat_id, text in messages:
+            notifier.notify(chat_id, text, callback=finished(chat_id, text))
+        for _ in messages:
+            assert done.acquire(timeout=10)
+    finally:
+        notifier.stop()
+    return notifier, results
+
+
+def test_retry_after_pauses_all_chats():
+    bot = FakeBot(errors={1: [RetryAfter(0.3)]})
+    notifier = Notifier(bot, workers=4, rate=1000, per_chat_interval=0.0)
+    sent = threading.Semaphore(0)
+    notifier.start()
+    try:
+        notifier.notify(1, "первое", callback=lambda ok: sent.release())
+        assert bot.raised.wait(5)
+        paused_at = bot.times(1)[0]
+        notifier.notify(2, "второе", callback=lambda ok: sent.release())
+        assert sent.acquire(timeout=5) and sent.acquire(timeout=5)
+    finally:
+        notifier.stop()
+
+    # Повтор в тот же чат и сообщение в другой чат ждут, пока действует флуд-контроль
+    assert bot.times(1)[1] - paused_at >= 0.3 - EPSILON
+    assert bot.times(2)[0] - paused_at >= 0.3 - EPSILON
+    stats = notifier.stats()
+    assert (stats['sent'], stats['failed'], stats['rate_limited'], stats['retried']) == (2, 0, 1, 1)
+
+
+def test_network_errors_retry_with_exponential_backoff():
+    bot = FakeBot(errors={1: [TimedOut(), NetworkError("connection reset")]})
+    notifier, results = run(bot, [(1, "заявка")], backoff=0.05)
+
+    assert results == {(1, "заявка"): True}
+    first, second, third = bot.times(1)
+    assert second - first >= 0.05 - EPSILON
+    assert third - second >= 0.1 - EPSILON
+    stats = notifier.stats()
+    assert (stats['sent'], stats['failed'], stats['retried']) == (1, 0, 2)
+
+
+def test_attempt_limit():
+    bot = FakeBot(always=TimedOut())
+    notifier, results = run(bot, [(1, "заявка")], max_attempts=3, backoff=0.01)
+
+    assert results == {(1, "заявка"): False}
+    assert len(bot.times(1)) == 3
+    stats = notifier.stats()
+    assert (stats['sent'], stats['failed'], stats['retried']) == (0, 1, 2)
+
+
+def test_retry_after_attempt_limit():
+    bot = FakeBot(always=RetryAfter(0.01))
+    notifier, results = run(bot, [(1, "заявка")], max_attempts=2)
+
+    assert results == {(1, "заявка"): False}
+    assert len(bot.times(1)) == 2
+    stats = notifier.stats()
+    assert (stats['failed'], stats['rate_limited'], stats['retried']) == (1, 2, 1)
+
+
+def test_bad_request_is_not_retried():
+    bot = FakeBot(errors={1: [BadRequest("Chat not found")]})
+    notifier, results = run(bot, [(1, "заявка"), (2, "заявка")])
+
+    assert results == {(1, "заявка"): False, (2, "заявка"): True}
+    assert len(bot.times(1)) == 1
+    stats = notifier.stats()
+    assert (stats['queued'], stats['sent'], stats['failed'], stats['retried']) == (2, 1, 1, 0)
+
+
+def test_per_chat_spacing():
+    bot = FakeBot()
+    messages = [(1, f"сообщение {number}") for number in range(3)] + [(2, "другой чат"), (3, "другой чат")]
+    notifier, results = run(bot, messages, per_chat_interval=0.2)
+
+    assert all(results.values())
+    times = bot.times(1)
+    assert all(later - earlier >= 0.2 - EPSILON for earlier, later in zip(times, times[1:]))
+    # Другие чаты не ждут очереди первого
+    assert bot.times(2)[0] - times[0] < 0.2
+    assert bot.times(3)[0] - times[0] < 0.2
+    assert notifier.stats()['sent'] == 5
@@ -0,0 +1,45 @@
+import os
+
+import database
+from app_constants import CATEGORY_IDS
+
+# Размер таблицы можно поднять до боевого: QUERY_PLANS_ROWS=1000000 pytest tests/test_query_plans.py
+ROWS = int(os.getenv('QUERY_PLANS_ROWS', '100000'))
+
+
+def seed_orders(count):
+    """Заявки во всех статусах: 1% новых, 1% в работе, остальные завершены"""
+    with database.write_batch():
+        database.get_connection().execute(
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+            "INSERT INTO orders (user_id, username, category_id, description, contacts, status, "
+            "master_id, created_at, assigned_at, completed_at) "
+            "SELECT i, 'user' || i, i % 6 + 1, 'Протекает бойлер ' || i, '+7 900 000-00-00', "
+            "CASE i % 100 WHEN 0 THEN 'new' WHEN 1 THEN 'in_progress' ELSE 'completed' END, "
+            "CASE i % 100 WHEN 0 THEN NULL ELSE i % 5000 END, datetime(1600000000 + i, 'unixepoch'), "
+            "CASE i % 100 WHEN 0 THEN NULL ELSE datetime(1600000060 + i, 'unixepoch') END, "
+            "CASE WHEN i % 100 > 1 THEN datetime(1600000600 + i, 'unixepoch') END FROM n", (count,))
+
+
+def test_hot_queries_use_indexes(db_path):
+    seed_orders(ROWS)
+    assert database.check_query_plans() == []
+
+    # Со статистикой планировщик выбирает планы по ней, они тоже не должны сканировать таблицу
+    database.get_connection().execute("ANALYZE")
+    database.close_connections()
+    assert database.check_query_plans() == []
+
+
+def test_new_order_navigation_matches_hot_queries(db_path):
+    seed_orders(1000)
+    first = database.get_new_order_near("all")
+    assert first.id == 100
+    assert database.get_new_order_near("all", first.id, 1).id == 200
+    assert database.get_new_order_near("all", first.id, -1).id == 1000
+    assert database.get_new_order_near("all", 1000, 1).id == 100
+    assert database.get_new_order_position(database.get_new_order_near("all", 300)) == 3
+
+    category_key = next(key for key, category_id in CATEGORY_IDS.items() if category_id == 100 % 6 + 1)
+    assert database.get_new_order_near(category_key).id == 100
+    assert [order.id for order in database.get_new_orders_by_category(category_key)] == [100, 400, 700, 1000]
@@ -0,0 +1,50 @@
+import database
+
+
+def create_orders():
+    return [database.save_order(100, "Иван", 1, description, contacts) for description, contacts in (
+        ("Течет бойлер", "+7 905 123-45-67"),
+        ("Не включается стиральная машина", "8 (905) 765-43-21, Мария"),
+        ("Сборка шкафа, дом 905", "ivan@example.com"),
+    )]
+
+
+def found(text):
+    orders, total = database.search_orders(text, 10)
+    assert total == len(orders)
+    return [order.id for order in orders]
+
+
+def test_phone_by_inner_fragment(db_path):
+    boiler, washer, wardrobe = create_orders()
+
+    assert found("9051234567") == [boiler]
+    assert found("1234567") == [boiler]
+    assert found("123-45-67") == [boiler]
+    assert found("+7 905 123 45 67") == [boiler]
+    assert found("(905) 765") == [washer]
+    # Число ищется и в тексте заявки, новые заявки первыми
+    assert found("905") == [wardrobe, washer, boiler]
+
+
+def test_word_queries_are_unchanged(db_path):
+    boiler, washer, wardrobe = create_orders()
+
+    assert found("бойлер") == [boiler]
+    assert found("мария") == [washer]
+    assert found("шкаф 905") == [wardrobe]
+    assert found("12") == []
+
+
+def test_migration_indexes_existing_contacts(db_path):
+    boiler, _, _ = create_orders()
+    # База версии 11: индекса телефонов еще нет
+    conn = database.get_connection()
+    for trigger in ("insert", "delete", "update"):
+        conn.execute(f"DROP TRIGGER orders_phone_fts_{trigger}")
+    conn.execute("DROP TABLE orders_phone_fts")
+    conn.execute("DROP VIEW orders_phones")
+    conn.execute("PRAGMA user_version = 11")
+
+    database.init_db()
+    assert found("1234567") == [boiler]
@@ -0,0 +1,74 @@
+import types
+
+from models import OrderState
+from sla import SlaScheduler
+
+# Категория 1 с долгими сроками, категория 2 с короткими
+THRESHOLDS = {1: {OrderState.NEW: 3600, OrderState.IN_PROGRESS: 3600},
+              2: {OrderState.NEW: 60, OrderState.IN_PROGRESS: 60}}
+
+
+class FakeJob:
+    def __init__(self, callback, when):
+        self.callback = callback
+        self.when = when
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class FakeJobQueue:
+    """JobQueue, задания которой запускаются вручную через fire()"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, name=None):
+        job = FakeJob(callback, when)
+        self.jobs.append(job)
+        return job
+
+    def pending(self):
+        return [job for job in self.jobs if not job.removed and job.callback is not None]
+
+    def fire(self, job):
+        callback, job.callback = job.callback, None
+        callback(types.SimpleNamespace(job=job))
+
+
+def make_scheduler():
+    scheduler = SlaScheduler(notifier=None, render=None, masters=list, thresholds=THRESHOLDS)
+    job_queue = FakeJobQueue()
+    scheduler._job_queue = job_queue
+    return scheduler, job_queue
+
+
+def test_earlier_deadline_replaces_armed_job():
+    scheduler, job_queue = make_scheduler()
+    scheduler.order_created(1, 1)
+    assert len(job_queue.pending()) == 1
+    scheduler.order_created(2, 2)
+    pending = job_queue.pending()
+    assert len(pending) == 1 and pending[0].when <= 60
+    # Более поздний срок не ставит нового задания
+    scheduler.order_created(3, 1)
+    assert job_queue.pending() == pending
+
+
+def test_create_close_cycles_keep_one_job():
+    scheduler, job_queue = make_scheduler()
+    scheduler.order_created(1, 1)
+    for order_id in range(2, 102):
+        scheduler.order_created(order_id, 2 if order_id % 2 else 1)
+        scheduler.order_closed(order_id)
+        assert len(job_queue.pending()) <= 1
+
+    # Срабатывание задания ставит одно следующее, снятые задания ничего не ставят
+    for _ in range(10):
+        (job,) = job_queue.pending()
+        job_queue.fire(job)
+        assert len(job_queue.pending()) == 1
+    for job in [job for job in job_queue.jobs if job.removed and job.callback is not None]:
+        job_queue.fire(job)
+    assert len(job_queue.pending()) == 1
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import database
+import state_store
+from state_store import STATE_AWAITING_CONTACTS, STATE_AWAITING_DESCRIPTION, ConversationStore
+
+
+def test_write_through_flushes_commit_in_order(db_path, monkeypatch):
+    """Сброс диалога (DELETE) не перекрывается более старым снимком из параллельной записи"""
+    save = database.save_conversations
+    slow = threading.Event()
+    first_save_started = threading.Event()
+
+    def slow_save(saved, deleted, expired_before):
+        if saved and slow.is_set() and not first_save_started.is_set():
+            # Первая запись задерживается, пока второй поток сбрасывает диалог
+            first_save_started.set()
+            time.sleep(0.2)
+        save(saved, deleted, expired_before)
+
+    monkeypatch.setattr(state_store.database, 'save_conversations', slow_save)
+    store = ConversationStore(write_through=True, flush_interval=0.01)
+    store.start()
+    try:
+        store.set(1, STATE_AWAITING_DESCRIPTION, category='plumbing')
+        slow.set()
+        writer = threading.Thread(target=store.set, args=(1, STATE_AWAITING_CONTACTS),
+                                  kwargs={'description': "Течет кран"})
+        writer.start()
+        assert first_save_started.wait(5)
+        store.reset(1)
+        writer.join()
+    finally:
+        store.stop()
+    assert database.load_conversation(1, 0) is None
+
+
+def test_restart_restores_conversation(db_path):
+    store = ConversationStore(write_through=True)
+    store.set(1, STATE_AWAITING_CONTACTS, category='plumbing', description="Течет кран")
+    store.stop()
+
+    restored = ConversationStore()
+    assert restored.load() == 1
+    conversation = restored.get(1)
+    assert (conversation.state, conversation.category, conversation.description) == (
+        STATE_AWAITING_CONTACTS, 'plumbing', "Течет кран")
@@ -0,0 +1,99 @@
+import signal
+import sys
+import threading
+import types
+
+from telegram.error import Conflict, NetworkError, RetryAfter, Unauthorized
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # Токен не нужен: Telegram заменен поддельным ботом
+    sys.modules['config'] = types.SimpleNamespace(BOT_TOKEN='123456:offline')
+
+import bot  # noqa: E402
+import supervisor  # noqa: E402
+
+
+class FakeBot:
+    """getUpdates по сценарию: исключение или список обновлений на каждый вызов"""
+
+    def __init__(self, script, stopping):
+        self.script = list(script)
+        self.stopping = stopping
+        self.webhook_deleted = 0
+
+    def delete_webhook(self, drop_pending_updates=False):
+        self.webhook_deleted += 1
+
+    def get_updates(self, offset=None, timeout=None, allowed_updates=None):
+        step = self.script.pop(0)
+        if not self.script:
+            self.stopping.set()
+        if isinstance(step, Exception):
+            raise step
+        return [types.SimpleNamespace(update_id=update_id) for update_id in step]
+
+
+class FakeSupervisor:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, update, timeout=5.0):
+        self.submitted.append(update.update_id)
+
+
+class RecordingEvent(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self.waits = []
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        return self.is_set()
+
+
+def test_polling_survives_telegram_errors(monkeypatch):
+    monkeypatch.setattr(supervisor, 'POLL_RETRY_DELAY', 1.0)
+    stopping = RecordingEvent()
+    fake_bot = FakeBot([[1, 2], RetryAfter(7), Conflict("terminated by other getUpdates request"),
+                        Unauthorized("Unauthorized"), NetworkError("reset"), ValueError("bad json"), [3], []],
+                       stopping)
+    received = FakeSupervisor()
+    supervisor.poll_updates(fake_bot, received, stopping)
+
+    assert received.submitted == [1, 2, 3]
+    assert fake_bot.webhook_deleted == 1
+    # retry_after, затем растущая пауза на остальные ошибки подряд
+    assert stopping.waits == [7.0, 1.0, 2.0, 4.0, 8.0]
+
+
+def test_backoff_is_capped_and_resets_after_success(monkeypatch):
+    monkeypatch.setattr(supervisor, 'POLL_RETRY_DELAY', 1.0)
+    monkeypatch.setattr(supervisor, 'POLL_MAX_DELAY', 3.0)
+    stopping = RecordingEvent()
+    errors = [NetworkError("reset")] * 3
+    fake_bot = FakeBot([*errors, [1], *errors, []], stopping)
+    supervisor.poll_updates(fake_bot, FakeSupervisor(), stopping)
+    assert stopping.waits == [1.0, 2.0, 3.0, 1.0, 2.0, 3.0]
+
+
+def test_stop_wait_ends_when_poller_dies():
+    handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        assert bot.wait_for_stop_signal(alive=lambda: False) is False
+    finally:
+        for sig, handler in handlers.items():
+            signal.signal(sig, handler)
+
+
+def test_sharded_handlers_run_in_shard_thread():
+    registered = []
+    application = types.SimpleNamespace(add_handler=registered.append)
+
+    bot.register_handlers(application, run_async=False)
+    assert registered and not any(handler.run_async for handler in registered)
+
+    registered.clear()
+    bot.register_handlers(application)
+    assert any(handler.run_async for handler in registered)
@@ -0,0 +1,113 @@
+import http.client
+import json
+import threading
+import types
+
+import pytest
+
+from webhook import SECRET_HEADER, ShardedUpdateQueue, start_webhook_server
+
+SECRET = "webhook-secret"
+PATH = "/telegram"
+
+
+def message_update(update_id, chat_id):
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'date': 0, 'text': "/start",
+                        'chat': {'id': chat_id, 'type': 'private'}}}
+
+
+class Client:
+    """HTTP-клиент webhook на одном keep-alive соединении"""
+
+    def __init__(self, server):
+        self.connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+
+    def post(self, body, path=PATH, secret=SECRET):
+        headers = {'Content-Type': 'application/json'}
+        if secret is not None:
+            headers[SECRET_HEADER] = secret
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.connection.request("POST", path, body, headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+    def close(self):
+        self.connection.close()
+
+
+@pytest.fixture
+def webhook():
+    """Запустить сервер на свободном порту: (server, updates, processed)"""
+    processed = []
+    updates = ShardedUpdateQueue(lambda update: processed.append((update.effective_chat.id, update.update_id)),
+                                 workers=4)
+    updates.start()
+    server = start_webhook_server(None, updates, SECRET, 0, host="127.0.0.1", path=PATH)
+    yield server, updates, processed
+    server.shutdown()
+    server.server_close()
+    updates.stop()
+
+
+def test_rejects_wrong_secret_path_and_body(webhook):
+    server, updates, processed = webhook
+    client = Client(server)
+    try:
+        assert client.post(message_update(1, 1), secret="wrong") == 403
+        assert client.post(message_update(1, 1), secret=None) == 403
+        assert client.post(message_update(1, 1), path="/other") == 404
+        assert client.post(b"{not json") == 400
+        assert client.post(b"[]") == 400
+    finally:
+        client.close()
+    updates.stop()
+    assert processed == []
+    assert updates.stats()['received'] == 0
+
+
+def test_updates_of_one_chat_keep_order(webhook):
+    server, updates, processed = webhook
+    chats = (101, 102, 103, 104, 105)
+    sent = [(chats[update_id % len(chats)], update_id) for update_id in range(1, 301)]
+    client = Client(server)
+    try:
+        assert all(client.post(message_update(update_id, chat_id)) == 200 for chat_id, update_id in sent)
+    finally:
+        client.close()
+    updates.stop()
+
+    assert sorted(processed) == sorted(sent)
+    for chat_id in chats:
+        order = [update_id for chat, update_id in processed if chat == chat_id]
+        assert order == sorted(order)
+
+
+def test_full_queue_returns_503():
+    started, release = threading.Event(), threading.Event()
+
+    def process(update):
+        started.set()
+        release.wait(10)
+
+    updates = ShardedUpdateQueue(process, workers=1, queue_size=1)
+    updates.start()
+    # Сервер ждет места в очереди 0.1 с вместо 5 с
+    server = start_webhook_server(None, types.SimpleNamespace(submit=lambda update: updates.submit(update, 0.1)),
+                                  SECRET, 0, host="127.0.0.1", path=PATH)
+    client = Client(server)
+    try:
+        # Первое обновление занимает поток, второе - очередь, третьему места нет
+        assert client.post(message_update(1, 1)) == 200
+        assert started.wait(5)
+        assert client.post(message_update(2, 1)) == 200
+        assert client.post(message_update(3, 1)) == 503
+        assert updates.stats()['rejected'] == 1
+    finally:
+        release.set()
+        client.close()
+        server.shutdown()
+        server.server_close()
+        updates.stop()
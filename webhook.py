@@ -0,0 +1,139 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def shard_key(update):
+    """Ключ распределения обновления: ID чата, а если чата нет - пользователя"""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return update.update_id
+
+
+class ShardedUpdateQueue:
+    """Обработка обновлений пулом потоков с очередью на каждый поток.
+
+    Поток выбирается по ID чата, поэтому обновления одного чата обрабатываются
+    строго по порядку, а разных чатов - параллельно. Очереди ограничены:
+    если обработка не успевает, submit() через timeout вернет False."""
+
+    def __init__(self, process, workers=8, queue_size=1000):
+        self.process = process
+        self.workers = workers
+        self._queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counters = {'received': 0, 'processed': 0, 'rejected': 0, 'errors': 0}
+
+    def start(self):
+        for number, updates in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(updates,), name=f"updates-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=5.0):
+        """Обработать уже принятые обновления и остановить потоки"""
+        for updates in self._queues:
+            updates.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, update, timeout=5.0):
+        try:
+            self._queues[shard_key(update) % self.workers].put(update, timeout=timeout)
+        except queue.Full:
+            self._count('rejected')
+            return False
+        self._count('received')
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+        stats['queue_depth'] = sum(updates.qsize() for updates in self._queues)
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _run(self, updates):
+        while True:
+            update = updates.get()
+            if update is None:
+                return
+            try:
+                self.process(update)
+                self._count('processed')
+            except Exception:
+                self._count('errors')
+                logger.exception("Ошибка при обработке обновления %s", update.update_id)
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    # Telegram держит соединения открытыми, HTTP/1.1 избавляет от нового TCP на каждое обновление
+    protocol_version = "HTTP/1.1"
+    # Ответ уходит одной записью, без задержки Nagle + delayed ACK на keep-alive соединении
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        server = self.server
+        if self.path != server.path:
+            self.send_error(404)
+            return
+        secret = self.headers.get(SECRET_HEADER, '').encode('utf-8')
+        if not hmac.compare_digest(secret, server.secret):
+            logger.warning("Запрос к webhook с неверным секретом от %s", self.client_address[0])
+            self.send_error(403)
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            update = Update.de_json(json.loads(body), server.bot)
+        except (ValueError, TypeError, KeyError):
+            self.send_error(400)
+            return
+        if update is None:
+            self.send_error(400)
+            return
+        if not server.updates.submit(update):
+            # Очереди переполнены: Telegram повторит доставку позже
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP-сервер, который принимает обновления Telegram и передает их в ShardedUpdateQueue"""
+    daemon_threads = True
+
+    def __init__(self, address, bot, updates, secret, path="/telegram"):
+        super().__init__(address, _WebhookHandler)
+        self.bot = bot
+        self.updates = updates
+        self.secret = secret.encode('utf-8')
+        self.path = path
+
+
+def start_webhook_server(bot, updates, secret, port, host="0.0.0.0", path="/telegram"):
+    """Принимать обновления на http://host:port/path в фоновом потоке"""
+    server = WebhookServer((host, port), bot, updates, secret, path)
+    threading.Thread(target=server.serve_forever, name="webhook-http", daemon=True).start()
+    return server